@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							commandQueue.py
+#
+# Outbound command queue for one ISY.  Indigo action callbacks drop commands
+# in here and return straight away instead of holding the action thread for
+# a full REST round-trip.  Commands for the same address always land on the
+# same worker so they go out in the order they were issued, while commands
+# for different nodes are spread across the workers and run in parallel.
+#
+# The queue depth is bounded.  When a worker's queue is full the new command
+# is rejected - it is not sent, the rejection is counted and logged, and its
+# completion callback (if any) is called with the error.
+#
+# Commands can also be coalesced.  A dimmer slider or a run of BrightenBy/DimBy
+# actions produces one DON per step, and the Insteon network would otherwise
+# replay every intermediate level.  A command queued with a coalesceKey (the
+# address plus what it sets - level, heat setpoint...) is held for a short
+# window before it goes out, and if another command with the same key arrives
+# meanwhile it simply replaces the pending one.  We only do that while the
+# pending command is still the latest one queued for its address, so anything
+# queued in between (a status query, say) never gets reordered.  A command
+# waiting out its window only holds up later commands for its own address -
+# the worker goes on with other addresses that share it in the meantime.
+################################################################################
+
+import time
+import itertools
+from collections import deque
+from heapq import heappush, heappop
+from Queue import Full
+from threading import Thread, Lock, Condition
+from metrics import kNoMetrics
+
+kCommandQueueDepth = 64
+kDefaultCoalesceWindow = 0.1
+kWorkerJoinTimeout = 5
+
+########################################################
+class QueuedCommand(object):
+	####################################################
+
+	__slots__ = ('address', 'func', 'args', 'callback', 'queued', 'coalesceKey', 'due')
+
+	def __init__(self, address, func, args, callback, coalesceKey=None, due=0):
+		self.address = address
+		self.func = func
+		self.args = args
+		self.callback = callback
+		self.queued = time.time()
+		self.coalesceKey = coalesceKey
+		self.due = due
+
+########################################################
+class WorkerQueue(object):
+	####################################################
+	# one worker's commands, in order for each address.  The first command for each
+	# address sits in a heap by due time; get() hands out the earliest one that's due
+	# and waits for it otherwise, so commands that are already due go out first.
+
+	def __init__(self, depth):
+		self.depth = depth
+		self.condition = Condition()
+		self.addresses = {}		# address -> deque of commands
+		self.heads = []			# (due, tie breaker, address) for the first command of each address
+		self.counter = itertools.count()
+		self.size = 0
+		self.stopped = False
+
+	def put_nowait(self, command):
+		with self.condition:
+			if self.size >= self.depth:
+				raise Full
+			commands = self.addresses.get(command.address)
+			if commands is None:
+				commands = self.addresses[command.address] = deque()
+				heappush(self.heads, (command.due, self.counter.next(), command.address))
+			commands.append(command)
+			self.size += 1
+			self.condition.notify()
+
+	def get(self):
+		# the next command that's due, or None once stopped
+		with self.condition:
+			while not self.stopped:
+				if not self.heads:
+					self.condition.wait()
+					continue
+				due, count, address = self.heads[0]
+				wait = due - time.time()
+				if wait > 0:
+					self.condition.wait(wait)
+					continue
+				heappop(self.heads)
+				commands = self.addresses[address]
+				command = commands.popleft()
+				if commands:
+					heappush(self.heads, (commands[0].due, self.counter.next(), address))
+				else:
+					del self.addresses[address]
+				self.size -= 1
+				return command
+			return None
+
+	def stop(self):
+		with self.condition:
+			self.stopped = True
+			self.condition.notify()
+
+	def qsize(self):
+		return self.size
+
+########################################################
+class CommandQueue(object):
+	####################################################
+
+	def __init__(self, plugin, name, workers, depth=kCommandQueueDepth, coalesceWindow=kDefaultCoalesceWindow, metrics=kNoMetrics):
+		self.debugLog = plugin.getLog('rest').debug
+		self.errorLog = plugin.errorLog
+		self.name = name
+		self.queues = [WorkerQueue(depth) for i in range(max(1, workers))]
+		self.threads = []
+		self.running = False
+		self.lock = Lock()
+		self.commandStats = {}
+		self.rejected = 0
+		self.coalesceWindow = coalesceWindow
+		self.pendingByKey = {}
+		self.lastQueued = {}
+		self.coalesced = 0
+		self.metrics = metrics
+
+	def start(self):
+		self.running = True
+		for queue in self.queues:
+			thread = Thread(target=self.worker, args=(queue,))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def stop(self):
+		# anything still queued is dropped - the ISY is going away
+		self.running = False
+		for queue in self.queues:
+			queue.stop()
+		for thread in self.threads:
+			thread.join(kWorkerJoinTimeout)
+		self.threads = []
+
+	def enqueue(self, address, func, args=(), callback=None, coalesceKey=None):
+		superseded = None
+		with self.lock:
+			pending = self.pendingByKey.get(coalesceKey) if coalesceKey is not None else None
+			if pending is not None and self.lastQueued.get(address) is pending:
+				superseded = pending.callback
+				pending.func = func
+				pending.args = args
+				pending.callback = callback
+				self.coalesced += 1
+				command = None
+			else:
+				due = time.time() + self.coalesceWindow if coalesceKey is not None else 0
+				command = QueuedCommand(address, func, args, callback, coalesceKey, due)
+				self.track(command)
+		if command is None:
+			# the superseded command is as good as done - the newer target goes out in its place
+			self.complete(superseded, address, None)
+			return True
+
+		queue = self.queues[hash(address) % len(self.queues)]
+		try:
+			queue.put_nowait(command)
+		except Full:
+			with self.lock:
+				self.untrack(command)
+				self.rejected += 1
+			error = Exception('command queue full, dropped %s for %s' % (func.__name__, address))
+			self.errorLog('[%s] %s' % (self.name, error))
+			self.complete(callback, address, error)
+			return False
+		return True
+
+	# lastQueued and pendingByKey only ever hold commands that haven't started yet
+	def track(self, command):
+		self.lastQueued[command.address] = command
+		if command.coalesceKey is not None:
+			self.pendingByKey[command.coalesceKey] = command
+
+	def untrack(self, command):
+		if self.lastQueued.get(command.address) is command:
+			del self.lastQueued[command.address]
+		if command.coalesceKey is not None and self.pendingByKey.get(command.coalesceKey) is command:
+			del self.pendingByKey[command.coalesceKey]
+
+	def worker(self, queue):
+		while self.running:
+			command = queue.get()
+			if command is None:
+				break
+			with self.lock:
+				self.untrack(command)
+				func, args, callback = command.func, command.args, command.callback
+			error = None
+			try:
+				func(*args)
+			except Exception, e:
+				error = e
+				self.errorLog('[%s] %s failed for %s: %s' % (self.name, func.__name__, command.address, e))
+			self.recordLatency(func.__name__, time.time() - command.queued, error)
+			self.complete(callback, command.address, error)
+
+	def complete(self, callback, address, error):
+		if callback is None:
+			return
+		try:
+			callback(address, error)
+		except Exception, e:
+			self.errorLog('[%s] completion callback failed for %s: %s' % (self.name, address, e))
+
+	def recordLatency(self, name, latency, error):
+		if self.metrics.enabled:
+			self.metrics.count('commandsSent')
+			self.metrics.observe('commandLatency', latency)
+		with self.lock:
+			stats = self.commandStats.get(name)
+			if stats is None:
+				stats = self.commandStats[name] = {'count':0, 'errors':0, 'totalTime':0.0, 'maxTime':0.0}
+			stats['count'] += 1
+			stats['totalTime'] += latency
+			if latency > stats['maxTime']:
+				stats['maxTime'] = latency
+			if error is not None:
+				stats['errors'] += 1
+
+	def pending(self):
+		return sum([queue.qsize() for queue in self.queues])
+
+	def stats(self):
+		with self.lock:
+			return {'rejected':self.rejected, 'coalesced':self.coalesced, 'pending':self.pending(),
+				'commands':dict([(name, dict(stats)) for name, stats in self.commandStats.items()])}
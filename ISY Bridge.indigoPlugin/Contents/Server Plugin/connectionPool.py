@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							connectionPool.py
+#
+# Persistent HTTP/1.1 connections to one ISY.  The ISY only has a handful of
+# sockets to go around, so rather than opening a new TCP connection for every
+# REST call we keep a few keep-alive connections open and hand them out to
+# whoever needs one, capping how many can be in use at the same time.  The
+# ISY drops idle keep-alive sockets on its own schedule, so a request that
+# fails on a reused socket before any of the response body has arrived is
+# retried once on a fresh connection.
+################################################################################
+
+import base64
+import httplib
+import socket
+from threading import Lock, BoundedSemaphore
+
+kDefaultMaxConnections = 2
+kRestTimeout = 10
+kStreamChunkSize = 16384
+
+# httplib's read(amt) returns an empty string when the socket closes early rather than
+# raising IncompleteRead the way read() does
+def readChunk(response, chunkSize):
+	chunk = response.read(chunkSize)
+	if not chunk and response.length:
+		raise httplib.IncompleteRead('', response.length)
+	return chunk
+
+########################################################
+class ISYConnectionPool(object):
+	####################################################
+
+	def __init__(self, ISYIP, authorization, maxConnections=kDefaultMaxConnections, timeout=kRestTimeout):
+		self.ISYIP = ISYIP
+		self.authorization = authorization
+		self.authorizationHeader = 'Basic %s' % base64.b64encode(authorization)
+		self.maxConnections = maxConnections
+		self.timeout = timeout
+		self.slots = BoundedSemaphore(maxConnections)
+		self.lock = Lock()
+		self.idle = []
+		self.closed = False
+		self.hits = 0
+		self.misses = 0
+		self.reconnects = 0
+
+	def acquire(self):
+		self.slots.acquire()
+		with self.lock:
+			if self.idle:
+				self.hits += 1
+				return self.idle.pop(), True
+			self.misses += 1
+		return httplib.HTTPConnection(self.ISYIP, timeout=self.timeout), False
+
+	def release(self, conn, reusable):
+		with self.lock:
+			if reusable and not self.closed:
+				self.idle.append(conn)
+				conn = None
+		if conn is not None:
+			conn.close()
+		self.slots.release()
+
+	# returns the response and the first chunk of its body
+	def sendRequest(self, conn, command, chunkSize):
+		conn.request('GET', command, headers={'Authorization':self.authorizationHeader})
+		response = conn.getresponse()
+		return response, readChunk(response, chunkSize)
+
+	def getResponse(self, conn, reused, command, chunkSize):
+		# a stale socket can fail the send, the response or the first read, which the ISY
+		# may close on us with nothing sent; once some of the body is in, a failure is real
+		try:
+			return self.sendRequest(conn, command, chunkSize)
+		except (httplib.HTTPException, socket.error), e:
+			if not reused or getattr(e, 'partial', None):
+				raise
+			# stale keep-alive socket - httplib reconnects on the next request once it's closed
+			conn.close()
+			with self.lock:
+				self.reconnects += 1
+			return self.sendRequest(conn, command, chunkSize)
+
+	def request(self, command):
+		conn, reused = self.acquire()
+		reusable = False
+		try:
+			response, body = self.getResponse(conn, reused, command, kStreamChunkSize)
+			body += response.read()
+			reusable = not response.will_close
+			if response.status != 200:
+				raise Exception('ISY returned HTTP %d %s for %s' % (response.status, response.reason, command))
+			return body
+		finally:
+			self.release(conn, reusable)
+
+	# yields the response body a chunk at a time as it arrives, holding the connection
+	# until the body has been read to the end (or the caller stops iterating)
+	def iterRequest(self, command, chunkSize=kStreamChunkSize):
+		conn, reused = self.acquire()
+		reusable = False
+		try:
+			response, chunk = self.getResponse(conn, reused, command, chunkSize)
+			if response.status != 200:
+				response.read()
+				raise Exception('ISY returned HTTP %d %s for %s' % (response.status, response.reason, command))
+			while chunk:
+				yield chunk
+				chunk = readChunk(response, chunkSize)
+			reusable = not response.will_close
+		finally:
+			self.release(conn, reusable)
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			idle = self.idle
+			self.idle = []
+		for conn in idle:
+			conn.close()
+
+	def stats(self):
+		with self.lock:
+			return {'hits':self.hits, 'misses':self.misses, 'reconnects':self.reconnects, 'idle':len(self.idle)}
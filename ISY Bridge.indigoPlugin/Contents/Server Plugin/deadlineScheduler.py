@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							deadlineScheduler.py
+#
+# Deadlines for all of the subscriptions - heartbeat supervision, reconnect
+# backoff, connect timeouts, pending gap recovery - kept in one heap instead of
+# a threading.Timer (and so a new thread) per deadline.  Each deadline has a
+# key, and scheduling a key again replaces its previous deadline, which is how
+# a heartbeat pushes its expiry back.  Replaced and cancelled entries are only
+# marked dead and get dropped when they reach the top of the heap.
+#
+# The event loop runs due deadlines itself between select() calls.  In threaded
+# mode the scheduler runs them on one thread of its own, shared by every ISY.
+################################################################################
+
+import time
+import itertools
+from heapq import heappush, heappop
+from threading import Thread, Condition
+
+kMaxSchedulerWait = 30
+kSchedulerJoinTimeout = 5
+
+########################################################
+class DeadlineScheduler(object):
+	####################################################
+
+	def __init__(self, errorLog, wake=None):
+		self.errorLog = errorLog
+		self.wake = wake
+		self.heap = []
+		self.entries = {}
+		self.counter = itertools.count()
+		self.condition = Condition()
+		self.thread = None
+		self.running = False
+
+	def schedule(self, key, when, callback, *args):
+		# entries are [when, tie breaker, key, callback, args], callback None once dead
+		entry = [when, self.counter.next(), key, callback, args]
+		with self.condition:
+			old = self.entries.get(key)
+			if old is not None:
+				old[3] = None
+			self.entries[key] = entry
+			heappush(self.heap, entry)
+			earliest = self.heap[0] is entry
+			if earliest:
+				self.condition.notify()
+		if earliest and self.wake is not None:
+			self.wake()
+
+	def cancel(self, key):
+		with self.condition:
+			entry = self.entries.pop(key, None)
+			if entry is not None:
+				entry[3] = None
+
+	def deadline(self, key):
+		with self.condition:
+			entry = self.entries.get(key)
+			return entry[0] if entry is not None else None
+
+	def nextDeadline(self):
+		with self.condition:
+			return self.earliest()
+
+	def earliest(self):
+		while self.heap and self.heap[0][3] is None:
+			heappop(self.heap)
+		return self.heap[0][0] if self.heap else None
+
+	def runDue(self, now):
+		due = []
+		with self.condition:
+			while self.heap and self.heap[0][0] <= now:
+				entry = heappop(self.heap)
+				if entry[3] is None:
+					continue
+				del self.entries[entry[2]]
+				due.append(entry)
+		for when, count, key, callback, args in due:
+			try:
+				callback(*args)
+			except Exception, e:
+				self.errorLog('deadline %s failed: %s' % (key[-1] if isinstance(key, tuple) else key, e))
+		return len(due)
+
+	def __len__(self):
+		return len(self.entries)
+
+	###########################
+	# threaded mode
+	###########################
+
+	def start(self):
+		self.running = True
+		self.thread = Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.thread.join(kSchedulerJoinTimeout)
+
+	def run(self):
+		while self.running:
+			with self.condition:
+				deadline = self.earliest()
+				wait = kMaxSchedulerWait if deadline is None else min(deadline - time.time(), kMaxSchedulerWait)
+				if wait > 0:
+					self.condition.wait(wait)
+					continue
+			self.runDue(time.time())
@@ -24,16 +24,66 @@ import simplejson
 import os
 import string
 import struct
+import marshal
+import tempfile
 
 import urllib2
-from xml.dom.minidom import parseString
+import xml.etree.cElementTree as ElementTree
+from cStringIO import StringIO
 import socket
+import select
+import time
 
-from threading import Thread, Timer
+from threading import Thread, Lock
+from connectionPool import ISYConnectionPool, kDefaultMaxConnections
+from metrics import kNoMetrics
 
 #DiscoveryDone = False
 
 kMulticastTimeout = 1.5
+kDiscoveryTTL = 300	# discovered ISYs are refreshed in the background once the list is this old
+kDeviceTypesFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1_fam.xml')
+kDeviceTypesCacheFile = 'deviceTypes.cache'
+kDeviceTypesCacheVersion = 1
+
+################################################################################
+
+def elementText(element, tag):
+	return element.findtext(tag) or ''
+
+# iterparse reads from a file, so this presents a chunk iterator as one
+class ChunkStream(object):
+
+	def __init__(self, chunks):
+		self.chunks = chunks
+		self.bytesRead = 0
+
+	def read(self, size=-1):
+		# iterparse is happy with less than it asked for, as long as '' means the end
+		for chunk in self.chunks:
+			self.bytesRead += len(chunk)
+			return chunk
+		return ''
+
+	def close(self):
+		self.chunks.close()
+
+# yields each tag element once it's complete; once the caller moves on, everything
+# parsed so far is cleared out of the tree
+def iterElements(stream, tag):
+	depth = 0
+	root = None
+	for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = element
+			depth += 1
+			continue
+		depth -= 1
+		if element.tag == tag:
+			yield element
+		if depth == 1:
+			root.clear()
 
 ################################################################################
 #
@@ -47,12 +97,21 @@ class DeviceController(object):
 	# class init & del
 	###########################
 
-	def __init__(self, plugin):
+	def __init__(self, plugin, maxConnections=kDefaultMaxConnections):
 		self.plugin = plugin
-		self.debugLog = self.plugin.debugLog
+		self.restLog = plugin.getLog('rest')
+		self.discoveryLog = plugin.getLog('discovery')
+		self.syncLog = plugin.getLog('sync')
 		self.errorLog = self.plugin.errorLog
-		self.discoveryDone = False
-		self.deviceTypes = parseString(self.getXmlFromFile('1_fam.xml'))
+		self.discovered = {}
+		self.discoveryTime = 0
+		self.discoveryRunning = False
+		self.discoveryLock = Lock()
+		self.maxConnections = maxConnections
+		self.pools = {}
+		self.poolLock = Lock()
+		self.deviceTypes = None
+		self.metrics = {}
 		
 	def __del__(self):
 		pass
@@ -65,53 +124,170 @@ class DeviceController(object):
 		xml_file.close()
 		return xml_data
 
+################################################################################
+#
+#			DEVICE TYPE DESCRIPTIONS
+#
+################################################################################
+
+	# Device descriptions come from the nodeSubCategory names in 1_fam.xml.  Rather than
+	# searching the XML for every node we import, it is boiled down once to a
+	# (category, subcategory) -> description dict the first time it's needed.  The dict is
+	# also kept in a marshal file in the plugin's cache folder, which is reused for as
+	# long as 1_fam.xml doesn't change, so normally the XML isn't parsed at all.
+	def deviceDescription(self, categoryID, subcategoryID):
+		if self.deviceTypes is None:
+			self.deviceTypes = self.loadDeviceTypes()
+		return self.deviceTypes.get((categoryID, subcategoryID), 'Unknown Device')
+
+	def loadDeviceTypes(self):
+		try:
+			info = os.stat(kDeviceTypesFile)
+		except OSError:
+			self.errorLog('Unable to find 1_fam.xml, device descriptions will not be available')
+			return {}
+		stamp = (kDeviceTypesCacheVersion, int(info.st_mtime), info.st_size)
+		cacheFile = os.path.join(self.cacheFolder(), kDeviceTypesCacheFile)
+		try:
+			with open(cacheFile, 'rb') as cache:
+				cached = marshal.load(cache)
+			if cached['stamp'] == stamp:
+				return cached['deviceTypes']
+		except Exception:
+			pass	# missing, stale or unreadable - just rebuild it
+
+		deviceTypes = self.parseDeviceTypes(kDeviceTypesFile)
+		try:
+			with open(cacheFile, 'wb') as cache:
+				marshal.dump({'stamp':stamp, 'deviceTypes':deviceTypes}, cache)
+		except Exception, e:
+			self.syncLog.debug('Unable to write device type cache %s: %s', cacheFile, e)
+		return deviceTypes
+
+	def parseDeviceTypes(self, filename):
+		deviceTypes = {}
+		for category in ElementTree.parse(filename).getroot().iter('nodeCategory'):
+			categoryID = category.get('id')
+			for subcategory in category.iter('nodeSubCategory'):
+				description = subcategory.get('name', '').replace('DEV_SCAT_','').replace('_',' ').lower()
+				# the first definition wins, as it did when we searched the XML
+				deviceTypes.setdefault((categoryID, subcategory.get('id')), string.capwords(description))
+		return deviceTypes
+
+	def cacheFolder(self):
+		try:
+			folder = os.path.join(indigo.server.getInstallFolderPath(), 'Preferences', 'Plugins', self.plugin.pluginId)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			return folder
+		except Exception:
+			return tempfile.gettempdir()
+
 ################################################################################
 #
 #			ISY DISCOVERY VIA DATAGRAM
 #
 ################################################################################
 		
-	def multicastTimeout(self):
-		self.debugLog('<<--called: multicastTimeout')
-		self.discoveryDone = True
+	# Discovery waits in select() for answers to our M-SEARCH until the deadline, or
+	# until every ISY we already know about (by uuid) has answered.  Whatever answers
+	# is cached, so the device config dialog can be filled straight from the cache and
+	# only kicks off a background refresh once the cache is older than kDiscoveryTTL.
+	def deviceDiscovery(self, knownISYs=(), timeout=kMulticastTimeout):
+		self.discoveryLog.debug('<<---called: deviceDiscovery')
 		
-	def deviceDiscovery(self):
-		self.debugLog('<<---called: deviceDiscovery')
-		
-		ISYs = []
+		found = {}
 		MCAST_GRP = '239.255.255.250'
 		MCAST_PORT = 1900
 		msg = "M-SEARCH * HTTP/1.1\r\nHOST:239.255.255.250:1900\r\nMAN:\"ssdp.discover\"\r\nMX:1\r\nST:urn:udi-com:device:X_Insteon_Lighting_Device:1\r\n\r\n"
-		self.discoveryDone = False
 
 		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 5)
 		mreq = struct.pack('4sl', socket.inet_aton(MCAST_GRP), socket.INADDR_ANY)
 		sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-		sock.settimeout(0.1)
-
-		timer = Timer(kMulticastTimeout, self.multicastTimeout)
-		timer.start()		
-		sock.sendto(msg, (MCAST_GRP, MCAST_PORT))
+		sock.setblocking(0)
+
+		startTime = time.time()
+		deadline = startTime + timeout
+		try:
+			sock.sendto(msg, (MCAST_GRP, MCAST_PORT))
+			while True:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				readable, writable, errors = select.select([sock], [], [], remaining)
+				if not readable:
+					break
+				try:
+					ISY = self.parseDiscoveryResponse(sock.recv(10240))
+				except socket.error:
+					continue
+				if ISY is not None:
+					self.discoveryLog.debug(ISY[1])
+					found[ISY[0]] = ISY
+					if knownISYs and set(knownISYs).issubset(found):
+						self.discoveryLog.debug('all known ISYs answered after %.2f seconds', time.time() - startTime)
+						break
+		finally:
+			sock.close()
+
+		with self.discoveryLock:
+			if knownISYs and set(knownISYs).issubset(found):
+				# we stopped listening early, so keep anything else we found last time
+				self.discovered.update(found)
+			else:
+				self.discovered = found
+			self.discoveryTime = time.time()
+		return [[value, label] for uuid, value, label in found.values()]
 
-		while self.discoveryDone != True:
-			try:
-				data = sock.recv(10240)
-	 			if 'HTTP/1.1 200 OK' in data:
-	 				index = data.index('LOCATION:')
-	  				index2 = data.index('/desc')
- 					location = data[index+16:index2]
- 					index = data.index('USN:')
- 					index2 = data.index('::urn')
- 					uuid = data[index+4:index2]
- 					ISY = '%s [%s]' % (location, uuid)
-					self.debugLog(ISY)
-					ISYs.append([ISY.replace(' ',''), ISY])
-			except:
-				pass
-
-		sock.close()
-		return ISYs
+	# returns (uuid, menu value, menu label) for an ISY's answer, None for anything else
+	def parseDiscoveryResponse(self, data):
+		if 'HTTP/1.1 200 OK' not in data:
+			return None
+		try:
+			index = data.index('LOCATION:')
+			index2 = data.index('/desc')
+			location = data[index+16:index2]
+			index = data.index('USN:')
+			index2 = data.index('::urn')
+			uuid = data[index+4:index2]
+		except ValueError:
+			return None
+		ISY = '%s [%s]' % (location, uuid)
+		return (uuid.replace(' ',''), ISY.replace(' ',''), ISY)
+
+	def discoveredISYs(self, knownISYs=()):
+		with self.discoveryLock:
+			cached = [[value, label] for uuid, value, label in self.discovered.values()]
+			age = time.time() - self.discoveryTime
+			refresh = age >= kDiscoveryTTL and not self.discoveryRunning
+			if refresh and len(cached) > 0:
+				self.discoveryRunning = True
+		if len(cached) == 0:
+			# nothing to show yet, so this one time the dialog has to wait
+			return self.deviceDiscovery(knownISYs)
+		if refresh:
+			self.refreshDiscovery(knownISYs, started=True)
+		return sorted(cached, key=lambda ISY: ISY[1])
+
+	def refreshDiscovery(self, knownISYs=(), started=False):
+		if not started:
+			with self.discoveryLock:
+				if self.discoveryRunning:
+					return
+				self.discoveryRunning = True
+		thread = Thread(target=self.backgroundDiscovery, args=(knownISYs,))
+		thread.daemon = True
+		thread.start()
+
+	def backgroundDiscovery(self, knownISYs):
+		try:
+			self.deviceDiscovery(knownISYs)
+		except Exception, e:
+			self.errorLog('ISY discovery failed: %s' % e)
+		finally:
+			with self.discoveryLock:
+				self.discoveryRunning = False
 
 ################################################################################
 #
@@ -119,41 +295,89 @@ class DeviceController(object):
 #
 ################################################################################
 		
-	def encodeBase64(self, arg):
-		encoded = base64.b64encode(arg)
-		self.debugLog(encoded)
-		return encoded
+	# one pool of keep-alive connections per ISY; a change of credentials gets a new pool
+	def getPool(self, ISYIP, authorization):
+		with self.poolLock:
+			pool = self.pools.get(ISYIP)
+			if pool is None or pool.authorization != authorization:
+				if pool is not None:
+					pool.close()
+				pool = ISYConnectionPool(ISYIP, authorization, self.maxConnections)
+				self.pools[ISYIP] = pool
+			return pool
+
+	def closePool(self, ISYIP):
+		with self.poolLock:
+			pool = self.pools.pop(ISYIP, None)
+		if pool is not None:
+			pool.close()
+
+	def setMaxConnections(self, maxConnections):
+		# existing pools are dropped and rebuilt with the new limit on next use
+		with self.poolLock:
+			self.maxConnections = maxConnections
+			pools = self.pools.values()
+			self.pools = {}
+		for pool in pools:
+			pool.close()
+
+	def poolStats(self, ISYIP):
+		with self.poolLock:
+			pool = self.pools.get(ISYIP)
+		if pool is None:
+			return None
+		return pool.stats()
+
+	# metrics for the ISY at ISYIP, or None to stop collecting them
+	def setMetrics(self, ISYIP, metrics):
+		if metrics is None:
+			self.metrics.pop(ISYIP, None)
+		else:
+			self.metrics[ISYIP] = metrics
 
 	def sendRest(self, ISYIP, authorization, command):
-		url = 'http://%s%s' % (ISYIP, command)
-		self.debugLog(url)
-		req = urllib2.Request(url)
-		req.add_header('Authorization', 'Basic %s' % self.encodeBase64(authorization))
-		file = urllib2.urlopen(req)
-		response = file.read()
-		file.close()
-		self.debugLog("jms/response from API is:")
-		self.debugLog(response)
-		self.debugLog("jms/--- end of response ---")
+		self.restLog.debug('http://%s%s', ISYIP, command)
+		metrics = self.metrics.get(ISYIP, kNoMetrics)
+		if not metrics.enabled:
+			response = self.getPool(ISYIP, authorization).request(command)
+		else:
+			startTime = time.time()
+			try:
+				response = self.getPool(ISYIP, authorization).request(command)
+			except Exception:
+				metrics.count('restErrors')
+				raise
+			metrics.observe('restLatency', time.time() - startTime)
+			metrics.count('restRequests')
+		self.restLog.verbose('%d bytes from %s%s', len(response), ISYIP, command)
 		return response
 
-	def extractFromXML(self, xml, tag, attribute=None, value=None):
-		elementList = xml.getElementsByTagName(tag)
-		if attribute == None:
-			return elementList[0].toxml().replace('<' + tag + '>','').replace('</' + tag + '>','')
-			
-		for element in elementList:
-			if element.getAttribute(attribute) == value:
-				return element
-		
-		return None # this is the failure case
-
+	# The node, scene and program lists can run to hundreds of KB.  Rather than reading the
+	# whole response and building a DOM of it, we feed it to iterparse as it arrives and
+	# hand back one element at a time, throwing each away once the caller is done with
+	# it, so memory stays bounded by the largest single element.
+	def streamRest(self, ISYIP, authorization, command, tag):
+		self.restLog.debug('http://%s%s', ISYIP, command)
+		metrics = self.metrics.get(ISYIP, kNoMetrics)
+		startTime = time.time()
+		stream = ChunkStream(self.getPool(ISYIP, authorization).iterRequest(command))
+		try:
+			for element in iterElements(stream, tag):
+				yield element
+		finally:
+			stream.close()
+		# the whole download, parsing and the caller's work included
+		metrics.observe('restStreamTime', time.time() - startTime)
+		metrics.count('restRequests')
+		self.restLog.verbose('%d bytes from %s%s', stream.bytesRead, ISYIP, command)
+
+	# device is a node element from cElementTree
 	def parseOneDevice(self, device):
-		flag = device.getAttribute('flag')
-		name = self.extractFromXML(device, 'name')
-		address = self.extractFromXML(device, 'address')
-		type = self.extractFromXML(device, 'type').split('.')
-		self.debugLog("jms/parseOneDevice flag: %s ; name %s ; address %s ; type %s" % (flag, name, address, type))
+		flag = device.get('flag', '')
+		name = elementText(device, 'name')
+		address = elementText(device, 'address')
+		type = elementText(device, 'type').split('.')
+		self.syncLog.verbose("jms/parseOneDevice flag: %s ; name %s ; address %s ; type %s", flag, name, address, type)
 # type is a 4-digit dotted code like 113.1.2.0.  The first # (called categoryID here) is a broad class
 # and the second number is a device type within this.  The third is version and the fourth is zero. 
 # from API manual: device category.device subcategory.version.reserved
@@ -163,17 +387,16 @@ class DeviceController(object):
 # If the category ID starts with 4, then this is (probably?) a ZWave device.  In that case,
 # we need to get the <devtype> element, and within the <devtype> element, we are only
 # really interested in the <cat> element.
+		zwaveCategory = None
 		if categoryID == '4':
-			self.debugLog('Family 4 device, extracting cat from devtype')
-			devtype = self.extractFromXML(device, 'devtype')
+			self.syncLog.verbose('Family 4 device, extracting cat from devtype')
+			devtype = device.find('devtype')
 			if devtype is None:
-				self.debugLog('Unable to extract Z-Wave devtype')
+				self.syncLog.debug('Unable to extract Z-Wave devtype')
 			else:
-				self.debugLog('Z-Wave devtype is %s' % devtype)
-				devtypeXML = '<XML>' + devtype + '</XML>'
-				zwaveCategory = self.extractFromXML(parseString(devtypeXML), 'cat')
+				zwaveCategory = elementText(devtype, 'cat')
 
-			self.debugLog('Family 4 device Z-Wave Category is %s' % zwaveCategory)
+			self.syncLog.verbose('Family 4 device Z-Wave Category is %s', zwaveCategory)
 		
 		addressParts = address.split(' ')
 # address in the case of Insteon devices looks like an Insteon address,
@@ -218,7 +441,7 @@ class DeviceController(object):
 				elif zwaveCategory in ['134', '109']:
 					deviceType = 'ISYDimmer'
 				else:
-					self.debugLog('Z-Wave category unknown or unsupported; ignoring this device')
+					self.syncLog.debug('Z-Wave category unknown or unsupported; ignoring this device')
 					return None
 
 		elif categoryID == '5':
@@ -258,49 +481,56 @@ class DeviceController(object):
 		else:
 			maxBrightness = 255
 
-		category = self.extractFromXML(self.deviceTypes, 'nodeCategory', 'id', categoryID)
-		subcategory = self.extractFromXML(category, 'nodeSubCategory', 'id', subcategoryID)
-		if subcategory:
-			description = subcategory.getAttribute('name').replace('DEV_SCAT_','').replace('_',' ').lower()
-			description = string.capwords(description)
-		else:
-			description = "Unknown Device"
+		description = self.deviceDescription(categoryID, subcategoryID)
 		return {'name':name, 'address':address, 'type':deviceType, 'description':description, 'nodeType':flag, 'maxBrightness':maxBrightness}
 
-	def getDevices(self, ISYIP, authorization):
-		deviceXML = parseString(self.sendRest(ISYIP, authorization, '/rest/nodes'))
-		devices = deviceXML.getElementsByTagName('node')
-		deviceList = []
-		for device in devices:
+	# node added events carry the node's XML in their eventInfo
+	def parseDeviceXML(self, devStr):
+		device = ElementTree.fromstring('<e>%s</e>' % devStr).find('.//node')
+		if device is None:
+			return None
+		return self.parseOneDevice(device)
+
+	def iterDevices(self, ISYIP, authorization):
+		for device in self.streamRest(ISYIP, authorization, '/rest/nodes', 'node'):
 			deviceDict = self.parseOneDevice(device)
 			if deviceDict != None:
-				deviceList.append(deviceDict)
- 		return deviceList
+				yield deviceDict
+
+	def iterScenes(self, ISYIP, authorization):
+		for scene in self.streamRest(ISYIP, authorization, '/rest/nodes/scenes', 'group'):
+			yield [elementText(scene, 'address'), elementText(scene, 'name')]
+
+	def iterPrograms(self, ISYIP, authorization):
+		for program in self.streamRest(ISYIP, authorization, '/rest/programs/?subfolders=true', 'program'):
+			if program.get('folder') == 'false':
+				# Apparently the API changed and now requires the full id so we can't strip it. [JMM]
+				yield [program.get('id'), elementText(program, 'name')]
+
+	def getDevices(self, ISYIP, authorization):
+		return list(self.iterDevices(ISYIP, authorization))
 		
 	def getScenes(self, ISYIP, authorization):
-		sceneXML = parseString(self.sendRest(ISYIP, authorization, '/rest/nodes/scenes'))
-		scenes = sceneXML.getElementsByTagName('group')
-		sceneList = []
-		for scene in scenes:
-			name = self.extractFromXML(scene, 'name')
-			address = self.extractFromXML(scene, 'address')
-			sceneList.append([address, name])
-		return sceneList
+		return list(self.iterScenes(ISYIP, authorization))
 		
 	def getPrograms(self, ISYIP, authorization):
-		programXML = parseString(self.sendRest(ISYIP, authorization, '/rest/programs/?subfolders=true'))
-		programs = programXML.getElementsByTagName('program')
-		programList = []
-		for program in programs:
-			folder = program.getAttribute('folder')
-			if folder == 'false':
-				id = program.getAttribute('id')
-				# Apparently the API changed and now requires the full id so we can't strip it. [JMM]
-				#id = id.lstrip('0')
-				name = self.extractFromXML(program, 'name')
-				programList.append([id, name])
-		return programList
+		return list(self.iterPrograms(ISYIP, authorization))
 		
+	# current value of every property of every node, as {address: [(property, value), ...]}
+	def getStatus(self, ISYIP, authorization):
+		status = {}
+		properties = None
+		for event, element in ElementTree.iterparse(StringIO(self.sendRest(ISYIP, authorization, '/rest/status')), events=('start', 'end')):
+			if event == 'start':
+				if element.tag == 'node':
+					properties = status.setdefault(element.get('id'), [])
+				elif element.tag == 'property' and properties is not None:
+					properties.append((element.get('id'), element.get('value')))
+			elif element.tag == 'node':
+				properties = None
+				element.clear()
+		return status
+
 ################################################################################
 #
 #			ACTIONS
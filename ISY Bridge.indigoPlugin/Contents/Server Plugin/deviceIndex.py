@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							deviceIndex.py
+#
+# Our Indigo devices by ISY and address, so that starting an ISY, syncing its
+# devices and filling in the scene and program menus don't each walk the whole
+# of indigo.devices and read every device's props from the server.  It's built
+# once when the plugin starts and kept current from the deviceCreated,
+# deviceUpdated and deviceDeleted callbacks.
+#
+# The ISY controller devices are kept by device id (one being set up has no
+# ISYuuid yet) and everything else by ISYuuid, then address.  Indigo will let
+# two devices share an address, so members holds every device and addresses
+# the one the subscription server should use.
+################################################################################
+
+from threading import Lock
+
+########################################################
+class DeviceIndex(object):
+	####################################################
+
+	def __init__(self, pluginId):
+		self.pluginId = pluginId
+		self.lock = Lock()
+		self.ISYs = {}			# device id -> ISY controller device
+		self.members = {}		# ISYuuid -> {device id: device}
+		self.addresses = {}		# ISYuuid -> {address: device}
+		self.locations = {}		# device id -> (ISYuuid, address)
+
+	def build(self, devices):
+		with self.lock:
+			self.ISYs = {}
+			self.members = {}
+			self.addresses = {}
+			self.locations = {}
+			for dev in devices:
+				if dev.pluginId == self.pluginId:
+					self.insert(dev)
+
+	###########################
+	# kept current from the device callbacks
+	###########################
+
+	def add(self, dev):
+		# a new device or a new copy of one we have, which may have changed ISY or
+		# address; returns where it used to be, (ISYuuid, address), if anywhere
+		if dev.pluginId != self.pluginId:
+			return None
+		with self.lock:
+			location = self.delete(dev.id)
+			self.insert(dev)
+			return location
+
+	def remove(self, dev):
+		with self.lock:
+			return self.delete(dev.id)
+
+	def insert(self, dev):
+		if dev.deviceTypeId == 'ISY':
+			self.ISYs[dev.id] = dev
+			return
+		props = dev.pluginProps
+		ISYuuid = props.get('ISYuuid')
+		address = props.get('address')
+		if not ISYuuid or not address:
+			return
+		self.members.setdefault(ISYuuid, {})[dev.id] = dev
+		addresses = self.addresses.setdefault(ISYuuid, {})
+		current = addresses.get(address)
+		if current is None or current.id == dev.id:
+			addresses[address] = dev
+		self.locations[dev.id] = (ISYuuid, address)
+
+	def delete(self, id):
+		if id in self.ISYs:
+			del self.ISYs[id]
+			return None
+		location = self.locations.pop(id, None)
+		if location is None:
+			return None
+		ISYuuid, address = location
+		members = self.members[ISYuuid]
+		del members[id]
+		addresses = self.addresses[ISYuuid]
+		if addresses.get(address) is not None and addresses[address].id == id:
+			del addresses[address]
+			# hand the address over to a duplicate if there is one
+			for dev in members.values():
+				if self.locations[dev.id][1] == address:
+					addresses[address] = dev
+					break
+		return location
+
+	###########################
+	# lookups
+	###########################
+
+	def controllers(self):
+		with self.lock:
+			return sorted(self.ISYs.values(), key=lambda dev: dev.id)
+
+	def devices(self, ISYuuid):
+		# every device belonging to the ISY, duplicate addresses included
+		with self.lock:
+			return self.members.get(ISYuuid, {}).values()
+
+	def location(self, dev):
+		# (ISYuuid, address), or None for an ISY or a device we don't index
+		return self.locations.get(dev.id)
+
+	def lookup(self, ISYuuid, address):
+		with self.lock:
+			return self.addresses.get(ISYuuid, {}).get(address)
+
+	def deviceDict(self, ISYuuid):
+		# address -> device, a copy the caller is free to change
+		with self.lock:
+			return dict(self.addresses.get(ISYuuid, {}))
@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							eventDecoder.py
+#
+# Pulls sid, seqnum, control, action, node and eventInfo out of an ISY
+# subscription event body.  Events are small and almost always laid out
+# exactly the same way, so the common case is a single validated pass over
+# the string.  Anything that doesn't look exactly like a well-formed event
+# (entities, CDATA, non-ASCII text, missing elements...) goes through the
+# strict minidom decoder instead, which raises on malformed payloads.
+################################################################################
+
+import re
+from xml.dom.minidom import parseString
+
+kEventFields = ('control', 'action', 'node', 'eventInfo')
+kSpecialMarkup = re.compile(r'[&\x80-\xff]|<!|<\?')
+
+########################################################
+class ISYEvent(object):
+	####################################################
+
+	__slots__ = ('sid', 'seqnum', 'control', 'action', 'node', 'eventInfo')
+
+	def __init__(self, sid, seqnum, control, action, node, eventInfo):
+		self.sid = sid
+		self.seqnum = seqnum
+		self.control = control
+		self.action = action
+		self.node = node
+		self.eventInfo = eventInfo
+
+	def __repr__(self):
+		return 'ISYEvent(seqnum=%d control=%s action=%s node=%s eventInfo=%s)' % (self.seqnum, self.control, self.action, self.node, self.eventInfo)
+
+########################################################
+
+def decodeEvent(body):
+	event = fastDecodeEvent(body)
+	if event is None:
+		event = strictDecodeEvent(body)
+	return event
+
+########################################################
+# fast path
+########################################################
+
+def attributeValue(attributes, name):
+	for quote in '"\'':
+		key = '%s=%s' % (name, quote)
+		start = attributes.find(key)
+		if start >= 0 and (start == 0 or attributes[start-1] in ' \t\r\n'):
+			start += len(key)
+			end = attributes.find(quote, start)
+			if end < 0:
+				return None
+			return attributes[start:end]
+	return None
+
+def elementText(body, tag, pos, limit):
+	# returns (text, position after the element) for the first <tag> at or
+	# after pos, or (None, pos) if it isn't there or isn't simple enough
+	start = body.find('<' + tag, pos, limit)
+	if start < 0 or body[start+len(tag)+1] not in '> /':
+		return None, pos
+	close = body.find('>', start, limit)
+	if close < 0:
+		return None, pos
+	if body[close-1] == '/':
+		return '', close + 1
+	endTag = '</%s>' % tag
+	if tag == 'eventInfo':
+		# eventInfo carries nested markup, so take everything up to its last close tag
+		end = body.rfind(endTag, close, limit)
+	else:
+		end = body.find(endTag, close, limit)
+		if end >= 0 and '<' in body[close+1:end]:
+			return None, pos
+	if end < 0:
+		return None, pos
+	return body[close+1:end], end + len(endTag)
+
+def fastDecodeEvent(body):
+	if kSpecialMarkup.search(body, body.find('?>') + 1) is not None:
+		return None
+	start = body.find('<Event ')
+	if start < 0:
+		return None
+	tagEnd = body.find('>', start)
+	limit = body.rfind('</Event>')
+	if tagEnd < 0 or limit < tagEnd or body[tagEnd-1] == '/':
+		return None
+	attributes = body[start+7:tagEnd]
+	sid = attributeValue(attributes, 'sid')
+	seqnum = attributeValue(attributes, 'seqnum')
+	if sid is None or seqnum is None or not seqnum.isdigit():
+		return None
+
+	pos = tagEnd + 1
+	values = []
+	for tag in kEventFields:
+		value, pos = elementText(body, tag, pos, limit)
+		if value is None:
+			return None
+		values.append(value)
+	return ISYEvent(sid, int(seqnum), *values)
+
+########################################################
+# strict path
+########################################################
+
+def innerXML(xml, tag):
+	element = xml.getElementsByTagName(tag)[0].toxml()
+	start = element.find('>') + 1
+	end = element.rfind('<')
+	return element[start:end]
+
+def strictDecodeEvent(body):
+	event = parseString(body).getElementsByTagName('Event')[0]
+	values = [innerXML(event, tag) for tag in kEventFields]
+	return ISYEvent(event.getAttribute('sid'), int(event.getAttribute('seqnum')), *values)
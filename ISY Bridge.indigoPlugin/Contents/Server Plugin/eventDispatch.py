@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							eventDispatch.py
+#
+# Lookup tables that route subscription events to their handlers.  Handlers are
+# registered against a (control, action) pair, or against a control alone to
+# catch every action of that control that has no handler of its own, and
+# device handlers are registered by Indigo deviceTypeId.  Adding support for a
+# new control is a register call - nothing in the event loop changes.
+#
+# Every registered handler keeps its own invocation count and the time spent
+# in it, so we can see where event processing time actually goes.
+################################################################################
+
+import time
+
+########################################################
+class EventHandler(object):
+	####################################################
+
+	__slots__ = ('name', 'func', 'count', 'errors', 'totalTime', 'maxTime')
+
+	def __init__(self, name, func):
+		self.name = name
+		self.func = func
+		self.count = 0
+		self.errors = 0
+		self.totalTime = 0.0
+		self.maxTime = 0.0
+
+	def __call__(self, *args):
+		start = time.time()
+		try:
+			return self.func(*args)
+		except:
+			self.errors += 1
+			raise
+		finally:
+			elapsed = time.time() - start
+			self.count += 1
+			self.totalTime += elapsed
+			if elapsed > self.maxTime:
+				self.maxTime = elapsed
+
+########################################################
+class EventDispatcher(object):
+	####################################################
+
+	def __init__(self):
+		self.handlers = {}
+		self.controls = {}
+		self.deviceTypes = {}
+
+	def handler(self, func, name):
+		# handlers registered under the same name share one set of counters
+		name = name or func.__name__
+		entry = self.handlers.get(name)
+		if entry is None or entry.func != func:
+			entry = self.handlers[name] = EventHandler(name, func)
+		return entry
+
+	def registerControlHandler(self, control, action, func, name=None):
+		# action None matches any action of the control without a handler of its own
+		self.controls[(control, action)] = self.handler(func, name)
+
+	def registerDeviceHandler(self, deviceTypeIds, func, name=None):
+		entry = self.handler(func, name)
+		for deviceTypeId in deviceTypeIds:
+			self.deviceTypes[deviceTypeId] = entry
+
+	def controlHandler(self, control, action):
+		entry = self.controls.get((control, action))
+		if entry is None:
+			entry = self.controls.get((control, None))
+		return entry
+
+	def deviceHandler(self, deviceTypeId):
+		return self.deviceTypes.get(deviceTypeId)
+
+	def stats(self):
+		return dict([(entry.name, {'count':entry.count, 'errors':entry.errors, 'totalTime':entry.totalTime, 'maxTime':entry.maxTime})
+			for entry in self.handlers.values() if entry.count > 0])
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							menuCache.py
+#
+# The scene and program popups in the action and trigger dialogs.  Each ISY's
+# scene and program lists are decoded from its props once, the menus built from
+# them are kept until something changes, and menus narrowed by a filter are kept
+# the same way, so a dialog opens with a list lookup however many programs the
+# ISYs have.
+#
+# A list is replaced whenever the plugin refreshes that ISY's scenes or programs,
+# and the menus are rebuilt when the set of ISYs changes or one is renamed - with
+# more than one ISY each entry carries the ISY's name.
+################################################################################
+
+import simplejson
+from threading import Lock
+
+kMenuKinds = ['scenes', 'programs']
+
+########################################################
+class MenuCache(object):
+	####################################################
+
+	def __init__(self):
+		self.lock = Lock()
+		self.lists = dict([(kind, {}) for kind in kMenuKinds])	# kind -> ISY device id -> [[id, name], ...]
+		self.menus = {}		# (kind, filter) -> [[value, label], ...]
+		self.controllerIds = []	# the ISYs the menus were built for
+
+	def store(self, kind, ISYId, items):
+		with self.lock:
+			self.lists[kind][ISYId] = items
+			self.clear(kind)
+
+	def invalidate(self):
+		# an ISY was renamed
+		with self.lock:
+			self.menus = {}
+
+	def forget(self, ISYId):
+		with self.lock:
+			for kind in kMenuKinds:
+				self.lists[kind].pop(ISYId, None)
+			self.menus = {}
+
+	def clear(self, kind):
+		for key in [key for key in self.menus if key[0] == kind]:
+			del self.menus[key]
+
+	# filter narrows the menu to the entries whose label contains it, ignoring case
+	def menu(self, kind, controllers, filter=''):
+		filter = (filter or '').lower()
+		controllerIds = [ISY.id for ISY in controllers]
+		with self.lock:
+			if controllerIds != self.controllerIds:
+				self.menus = {}
+				self.controllerIds = controllerIds
+			menu = self.menus.get((kind, filter))
+			if menu is None:
+				if filter:
+					menu = [item for item in self.fullMenu(kind, controllers) if filter in item[1].lower()]
+				else:
+					menu = self.fullMenu(kind, controllers)
+				self.menus[(kind, filter)] = menu
+			return list(menu)
+
+	def fullMenu(self, kind, controllers):
+		menu = self.menus.get((kind, ''))
+		if menu is not None:
+			return menu
+		menu = []
+		for ISY in controllers:
+			items = self.lists[kind].get(ISY.id)
+			if items is None:
+				items = self.lists[kind][ISY.id] = simplejson.loads(ISY.pluginProps.get(kind, '[]'))
+			for id, name in items:
+				if len(controllers) == 1:
+					menu.append(['[%s]%s' % (ISY.id, id), name])
+				else:
+					menu.append(['[%s]%s' % (ISY.id, id), '[%s]%s' % (ISY.name, name)])
+		self.menus[(kind, '')] = menu
+		return menu
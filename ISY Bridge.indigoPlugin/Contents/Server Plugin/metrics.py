@@ -0,0 +1,120 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							metrics.py
+#
+# Counters and latency histograms for one ISY - events received, event parse and
+# handler time, REST latency, commands sent, reconnects, sequence gaps.  The
+# subscription server publishes a summary to the ISY device's states every so
+# often, and the Log Performance Metrics menu item dumps the lot.
+#
+# Collection is off unless turned on in the plugin config.  When it's off each
+# ISY gets kNoMetrics instead, whose methods do nothing, and the hot paths check
+# metrics.enabled before even reading the clock.
+################################################################################
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+kMetricsInterval = 60	# seconds between updates of the ISY device's metric states
+
+# histogram bucket upper bounds in milliseconds; anything slower lands in the last one
+kBucketBounds = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+########################################################
+class Histogram(object):
+	####################################################
+
+	__slots__ = ('count', 'totalTime', 'maxTime', 'buckets')
+
+	def __init__(self):
+		self.count = 0
+		self.totalTime = 0.0
+		self.maxTime = 0.0
+		self.buckets = [0] * (len(kBucketBounds) + 1)
+
+	def observe(self, seconds):
+		self.count += 1
+		self.totalTime += seconds
+		if seconds > self.maxTime:
+			self.maxTime = seconds
+		self.buckets[bisect_left(kBucketBounds, seconds * 1000)] += 1
+
+	def percentile(self, fraction):
+		# upper bound of the bucket holding the percentile, in milliseconds
+		if self.count == 0:
+			return 0.0
+		rank = fraction * self.count
+		seen = 0
+		for index, count in enumerate(self.buckets):
+			seen += count
+			if seen >= rank:
+				return kBucketBounds[index] if index < len(kBucketBounds) else 1000 * self.maxTime
+		return 1000 * self.maxTime
+
+	def stats(self):
+		return {'count':self.count, 'avg':1000 * self.totalTime / self.count if self.count else 0.0,
+			'p50':self.percentile(0.5), 'p99':self.percentile(0.99), 'max':1000 * self.maxTime}
+
+########################################################
+class Metrics(object):
+	####################################################
+	# updated from the subscription, command queue and REST threads at once
+
+	enabled = True
+
+	def __init__(self):
+		self.counters = {}
+		self.histograms = {}
+		self.lock = Lock()
+		self.started = time.time()
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	def observe(self, name, seconds):
+		with self.lock:
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram()
+			histogram.observe(seconds)
+
+	def counter(self, name):
+		return self.counters.get(name, 0)
+
+	def average(self, name):
+		# in milliseconds
+		histogram = self.histograms.get(name)
+		if histogram is None or histogram.count == 0:
+			return 0.0
+		return 1000 * histogram.totalTime / histogram.count
+
+	def snapshot(self):
+		with self.lock:
+			return {'uptime':time.time() - self.started, 'counters':dict(self.counters),
+				'histograms':dict([(name, histogram.stats()) for name, histogram in self.histograms.items()])}
+
+########################################################
+class NullMetrics(object):
+	####################################################
+
+	enabled = False
+
+	def count(self, name, amount=1):
+		pass
+
+	def observe(self, name, seconds):
+		pass
+
+	def counter(self, name):
+		return 0
+
+	def average(self, name):
+		return 0.0
+
+	def snapshot(self):
+		return None
+
+kNoMetrics = NullMetrics()
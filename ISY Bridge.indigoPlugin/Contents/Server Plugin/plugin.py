@@ -29,8 +29,18 @@ import socket
 import simplejson
 from threading import Thread
 from deviceController import DeviceController
-from subscriptionServer import SubscriptionServer
-from xml.dom.minidom import parseString
+from connectionPool import kDefaultMaxConnections
+from commandQueue import CommandQueue, kDefaultCoalesceWindow
+from subscriptionServer import SubscriptionServer, kSocketTimeout
+from subscriptionLoop import SubscriptionLoop
+from deadlineScheduler import DeadlineScheduler
+from deviceIndex import DeviceIndex
+from startupOrchestrator import StartupOrchestrator
+from topologyCache import TopologyCache
+from menuCache import MenuCache
+from triggerRegistry import TriggerRegistry, kProgramEvents
+from metrics import Metrics, kNoMetrics
+from subsystemLog import SubsystemLog, kLogSubsystems, kLogDebug, kLogOff
 
 ################################################################################
 #
@@ -48,14 +58,40 @@ class Plugin(indigo.PluginBase):
 		indigo.PluginBase.__init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
 		self.debug = pluginPrefs.get('debug', False)
 		self.eventViewer = pluginPrefs.get('eventViewer', 'none')
+		self.logs = dict([(name, SubsystemLog(name, self.debugLog)) for name in kLogSubsystems])
+		self.setLogLevels(pluginPrefs)
 		self.debugLog('<<----called: init')
-		self.deviceController = DeviceController(self)
+		self.deviceController = DeviceController(self, int(pluginPrefs.get('maxConnections', kDefaultMaxConnections)))
+		self.topologyCache = TopologyCache(self.deviceController.cacheFolder, self.logs['sync'])
+		self.coalesceWindow = int(pluginPrefs.get('coalesceWindow', int(kDefaultCoalesceWindow * 1000))) / 1000.0
+		self.subscriptionMode = pluginPrefs.get('subscriptionMode', 'threaded')
+		self.collectMetrics = pluginPrefs.get('collectMetrics', False)
+		self.subscriptionLoop = None
+		self.deadlineScheduler = None
+		self.deviceIndex = DeviceIndex(pluginId)
+		self.startupOrchestrator = StartupOrchestrator(self)
+		self.menuCache = MenuCache()
 		self.lookupTable = {}
-		self.thenTriggers = {}
-		self.elseTriggers = {}
+		self.triggerRegistry = TriggerRegistry(self, indigo.trigger.execute)
 		
 	def __del__(self):
 		indigo.PluginBase.__del__(self)
+
+	def startup(self):
+		# the one full pass over our devices; the device callbacks keep the index current from here on
+		self.deviceIndex.build(indigo.devices.iter('self'))
+		self.triggerRegistry.start()
+		# have the ISYs on the network cached before anyone opens the device dialog
+		self.deviceController.refreshDiscovery(self.knownISYs())
+
+	def shutdown(self):
+		if self.subscriptionLoop is not None:
+			self.subscriptionLoop.stop()
+			self.subscriptionLoop = None
+		if self.deadlineScheduler is not None:
+			self.deadlineScheduler.stop()
+			self.deadlineScheduler = None
+		self.triggerRegistry.stop()
 				
 	###########################
 	# validate plugin Prefs
@@ -63,8 +99,33 @@ class Plugin(indigo.PluginBase):
 
 	def validatePrefsConfigUi(self, valuesDict):
 		self.debugLog('<<----called: validatePrefsConfigUi')
+		errorsDict = indigo.Dict()
+		try:
+			maxConnections = int(valuesDict['maxConnections'])
+		except ValueError:
+			maxConnections = 0
+		if maxConnections < 1:
+			errorsDict['maxConnections'] = 'Enter a whole number of 1 or more.'
+		try:
+			coalesceWindow = int(valuesDict['coalesceWindow'])
+		except ValueError:
+			coalesceWindow = -1
+		if coalesceWindow < 0:
+			errorsDict['coalesceWindow'] = 'Enter a whole number of milliseconds, or 0 to turn off the delay.'
+		if len(errorsDict) > 0:
+			return (False, valuesDict, errorsDict)
+
 		self.debug = valuesDict['debug']
+		self.setLogLevels(valuesDict)
 		self.eventViewer = valuesDict['eventViewer']
+		if maxConnections != self.deviceController.maxConnections:
+			self.deviceController.setMaxConnections(maxConnections)
+		self.coalesceWindow = coalesceWindow / 1000.0
+		# a new subscription mode is picked up as each ISY device is restarted
+		self.subscriptionMode = valuesDict['subscriptionMode']
+		self.collectMetrics = valuesDict['collectMetrics']
+		for lookup in self.lookupTable.values():
+			lookup['commandQueue'].coalesceWindow = self.coalesceWindow
 		return True
 	
 ##################################################################################
@@ -73,6 +134,19 @@ class Plugin(indigo.PluginBase):
 #
 ##################################################################################
 
+	###########################
+	# subsystem debug logging
+	###########################
+
+	# the subscription, REST, discovery and sync code log through these rather than
+	# debugLog; with debugging off every one of them is off
+	def getLog(self, name):
+		return self.logs[name]
+
+	def setLogLevels(self, prefs):
+		for name, log in self.logs.items():
+			log.level = int(prefs.get('%sLogLevel' % name, kLogDebug)) if self.debug else kLogOff
+
 	###########################
 	# find a valid device name
 	###########################
@@ -108,32 +182,70 @@ class Plugin(indigo.PluginBase):
 		if dev.deviceTypeId != 'ISY': return
 		
 		dev.updateStateOnServer('badNodesList', '[]')
-		pluginProps = dev.pluginProps
-		#self.debugLog("pluginprops are %s" % pluginProps)
-		
+
 		# Added flag to the props for this device that will allow us to do
 		# the initial load of devices, scenes, and programs when an ISY Controller
 		# device is first started up. [JMM]
-		if not pluginProps['initialLoadDone']:
-			self.updateISYDevices(dev)
-			self.updateISYScenes(dev)	
-			self.updateISYPrograms(dev)
-			pluginProps['initialLoadDone'] = True
-			dev.replacePluginPropsOnServer(pluginProps)
- 		
+		# The load and the subscription start run on a thread for each ISY, so that
+		# all of them come up at once - see startupOrchestrator.py
+		self.startupOrchestrator.start(dev)
+
+	# called from the startup orchestrator once the ISY's devices are in the index
+	def startISY(self, dev):
+		pluginProps = dev.pluginProps
+
  		# create index of devices and initialize subscription server
 		#self.debugLog('deviceStartComm: Setting up deviceDict, then dumping it.')
-		deviceDict = dict([(device.address, device) for device in indigo.devices if device.pluginId == self.pluginId
-			and device.deviceTypeId != 'ISY' and device.pluginProps['ISYuuid'] == pluginProps['ISYuuid']])
+		deviceDict = self.buildDeviceDict(pluginProps['ISYuuid'])
 		#self.debugLog(deviceDict)
 		subscriptionServer = SubscriptionServer(self, dev, deviceDict)
 
-		# pass the port to the Subscription Manager and start it
- 		myThread = Thread(target=subscriptionServer.startServer)
- 		myThread.start()
-			
-		# create entry in lookup table
-		self.lookupTable[pluginProps['ISYuuid']] = {'ISYIP':dev.address, 'authorization':pluginProps['authorization'], 'subscriptionServer':subscriptionServer, 'thread':myThread}
+		# like the subscription mode, turning metrics on or off takes effect as each ISY is restarted
+		metrics = Metrics() if self.collectMetrics else kNoMetrics
+		subscriptionServer.metrics = metrics
+		self.deviceController.setMetrics(dev.address, metrics)
+
+		# outbound commands to this ISY go through a queue so action callbacks don't block
+		commandQueue = CommandQueue(self, dev.name, self.deviceController.maxConnections, coalesceWindow=self.coalesceWindow,
+			metrics=metrics)
+		commandQueue.start()
+
+		# create entry in lookup table - before the subscription starts, since in event loop
+		# mode its status snapshot goes through the command queue
+		lookup = {'ISYIP':dev.address, 'authorization':pluginProps['authorization'], 'subscriptionServer':subscriptionServer, 'thread':None,
+			'commandQueue':commandQueue, 'metrics':metrics}
+		self.lookupTable[pluginProps['ISYuuid']] = lookup
+
+		# pass the port to the Subscription Manager and start it, either on the event
+		# loop shared by all ISYs or on a thread of its own
+		if self.subscriptionMode == 'loop':
+			if self.subscriptionLoop is None:
+				self.subscriptionLoop = SubscriptionLoop(self)
+				self.subscriptionLoop.start()
+			self.subscriptionLoop.add(subscriptionServer)
+		else:
+			# heartbeat deadlines for all the threaded servers run on one shared thread
+			if self.deadlineScheduler is None:
+				self.deadlineScheduler = DeadlineScheduler(self.errorLog)
+				self.deadlineScheduler.start()
+			subscriptionServer.scheduler = self.deadlineScheduler
+ 			myThread = Thread(target=subscriptionServer.startServer)
+ 			myThread.start()
+			lookup['thread'] = myThread
+
+	# the scene and program lists from a first load, written in one go so the two
+	# don't overwrite each other's props
+	def storeInitialLoad(self, dev, sceneList, programList):
+		pluginProps = dev.pluginProps
+		pluginProps['scenes'] = simplejson.dumps(sceneList)
+		pluginProps['programs'] = simplejson.dumps(programList)
+		pluginProps['initialLoadDone'] = True
+		dev.replacePluginPropsOnServer(pluginProps)
+		self.menuCache.store('scenes', dev.id, sceneList)
+		self.menuCache.store('programs', dev.id, programList)
+		topology = self.lookupTable[pluginProps['ISYuuid']]['subscriptionServer'].topology
+		topology.loadScenes(sceneList)
+		topology.loadPrograms(programList)
 
 	###########################
 	# device stop communication
@@ -142,15 +254,30 @@ class Plugin(indigo.PluginBase):
 	def deviceStopComm(self, dev):
 		self.debugLog('<<----called: deviceStopComm: %s id: %d' % (dev.name, dev.id))
 		if dev.deviceTypeId == 'ISY':
+			stopTime = time.time()
+			self.startupOrchestrator.wait(dev)
 			ISYuuid = dev.pluginProps['ISYuuid']
-			lookup = self.lookupTable[ISYuuid]
+			lookup = self.lookupTable.pop(ISYuuid, None)
+			if lookup is None:
+				# the start failed, there's nothing running
+				return
 			subscriptionServer = lookup['subscriptionServer']
 			myThread = lookup['thread']
-			del self.lookupTable[ISYuuid]
+			closed = None
+			if myThread is None and self.subscriptionLoop is not None:
+				closed = self.subscriptionLoop.remove(subscriptionServer)
 			subscriptionServer.stopServer()
-			time.sleep(4)
-			myThread.join()
-			indigo.server.log('ISY stopped')
+			lookup['commandQueue'].stop()
+			# wait for the subscription to let go of its socket rather than for a fixed time
+			if closed is not None:
+				closed.wait(kSocketTimeout)
+			elif myThread is not None:
+				myThread.join(kSocketTimeout)
+			self.deviceController.setMetrics(dev.address, None)
+			self.logPoolStats(dev)
+			self.logCommandStats(dev, lookup['commandQueue'])
+			self.deviceController.closePool(dev.address)
+			indigo.server.log('[%s] ISY stopped in %.2f seconds' % (dev.name, time.time() - stopTime))
 
 ##################################################################################
 #
@@ -166,17 +293,22 @@ class Plugin(indigo.PluginBase):
 	def populateISYList(self, filter='', valuesDict=None, typeId='', targetId=0):
 		self.debugLog('<<----called: populateISYList')
 		
-		ISYInfoList = self.deviceController.deviceDiscovery()
-		self.debugLog(simplejson.dumps(ISYInfoList))
+		ISYInfoList = self.deviceController.discoveredISYs(self.knownISYs())
+		self.logs['discovery'].debug('%s', ISYInfoList)
 		
 		return ISYInfoList
 	
 	# callback method for findISY button		
 	def findISYButton(self, valuesDict, typeId, devID):
 		self.debugLog('<<----called: findISYButton')
-		# just need to return valuesDict to get ISYList to auto repopulate
+		# search the network again rather than trusting the cache, then return
+		# valuesDict to get ISYList to auto repopulate from the fresh results
+		self.deviceController.deviceDiscovery()
 		return valuesDict
 
+	def knownISYs(self):
+		return [device.pluginProps['ISYuuid'] for device in self.deviceIndex.controllers() if device.pluginProps.get('ISYuuid')]
+
 	###########################
 	# validate configUi input
 	###########################
@@ -220,56 +352,74 @@ class Plugin(indigo.PluginBase):
 	###########################
 
 	def updateISYDevices(self, dev):
-
+		startTime = time.time()
 		folderId = dev.folderId
 		ISYIP = dev.address   #pluginProps['ISYIP']
 		pluginProps = dev.pluginProps
 		ISYuuid = pluginProps['ISYuuid']
 
-		# create, update or delete indigo devices for ISY Insteon devices
-		ISYDevices = self.deviceController.getDevices(ISYIP, pluginProps['authorization'])
-		self.debugLog("ISYDevices:\n%s" % str(ISYDevices))
-		self.debugLog("jms/end of ISYDevices")
-
-		existingDevices = [device for device in indigo.devices
-			if device.pluginId == self.pluginId and device.pluginProps['ISYuuid'] == ISYuuid
-			and device.deviceTypeId != "ISY" and device.deviceTypeId != 'ISYProgram']
-		for existingDevice in existingDevices:
-			# check to see if this device corresponds to a device on the new device list
-			newDevice = [device for device in ISYDevices if device['address'] == existingDevice.pluginProps['address']]
-			if newDevice != []:
-				deviceInfo = newDevice[0]
-				self.debugLog('updating ISY device: %s' % existingDevice.name)
-				
-				# I don't believe trying to sync the name from the ISY to Indigo
-				# is a reasonable thing to do given that the new name might
-				# collide with an existing device in Indigo. After initial
-				# creation, it'll be up to the user to change the name in
-				# Indigo. [JMM]
-				#existingDevice.name = deviceInfo['name']
-				
+		# create, update or delete indigo devices for ISY Insteon devices.  Both sides are
+		# keyed by address so each existing device is matched in a single lookup.
+		ISYDevices = dict([(device['address'], device) for device in self.deviceController.iterDevices(ISYIP, pluginProps['authorization'])])
+		self.logs['sync'].verbose("ISYDevices:\n%s", ISYDevices.values())
+
+		existingDevices = {}
+		deleted = []
+		for device in self.deviceIndex.devices(ISYuuid):
+			if device.deviceTypeId == 'ISYProgram':
+				continue
+			props = device.pluginProps
+			if props['address'] in ISYDevices and props['address'] not in existingDevices:
+				existingDevices[props['address']] = (device, props)
+			else:
+				# gone from the ISY (or a duplicate of a device we already have)
+				deleted.append(device)
+
+		updated = 0
+		for address, (existingDevice, props) in existingDevices.iteritems():
+			deviceInfo = ISYDevices[address]
+
+			# I don't believe trying to sync the name from the ISY to Indigo
+			# is a reasonable thing to do given that the new name might
+			# collide with an existing device in Indigo. After initial
+			# creation, it'll be up to the user to change the name in
+			# Indigo. [JMM]
+			#existingDevice.name = deviceInfo['name']
+
+			# I also don't believe that a device should automatically
+			# move back to the folder that it's controller device is
+			# in. If the user moved it, they probably would like for
+			# it to stay moved. [JMM]
+			#if existingDevice.folderId != folderId:
+			#	existingDevice.moveToFolder(folderId)
+
+			# only go to the server for the fields that actually changed
+			changed = False
+			if existingDevice.description != deviceInfo['description']:
+				self.debugLog('updating ISY device description: %s' % existingDevice.name)
 				existingDevice.description = deviceInfo['description']
 				existingDevice.replaceOnServer()
-				
-				# I also don't believe that a device should automatically
-				# move back to the folder that it's controller device is
-				# in. If the user moved it, they probably would like for
-				# it to stay moved. [JMM]
-				#if existingDevice.folderId != folderId:
-				#	existingDevice.moveToFolder(folderId)
-				
-				# remove the device address and info from the list we need to deal with
-				ISYDevices = [dev for dev in ISYDevices if dev != deviceInfo]
-			else:
-				# if the device is not in the new device list, delete it
-				self.debugLog('deleting device: %s' % existingDevice.name)
-				indigo.device.delete(existingDevice.id)
+				changed = True
+			if props.get('ISYtype') != deviceInfo['type'] or str(props.get('ISYmaxBrightness')) != str(deviceInfo['maxBrightness']):
+				self.debugLog('updating ISY device props: %s' % existingDevice.name)
+				props['ISYtype'] = deviceInfo['type']
+				props['ISYmaxBrightness'] = deviceInfo['maxBrightness']
+				existingDevice.replacePluginPropsOnServer(props)
+				changed = True
+			if changed:
+				updated += 1
+
+		for device in deleted:
+			self.debugLog('deleting device: %s' % device.name)
+			indigo.device.delete(device.id)
+			self.refreshServerDevices(self.deviceIndex.remove(device))
 
 		# add devices if necessary
 		# jms/171220 - added a number of properties, including ISYmaxBrightness and ISYtype, so
 		# that we can "know" more about the device when we come back to handling it when we get
 		# an event.  Fortunately, Indigo is great about letting us store junk in their database.
-		for device in ISYDevices:
+		added = [device for address, device in ISYDevices.iteritems() if address not in existingDevices]
+		for device in added:
 			self.debugLog('creating device: %s' % device['name'])
 			pDev = indigo.device.create(protocol=indigo.kProtocol.Plugin,
 				# We need to get a valid name so that an exception isn't thrown if
@@ -281,43 +431,94 @@ class Plugin(indigo.PluginBase):
 				props={'ISYuuid':ISYuuid, 'address':device['address'], 'ISYtype':device['type'], 
 				 'ISYmaxBrightness':device['maxBrightness'], 'ShowCoolHeatEquipmentStateUI':True},
 				 folder=folderId)
+			# the deviceCreated callback won't arrive until we're done here, and the
+			# subscription server may be about to start from the index
+			self.deviceIndex.add(pDev)
+
+		indigo.server.log('[%s] device update: %d added, %d updated, %d deleted, %d unchanged in %.2f seconds' % (dev.name,
+			len(added), updated, len(deleted), len(existingDevices) - updated, time.time() - startTime))
 
 	def updateISYScenes(self, dev):
 		ISYIP = dev.address
 		pluginProps = dev.pluginProps
 		ISYScenes = self.deviceController.getScenes(ISYIP, pluginProps['authorization'])
 		pluginProps['scenes'] = simplejson.dumps(ISYScenes)
-		self.debugLog("scene list from ISY: \n%s" % str(pluginProps['scenes']))
+		self.logs['sync'].verbose("scene list from ISY: \n%s", pluginProps['scenes'])
 		dev.replacePluginPropsOnServer(pluginProps)
+		self.menuCache.store('scenes', dev.id, ISYScenes)
+		lookup = self.lookupTable.get(pluginProps['ISYuuid'])
+		if lookup is not None:
+			lookup['subscriptionServer'].topology.loadScenes(ISYScenes)
+		return ISYScenes
 
 	def updateISYPrograms(self, dev):
 		ISYIP = dev.address
 		pluginProps = dev.pluginProps
 		ISYPrograms = self.deviceController.getPrograms(ISYIP, pluginProps['authorization'])
 		pluginProps['programs'] = simplejson.dumps(ISYPrograms)
-		self.debugLog("program list from ISY: \n%s" % str(pluginProps['programs']))
+		self.logs['sync'].verbose("program list from ISY: \n%s", pluginProps['programs'])
 		dev.replacePluginPropsOnServer(pluginProps)
-		
+		self.menuCache.store('programs', dev.id, ISYPrograms)
+		lookup = self.lookupTable.get(pluginProps['ISYuuid'])
+		if lookup is not None:
+			lookup['subscriptionServer'].topology.loadPrograms(ISYPrograms)
+		return ISYPrograms
+
+	# full reload of an ISY's devices, scenes and programs
+	def reloadISY(self, dev):
+		self.updateISYDevices(dev)
+		sceneList = self.updateISYScenes(dev)
+		programList = self.updateISYPrograms(dev)
+		return (sceneList, programList)
+
+	# address -> device for all of an ISY's devices; this is what the subscription server works from
+	def buildDeviceDict(self, ISYuuid):
+		return self.deviceIndex.deviceDict(ISYuuid)
+
 	###########################
-	# device deleted
+	# device created, updated and deleted
 	###########################
 
+	def deviceCreated(self, dev):
+		self.deviceIndex.add(dev)
+		self.refreshServerDevices(self.deviceIndex.location(dev))
+		indigo.PluginBase.deviceCreated(self, dev)
+
+	# called for every state change on every one of our devices, so the subscription
+	# server only hears about it when a device has changed ISY or address
+	def deviceUpdated(self, origDev, newDev):
+		previous = self.deviceIndex.add(newDev)
+		location = self.deviceIndex.location(newDev)
+		if newDev.deviceTypeId == 'ISY' and newDev.name != origDev.name:
+			self.menuCache.invalidate()
+		if previous != location:
+			self.refreshServerDevices(previous, location)
+		indigo.PluginBase.deviceUpdated(self, origDev, newDev)
+
 	def deviceDeleted(self, dev):
 		self.debugLog('<<----called: deviceDeleted')
 		if dev.deviceTypeId == 'ISY':
 			ISYuuid = dev.pluginProps['ISYuuid']
-			[indigo.device.delete(device.id) for device in indigo.devices
-				if device.pluginId == self.pluginId and device.pluginProps['ISYuuid'] == ISYuuid
-				and device.deviceTypeId != 'ISY']
-		else:
-			pluginProps = dev.pluginProps
-			address = pluginProps['address']
-			ISYuuid = pluginProps['ISYuuid']
-			if ISYuuid in self.lookupTable:
-				self.lookupTable[ISYuuid]['subscriptionServer'].deleteDevice(address)
+			[indigo.device.delete(device.id) for device in self.deviceIndex.devices(ISYuuid)]
+			self.menuCache.forget(dev.id)
+		self.refreshServerDevices(self.deviceIndex.remove(dev))
 
 		self.deviceStopComm(dev)
 
+	# hand the devices now indexed at these (ISYuuid, address) locations to the running
+	# subscription server for that ISY, or take them away if there's nothing there any more
+	def refreshServerDevices(self, *locations):
+		for location in set(locations):
+			if location is None or location[0] not in self.lookupTable:
+				continue
+			ISYuuid, address = location
+			subscriptionServer = self.lookupTable[ISYuuid]['subscriptionServer']
+			device = self.deviceIndex.lookup(ISYuuid, address)
+			if device is None:
+				subscriptionServer.deleteDevice(address)
+			else:
+				subscriptionServer.updateDevice(address, device)
+
 ##################################################################################
 #
 #		CALLBACKS FROM SUBSCRIPTION SERVER
@@ -346,13 +547,13 @@ class Plugin(indigo.PluginBase):
 	def deviceNeedsDeletion(self, dev):
 		self.debugLog('<<---called: deviceNeedsDeletion: %s' % dev.name)
 		indigo.device.delete(dev.id)
+		self.refreshServerDevices(self.deviceIndex.remove(dev))
 		
 	def deviceNeedsAdding(self, ISY, devStr):
 		self.debugLog('<<---called: deviceNeedsAdding: %s' % devStr)
 		ISYuuid = ISY.pluginProps['ISYuuid']
 		folderId = ISY.folderId
-		devXML = parseString(devStr).getElementsByTagName('node')[0]
-		device = self.deviceController.parseOneDevice(devXML)
+		device = self.deviceController.parseDeviceXML(devStr)
 		if device == None:
 			return None
 		else:
@@ -360,24 +561,37 @@ class Plugin(indigo.PluginBase):
 				name=device['name'],
 				deviceTypeId=device['type'],
 				description=device['description'],
-				props={'ISYuuid':ISYuuid, 'address':device['address'], 'ShowCoolHeatEquipmentStateUI':True},
+				props={'ISYuuid':ISYuuid, 'address':device['address'], 'ISYtype':device['type'],
+				 'ISYmaxBrightness':device['maxBrightness'], 'ShowCoolHeatEquipmentStateUI':True},
 				folder=folderId)
 			if device['nodeType'] == '144': indigo.device.enable(pDev, value=False)
+			self.deviceIndex.add(pDev)
 			return pDev
+
+	def storeScenes(self, ISY, sceneList):
+		dev = indigo.devices[ISY.id]
+		pluginProps = dev.pluginProps
+		pluginProps['scenes'] = simplejson.dumps(sceneList)
+		dev.replacePluginPropsOnServer(pluginProps)
+		self.menuCache.store('scenes', dev.id, sceneList)
+
+	def refreshPrograms(self, ISY):
+		return self.updateISYPrograms(indigo.devices[ISY.id])
+
+	# full reload of an ISY's devices, scenes and programs, for when the incremental
+	# topology sync has lost track
+	def resyncISY(self, ISY):
+		dev = indigo.devices[ISY.id]
+		sceneList, programList = self.reloadISY(dev)
+		return (self.buildDeviceDict(dev.pluginProps['ISYuuid']), sceneList, programList)
 		
 	def undefinedDeviceDetected(self, address):
 		self.debugLog('<<---called: undefinedDeviceDetected: %s' % address)
 		
 	def programFeedback(self, id, fork, status):
 		self.debugLog('program: %s %s fork %s execution' % (id, fork, status))
-		if fork == 'then':
-			if status == 'finished':
-				if id in self.thenTriggers:
-					indigo.trigger.execute(self.thenTriggers[id])
-		elif fork == 'else':
-			if status == 'finished':
-				if id in self.elseTriggers:
-					indigo.trigger.execute(self.elseTriggers[id])
+		# this is the subscription thread - the registry queues the triggers for its own thread to run
+		self.triggerRegistry.programEvent(id, fork, status)
 
 	def pluginEventViewer(self, ISY, eventInfo):
 		if self.eventViewer == 'normal':
@@ -385,8 +599,39 @@ class Plugin(indigo.PluginBase):
 		elif self.eventViewer == 'highlight':
 			self.errorLog('[%s Event Viewer]: %s' % (ISY.name, eventInfo))
 
+	def getStatus(self, ISY):
+		return self.deviceController.getStatus(ISY.address, ISY.pluginProps['authorization'])
+
+	# the event loop's status fetches, run on the ISY's command queue so the loop thread
+	# never waits on the ISY; callback(status, error) is called from the queue's worker
+	def queueStatus(self, ISY, callback):
+		result = {}
+		def getStatus(ISYIP, authorization):
+			try:
+				result['status'] = self.deviceController.getStatus(ISYIP, authorization)
+			except Exception, e:
+				result['error'] = e
+		def fetched(address, error):
+			callback(result.get('status'), error or result.get('error'))
+		self.queueCommand(ISY.pluginProps['ISYuuid'], ISY.address, getStatus, callback=fetched)
+
 	def queryDevice(self, ISY, address):
-		self.deviceController.queryStatus(ISY.address, ISY.pluginProps['authorization'], address)
+		self.queueCommand(ISY.pluginProps['ISYuuid'], address, self.deviceController.queryStatus, address)
+
+	# hands a DeviceController command to the ISY's command queue; the ISY address and
+	# authorization are filled in ahead of args.  Pass coalesce= with what the command
+	# sets ('level', 'heatSetpoint'...) to let a newer command for the same address and
+	# target replace it while it is still waiting to go out.
+	def queueCommand(self, ISYuuid, address, command, *args, **kwargs):
+		lookup = self.lookupTable.get(ISYuuid)
+		if lookup is None:
+			self.errorLog('ISY %s is not running, %s for %s not sent' % (ISYuuid, command.__name__, address))
+			return False
+		args = (lookup['ISYIP'], lookup['authorization']) + args
+		coalesceKey = None
+		if kwargs.get('coalesce') is not None:
+			coalesceKey = (address, kwargs['coalesce'])
+		return lookup['commandQueue'].enqueue(address, command, args, kwargs.get('callback'), coalesceKey)
 
 ##################################################################################
 #
@@ -398,9 +643,7 @@ class Plugin(indigo.PluginBase):
 		self.debugLog('<<---called: updateAllFromMenu')
 		if valuesDict['ISYSelection'] == '': return
 		dev = valuesDict['ISYSelection']
-		self.updateISYDevices(indigo.devices[int(dev)])
-		self.updateISYScenes(indigo.devices[int(dev)])
-		self.updateISYPrograms(indigo.devices[int(dev)])
+		self.reloadISY(indigo.devices[int(dev)])
 
 	def updateDevicesFromMenu(self, valuesDict, typeId):
 		self.debugLog('<<---called: updateDevicesFromMenu')
@@ -419,6 +662,79 @@ class Plugin(indigo.PluginBase):
 		if valuesDict['ISYSelection'] == '': return
 		dev = valuesDict['ISYSelection']
 		self.updateISYPrograms(indigo.devices[int(dev)])
+
+	def logConnectionStatsFromMenu(self):
+		self.debugLog('<<---called: logConnectionStatsFromMenu')
+		indigo.server.log('topology cache: %d hits, %d misses' % (self.topologyCache.hits, self.topologyCache.misses))
+		indigo.server.log('program triggers: %d active, %d executed, %d dropped' % (self.triggerRegistry.count(),
+			self.triggerRegistry.dispatched, self.triggerRegistry.dropped))
+		for dev in self.deviceIndex.controllers():
+			self.logPoolStats(dev)
+			lookup = self.lookupTable.get(dev.pluginProps['ISYuuid'])
+			if lookup is not None:
+				self.logCommandStats(dev, lookup['commandQueue'])
+				self.logRecoveryStats(dev, lookup['subscriptionServer'])
+				self.logHeartbeatStats(dev, lookup['subscriptionServer'])
+				self.logEventStats(dev, lookup['subscriptionServer'])
+
+	def logMetricsFromMenu(self):
+		self.debugLog('<<---called: logMetricsFromMenu')
+		if not self.collectMetrics:
+			indigo.server.log('performance metrics are off, turn them on in the plugin config and restart the ISY devices')
+			return
+		for dev in self.deviceIndex.controllers():
+			lookup = self.lookupTable.get(dev.pluginProps['ISYuuid'])
+			snapshot = lookup['metrics'].snapshot() if lookup is not None else None
+			if snapshot is None:
+				indigo.server.log('[%s] no metrics collected, restart the device to start collecting' % dev.name)
+				continue
+			indigo.server.log('[%s] metrics over the last %.0f minutes' % (dev.name, snapshot['uptime'] / 60))
+			for name, value in sorted(snapshot['counters'].items()):
+				indigo.server.log('[%s]   %s: %d' % (dev.name, name, value))
+			for name, histogram in sorted(snapshot['histograms'].items()):
+				indigo.server.log('[%s]   %s: %d, avg %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.1f ms' % (dev.name, name,
+					histogram['count'], histogram['avg'], histogram['p50'], histogram['p99'], histogram['max']))
+
+	def logPoolStats(self, dev):
+		stats = self.deviceController.poolStats(dev.address)
+		if stats is None:
+			indigo.server.log('[%s] no REST connections opened yet' % dev.name)
+		else:
+			indigo.server.log('[%s] REST connection pool: %d hits, %d misses, %d reconnects, %d idle' %
+				(dev.name, stats['hits'], stats['misses'], stats['reconnects'], stats['idle']))
+
+	def logRecoveryStats(self, dev, subscriptionServer):
+		if subscriptionServer.recoveries > 0:
+			averageTime = subscriptionServer.recoveryTime / subscriptionServer.recoveries
+		else:
+			averageTime = 0.0
+		indigo.server.log('[%s] subscription: %d sequence gaps, %d events missed, %d status recoveries, avg %.0f ms' % (dev.name,
+			subscriptionServer.sequenceGaps, subscriptionServer.missedEvents, subscriptionServer.recoveries, 1000 * averageTime))
+
+	def logHeartbeatStats(self, dev, subscriptionServer):
+		stats = subscriptionServer.heartbeatStats()
+		if stats['lastHeartbeat'] is None:
+			indigo.server.log('[%s] heartbeat: none received yet, %d missed' % (dev.name, stats['missed']))
+		else:
+			indigo.server.log('[%s] heartbeat: every %d s, last %.0f s ago, %d missed, socket idle %.0f s' % (dev.name,
+				stats['interval'], stats['lastHeartbeat'], stats['missed'], stats['idleTime']))
+		if stats['nextDeadline'] is not None:
+			indigo.server.log('[%s]   next deadline in %.0f s' % (dev.name, stats['nextDeadline']))
+
+	def logEventStats(self, dev, subscriptionServer):
+		stats = subscriptionServer.dispatcher.stats()
+		# busiest handlers first
+		for name, handler in sorted(stats.items(), key=lambda item: -item[1]['totalTime']):
+			indigo.server.log('[%s]   %s: %d events, %d failed, %.0f ms total, avg %.2f ms, max %.1f ms' % (dev.name, name, handler['count'],
+				handler['errors'], 1000 * handler['totalTime'], 1000 * handler['totalTime'] / handler['count'], 1000 * handler['maxTime']))
+
+	def logCommandStats(self, dev, commandQueue):
+		stats = commandQueue.stats()
+		indigo.server.log('[%s] command queue: %d pending, %d rejected, %d superseded commands dropped' %
+			(dev.name, stats['pending'], stats['rejected'], stats['coalesced']))
+		for name, command in sorted(stats['commands'].items()):
+			indigo.server.log('[%s]   %s: %d sent, %d failed, avg %.0f ms, max %.0f ms' % (dev.name, name, command['count'],
+				command['errors'], 1000 * command['totalTime'] / command['count'], 1000 * command['maxTime']))
 		
 ##################################################################################
 #
@@ -446,38 +762,17 @@ class Plugin(indigo.PluginBase):
 		else:
 			return (True, valuesDict)
 
-	# method for dynamic list of ISY scenes
+	# method for dynamic list of ISY scenes; the menus come ready made from the menu
+	# cache, and a filter in the XML narrows them to the names containing it
 	def populateSceneList(self, filter='', valuesDict=None, typeId='', targetId=0):
 		self.debugLog('<<----called: populateSceneList')
-		ISYList = [device for device in indigo.devices if device.pluginId == self.pluginId
-			and device.deviceTypeId == 'ISY']
-		numberOfISYs = len(ISYList)
-		menu = []
-		for ISY in ISYList:
-			scenes = simplejson.loads(ISY.pluginProps['scenes'])
-			for scene in scenes:
-				if numberOfISYs == 1:
-					menu.append(['[%s]%s' % (ISY.id, scene[0]), scene[1]])
-				else:
-					menu.append('[%s]%s' % (ISY.id, scene[0]), '[%s]%s' % (ISY.name, scene[1]))
-		return menu
+		return self.menuCache.menu('scenes', self.deviceIndex.controllers(), filter)
 
 	# method for dynamic list of ISY programs
 	def populateProgramList(self, filter="", valuesDict=None, typeId="", targetId=0):
 		self.debugLog('<<----called: populateProgramList')
-		ISYList = [device for device in indigo.devices if device.pluginId == self.pluginId
-			and device.deviceTypeId == 'ISY']
-		numberOfISYs = len(ISYList)
-		self.debugLog("populateProgramsList: numberOfISYs: %i" % numberOfISYs)
-		menu = []
-		for ISY in ISYList:
-			programs = simplejson.loads(ISY.pluginProps['programs'])
-			for program in programs:
-				if numberOfISYs == 1:
-					menu.append(['[%s]%s' % (ISY.id, program[0]), program[1]])
-				else:
-					menu.append('[%s]%s' % (ISY.id, program[0]), '[%s]%s' % (ISY.name, program[1]))
-		self.debugLog("populateProgramList: menu: %s" % str(menu))
+		menu = self.menuCache.menu('programs', self.deviceIndex.controllers(), filter)
+		self.debugLog("populateProgramList: %d programs" % len(menu))
 		return menu
 
 	###########################
@@ -491,7 +786,7 @@ class Plugin(indigo.PluginBase):
 		ISYId = int(scene[1:index])
 		sceneAddress = scene[index+1:]
 		dev = indigo.devices[ISYId]
-		self.deviceController.deviceOn(dev.address, dev.pluginProps['authorization'], sceneAddress)
+		self.queueCommand(dev.pluginProps['ISYuuid'], sceneAddress, self.deviceController.deviceOn, sceneAddress, coalesce='level')
 
 	def sendSceneOff(self, action):
 		scene = action.props['scene']
@@ -500,7 +795,7 @@ class Plugin(indigo.PluginBase):
 		ISYId = int(scene[1:index])
 		sceneAddress = scene[index+1:]
 		dev = indigo.devices[ISYId]
-		self.deviceController.deviceOff(dev.address, dev.pluginProps['authorization'], sceneAddress)
+		self.queueCommand(dev.pluginProps['ISYuuid'], sceneAddress, self.deviceController.deviceOff, sceneAddress, coalesce='level')
 
 	def sendProgramCommand(self, action):
 		program = action.props['program']
@@ -508,7 +803,7 @@ class Plugin(indigo.PluginBase):
 		ISYId = int(program[1:index])
 		programId = program[index+1:]
 		dev = indigo.devices[ISYId]
-		self.deviceController.programCommand(dev.address, dev.pluginProps['authorization'], programId, action.props['command'])
+		self.queueCommand(dev.pluginProps['ISYuuid'], programId, self.deviceController.programCommand, programId, action.props['command'])
 	
 	########################################
 	# Dimmer/Relay Action callback
@@ -519,48 +814,46 @@ class Plugin(indigo.PluginBase):
 		ISYuuid = pluginProps['ISYuuid']
 		ISYtype = pluginProps['ISYtype']
 		ISYmaxBrightness = pluginProps['ISYmaxBrightness']
-		ISYIP = self.lookupTable[ISYuuid]['ISYIP']
 		self.debugLog("In actionControlDimmerRelay/jms")
-		self.debugLog("address %s ISYuuid %s ISYtype %s ISYIP %s" % (address, ISYuuid, ISYtype, ISYIP))
-		authorization = self.lookupTable[ISYuuid]['authorization']
+		self.debugLog("address %s ISYuuid %s ISYtype %s" % (address, ISYuuid, ISYtype))
 
 		###### TURN ON ######
 		if action.deviceAction == indigo.kDeviceAction.TurnOn:
 			if ISYtype == 'ISYRelay':
-				self.deviceController.deviceOn(ISYIP, authorization, address)
+				self.queueCommand(ISYuuid, address, self.deviceController.deviceOn, address, coalesce='level')
 			else:
-				self.deviceController.deviceOnDimmer(ISYIP, authorization, address, ISYmaxBrightness)
+				self.queueCommand(ISYuuid, address, self.deviceController.deviceOnDimmer, address, ISYmaxBrightness, coalesce='level')
 
 		###### TURN OFF ######
 		elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-			self.deviceController.deviceOff(ISYIP, authorization, address)
+			self.queueCommand(ISYuuid, address, self.deviceController.deviceOff, address, coalesce='level')
 
 		###### TOGGLE ######
 		elif action.deviceAction == indigo.kDeviceAction.Toggle:
 			if dev.onState:
-				self.deviceController.deviceOff(ISYIP, authorization, address)
+				self.queueCommand(ISYuuid, address, self.deviceController.deviceOff, address, coalesce='level')
 			else:
-				self.deviceController.deviceOn(ISYIP, authorization, address)
+				self.queueCommand(ISYuuid, address, self.deviceController.deviceOn, address, coalesce='level')
 
 		###### SET BRIGHTNESS ######
 		elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
-			self.deviceController.deviceSetBrightness(ISYIP, authorization, address, action.actionValue, ISYmaxBrightness)
+			self.queueCommand(ISYuuid, address, self.deviceController.deviceSetBrightness, address, action.actionValue, ISYmaxBrightness, coalesce='level')
 				
 		###### BRIGHTEN BY ######
 		elif action.deviceAction == indigo.kDeviceAction.BrightenBy:
 			currentBrightness = int(dev.states['brightnessLevel'])
 			newBrightness = currentBrightness + int(action.actionValue)
-			self.deviceController.deviceSetBrightness(ISYIP, authorization, address, newBrightness, ISYmaxBrightness)
+			self.queueCommand(ISYuuid, address, self.deviceController.deviceSetBrightness, address, newBrightness, ISYmaxBrightness, coalesce='level')
 
 		###### DIM BY ######
 		elif action.deviceAction == indigo.kDeviceAction.DimBy:
 			currentBrightness = int(dev.states['brightnessLevel'])
 			newBrightness = currentBrightness - int(action.actionValue)
-			self.deviceController.deviceSetBrightness(ISYIP, authorization, address, newBrightness, ISYmaxBrightness)
+			self.queueCommand(ISYuuid, address, self.deviceController.deviceSetBrightness, address, newBrightness, ISYmaxBrightness, coalesce='level')
 			
 		###### STATUS REQUEST ######
 #		elif action.deviceAction == indigo.kDeviceAction.RequestStatus:
-			self.deviceController.queryStatus(ISYIP, authorization, address)
+			self.queueCommand(ISYuuid, address, self.deviceController.queryStatus, address)
 
 	########################################
 	# Thermostat Action callback
@@ -570,50 +863,48 @@ class Plugin(indigo.PluginBase):
 		pluginProps = dev.pluginProps
 		address = pluginProps['address']
 		ISYuuid = pluginProps['ISYuuid']
-		ISYIP = self.lookupTable[ISYuuid]['ISYIP']
-		authorization = self.lookupTable[ISYuuid]['authorization']
 
 		###### SET HVAC MODE ######
 		if action.thermostatAction == indigo.kThermostatAction.SetHvacMode:
-			self.deviceController.changeHvacMode(ISYIP, authorization, address, action.actionMode)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeHvacMode, address, action.actionMode, coalesce='hvacMode')
 
 		###### SET FAN MODE ######
 		elif action.thermostatAction == indigo.kThermostatAction.SetFanMode:
-			self.deviceController.changeFanMode(ISYIP, authorization, address, action.actionMode)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeFanMode, address, action.actionMode, coalesce='fanMode')
 
 		###### SET COOL SETPOINT ######
 		elif action.thermostatAction == indigo.kThermostatAction.SetCoolSetpoint:
 			newSetpoint = action.actionValue
-			self.deviceController.changeCoolSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeCoolSetpoint, address, newSetpoint, coalesce='coolSetpoint')
 
 		###### SET HEAT SETPOINT ######
 		elif action.thermostatAction == indigo.kThermostatAction.SetHeatSetpoint:
 			newSetpoint = action.actionValue
-			self.deviceController.changeHeatSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeHeatSetpoint, address, newSetpoint, coalesce='heatSetpoint')
 
 		###### DECREASE/INCREASE COOL SETPOINT ######
 		elif action.thermostatAction == indigo.kThermostatAction.DecreaseCoolSetpoint:
 			newSetpoint = dev.coolSetpoint - action.actionValue
-			self.deviceController.changeCoolSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeCoolSetpoint, address, newSetpoint, coalesce='coolSetpoint')
 
 		elif action.thermostatAction == indigo.kThermostatAction.IncreaseCoolSetpoint:
 			newSetpoint = dev.coolSetpoint + action.actionValue
-			self.deviceController.changeCoolSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeCoolSetpoint, address, newSetpoint, coalesce='coolSetpoint')
 
 		###### DECREASE/INCREASE HEAT SETPOINT ######
 		elif action.thermostatAction == indigo.kThermostatAction.DecreaseHeatSetpoint:
 			newSetpoint = dev.heatSetpoint - action.actionValue
-			self.deviceController.changeHeatSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeHeatSetpoint, address, newSetpoint, coalesce='heatSetpoint')
 
 		elif action.thermostatAction == indigo.kThermostatAction.IncreaseHeatSetpoint:
 			newSetpoint = dev.heatSetpoint + action.actionValue
-			self.deviceController.changeHeatSetpoint(ISYIP, authorization, address, newSetpoint)
+			self.queueCommand(ISYuuid, address, self.deviceController.changeHeatSetpoint, address, newSetpoint, coalesce='heatSetpoint')
 
 		###### REQUEST STATE UPDATES ######
   		elif action.thermostatAction in [indigo.kThermostatAction.RequestStatusAll, indigo.kThermostatAction.RequestMode,
   		indigo.kThermostatAction.RequestEquipmentState, indigo.kThermostatAction.RequestTemperatures, indigo.kThermostatAction.RequestHumidities,
   		indigo.kThermostatAction.RequestDeadbands, indigo.kThermostatAction.RequestSetpoints]:
-			self.deviceController.queryStatus(ISYIP, authorization, address)
+			self.queueCommand(ISYuuid, address, self.deviceController.queryStatus, address)
 		
 ##################################################################################
 #
@@ -637,18 +928,10 @@ class Plugin(indigo.PluginBase):
 	def triggerStartProcessing(self, trigger):
 		self.debugLog("Start processing trigger: %i" % trigger.id)
 		triggerType = trigger.pluginTypeId
-		programId = trigger.pluginProps['program']
-		if triggerType == 'programThenFinished':
-			self.thenTriggers[programId] = trigger
-		elif triggerType == 'programElseFinished':
-			self.elseTriggers[programId] = trigger
+		if triggerType in kProgramEvents.values():
+			self.triggerRegistry.add(trigger, triggerType, trigger.pluginProps['program'])
 	
 	########################################
 	def triggerStopProcessing(self, trigger):
 		self.debugLog("Stop processing trigger " + str(trigger.id))
-		triggerType = trigger.pluginTypeId
-		programId = trigger.pluginProps['program']
-		if triggerType == 'programThenFinished':
-			del self.thenTriggers[programId]
-		elif triggerType == 'programElseFinished':
-			del self.elseTriggers[programId]
+		self.triggerRegistry.remove(trigger)
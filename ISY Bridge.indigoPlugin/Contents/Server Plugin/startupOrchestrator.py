@@ -0,0 +1,128 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							startupOrchestrator.py
+#
+# Brings the ISY controller devices up in parallel.  Indigo calls deviceStartComm
+# for one device after another on its own thread, so rather than loading an ISY
+# and starting its subscription there, each ISY gets a thread of its own and
+# deviceStartComm returns straight away.
+#
+# A restart starts the subscription with the devices Indigo already has - its
+# status snapshot is checked against the topology cache, and the topology sync
+# reloads everything if nodes changed meanwhile.  Nothing like that covers the
+# scene and program lists, so once the ISY is up they're fetched in the
+# background and stored if they differ from ours.  A first load is staged: the
+# scene and program lists are fetched in the background while the nodes are
+# turned into Indigo devices, the subscription starts as soon as the devices
+# are in the index, and the two lists are stored when they arrive.  Once every
+# ISY that was started together is up, the total wall time is logged.
+################################################################################
+
+import time
+import indigo
+import simplejson
+from threading import Thread, Lock
+
+# [[id, name], ...] lists in any order
+def sameList(list1, list2):
+	return sorted(map(tuple, list1)) == sorted(map(tuple, list2))
+
+########################################################
+class BackgroundCall(object):
+	####################################################
+	# runs func(*args) on a thread; result() waits for it and returns what it
+	# returned, or raises what it raised
+
+	def __init__(self, func, *args):
+		self.value = None
+		self.error = None
+		self.thread = Thread(target=self.run, args=(func, args))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self, func, args):
+		try:
+			self.value = func(*args)
+		except Exception, e:
+			self.error = e
+
+	def result(self):
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+########################################################
+class StartupOrchestrator(object):
+	####################################################
+
+	def __init__(self, plugin):
+		self.plugin = plugin
+		self.lock = Lock()
+		self.loads = {}			# ISY device id -> thread starting it
+		self.batchStart = None
+		self.batchCount = 0
+
+	def start(self, dev):
+		thread = Thread(target=self.load, args=(dev,))
+		thread.daemon = True
+		with self.lock:
+			if not self.loads:
+				self.batchStart = time.time()
+				self.batchCount = 0
+			self.loads[dev.id] = thread
+			self.batchCount += 1
+		thread.start()
+
+	def wait(self, dev):
+		# for deviceStopComm - a start in progress may be about to add the ISY to the lookup table
+		with self.lock:
+			thread = self.loads.get(dev.id)
+		if thread is not None:
+			thread.join()
+
+	def load(self, dev):
+		startTime = time.time()
+		try:
+			if not dev.pluginProps['initialLoadDone']:
+				self.download(dev)
+				indigo.server.log('[%s] ISY loaded and started in %.2f seconds' % (dev.name, time.time() - startTime))
+			else:
+				self.plugin.startISY(dev)
+				indigo.server.log('[%s] ISY started in %.2f seconds' % (dev.name, time.time() - startTime))
+				thread = Thread(target=self.checkLists, args=(dev,))
+				thread.daemon = True
+				thread.start()
+		except Exception, e:
+			self.plugin.errorLog('[%s] unable to start ISY: %s' % (dev.name, e))
+		finally:
+			with self.lock:
+				del self.loads[dev.id]
+				finished = not self.loads
+				batchCount = self.batchCount
+			if finished and batchCount > 1:
+				indigo.server.log('%d ISYs started in %.2f seconds' % (batchCount, time.time() - self.batchStart))
+
+	def download(self, dev):
+		pluginProps = dev.pluginProps
+		scenes = BackgroundCall(self.plugin.deviceController.getScenes, dev.address, pluginProps['authorization'])
+		programs = BackgroundCall(self.plugin.deviceController.getPrograms, dev.address, pluginProps['authorization'])
+		self.plugin.updateISYDevices(dev)
+		self.plugin.startISY(dev)
+		sceneList = scenes.result()
+		programList = programs.result()
+		self.plugin.storeInitialLoad(dev, sceneList, programList)
+
+	def checkLists(self, dev):
+		pluginProps = dev.pluginProps
+		try:
+			scenes = BackgroundCall(self.plugin.deviceController.getScenes, dev.address, pluginProps['authorization'])
+			programList = self.plugin.deviceController.getPrograms(dev.address, pluginProps['authorization'])
+			sceneList = scenes.result()
+			if sameList(sceneList, simplejson.loads(pluginProps['scenes'])) and sameList(programList, simplejson.loads(pluginProps['programs'])):
+				return
+			indigo.server.log('[%s] scenes or programs changed while the plugin was stopped, updating them' % dev.name)
+			self.plugin.storeInitialLoad(dev, sceneList, programList)
+		except Exception, e:
+			self.plugin.errorLog('[%s] unable to check the ISY\'s scene and program lists: %s' % (dev.name, e))
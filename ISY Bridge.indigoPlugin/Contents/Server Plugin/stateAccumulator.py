@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							stateAccumulator.py
+#
+# Every updateStateOnServer call is a round-trip to the Indigo server, and a
+# scene activation touches dozens of devices with a state or two each.  The
+# subscription server collects the state changes produced by an event (or a
+# burst of back-to-back events) here, per device, and flushes each device's
+# changes with one updateStatesOnServer call, leaving out anything that
+# already matches the device's current state.
+################################################################################
+
+########################################################
+class StateAccumulator(object):
+	####################################################
+
+	def __init__(self, errorLog):
+		self.errorLog = errorLog
+		self.pending = {}
+		self.statesSent = 0
+		self.statesSkipped = 0
+		self.flushes = 0
+
+	def set(self, dev, key, value):
+		entry = self.pending.get(dev.id)
+		if entry is None:
+			entry = self.pending[dev.id] = (dev, {})
+		entry[1][key] = value
+
+	def __len__(self):
+		return len(self.pending)
+
+	def flush(self):
+		if len(self.pending) == 0:
+			return 0
+		pending = self.pending
+		self.pending = {}
+		self.flushes += 1
+		sent = 0
+		for dev, states in pending.values():
+			changes = [{'key':key, 'value':value} for key, value in states.items() if dev.states.get(key) != value]
+			self.statesSkipped += len(states) - len(changes)
+			if len(changes) == 0:
+				continue
+			try:
+				if hasattr(dev, 'updateStatesOnServer'):
+					dev.updateStatesOnServer(changes)
+				else:
+					# older Indigo servers only take one state at a time
+					for change in changes:
+						dev.updateStateOnServer(change['key'], change['value'])
+			except Exception, e:
+				self.errorLog('Unable to update states for %s: %s' % (dev.name, e))
+				continue
+			sent += len(changes)
+		self.statesSent += sent
+		return sent
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							subscriptionLoop.py
+#
+# One thread serving the event subscriptions of every ISY.  In threaded mode each
+# ISY gets a thread of its own blocked in SubscriptionServer.startServer (plus a
+# Timer thread per heartbeat); here a single select() loop waits on all of the
+# subscription sockets at once and on the earliest deadline in a shared
+# DeadlineScheduler - reconnect backoff, heartbeat supervision, pending gap
+# recovery - and calls into the server that's ready.  The servers hold the
+# connection state, see the event loop section of subscriptionServer.py.
+#
+# Servers are added and removed from other threads, so those requests are
+# queued and a byte written to a pipe wakes the loop up to run them.
+################################################################################
+
+import os
+import time
+import errno
+import select
+from threading import Thread, Lock, Event, current_thread
+from deadlineScheduler import DeadlineScheduler
+
+kMaxSelectWait = 30
+kLoopJoinTimeout = 5
+
+########################################################
+class SubscriptionLoop(object):
+	####################################################
+
+	def __init__(self, plugin):
+		self.debugLog = plugin.getLog('subscription').debug
+		self.errorLog = plugin.errorLog
+		self.servers = []
+		self.calls = []
+		self.lock = Lock()
+		self.wakeRead, self.wakeWrite = os.pipe()
+		self.scheduler = DeadlineScheduler(self.errorLog, wake=self.deadlineChanged)
+		self.thread = None
+		self.running = False
+
+	def start(self):
+		self.running = True
+		self.thread = Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		self.wake()
+		self.thread.join(kLoopJoinTimeout)
+		if not self.thread.is_alive():
+			os.close(self.wakeRead)
+			os.close(self.wakeWrite)
+
+	def add(self, server):
+		server.eventLoop = self
+		server.scheduler = self.scheduler
+		self.call(self.addServer, server)
+
+	def remove(self, server):
+		# returns an Event that's set once the server's connection is closed
+		done = Event()
+		self.call(self.removeServer, server, done)
+		return done
+
+	def call(self, func, *args):
+		with self.lock:
+			self.calls.append((func, args))
+		self.wake()
+
+	def wake(self):
+		try:
+			os.write(self.wakeWrite, 'x')
+		except OSError:
+			pass
+
+	def deadlineChanged(self):
+		# a new earliest deadline only needs a wake-up if select() is already waiting
+		if current_thread() is not self.thread:
+			self.wake()
+
+	def addServer(self, server):
+		self.servers.append(server)
+		server.loopStart(time.time())
+		self.debugLog('event loop now serving %d ISYs', len(self.servers))
+
+	def removeServer(self, server, done):
+		if server in self.servers:
+			self.servers.remove(server)
+			self.dispatch(server, server.loopStop)
+		done.set()
+
+	def runCalls(self):
+		with self.lock:
+			calls = self.calls
+			self.calls = []
+		for func, args in calls:
+			func(*args)
+
+	def dispatch(self, server, func, *args):
+		try:
+			func(*args)
+		except Exception, e:
+			server.loopFailed(e)
+
+	def run(self):
+		while self.running:
+			self.runCalls()
+			readers = [self.wakeRead]
+			writers = []
+			sockets = {}
+			for server in self.servers:
+				conn, wantRead, wantWrite = server.loopWants()
+				if wantRead:
+					readers.append(conn)
+				if wantWrite:
+					writers.append(conn)
+				if conn is not None:
+					sockets[conn] = server
+
+			now = time.time()
+			deadline = self.scheduler.nextDeadline()
+			wait = kMaxSelectWait if deadline is None else min(max(0, deadline - now), kMaxSelectWait)
+			try:
+				readable, writable, errors = select.select(readers, writers, [], wait)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			if self.wakeRead in readable:
+				os.read(self.wakeRead, 4096)
+			for conn in writable:
+				self.dispatch(sockets[conn], sockets[conn].loopWritable)
+			for conn in readable:
+				if conn in sockets:
+					self.dispatch(sockets[conn], sockets[conn].loopReadable)
+
+			self.scheduler.runDue(time.time())
+
+		for server in self.servers:
+			self.dispatch(server, server.loopStop)
+		self.servers = []
@@ -14,53 +14,132 @@
 #		  us to stop running.
 ################################################################################
 
+import os
+import errno
 import socket
 import base64
+import time
+from threading import Event, Lock
 from xml.dom.minidom import parseString
-from threading import Timer
+from eventDecoder import decodeEvent
+from topologySync import TopologySync, kTopologyActions
+from stateAccumulator import StateAccumulator
+from eventDispatch import EventDispatcher
+from metrics import kNoMetrics, kMetricsInterval
 
 ########################################################
 
-kHeartbeatTimeout = 250  # ISY sends heartbeat every 120 seconds, 250 seconds allows one miss
+kHeartbeatInterval = 120	# until the ISY tells us otherwise in its first heartbeat
+kHeartbeatSlack = 30	# how late a heartbeat may be before we count it missed
+kMaxMissedHeartbeats = 2	# missed in a row while other events still arrive before we give up
 kSocketTimeout = 30
+kRecvChunkSize = 8192
+kGapRecoveryInterval = 30	# at most one status re-query per 30 seconds, however often events go missing
+kStatusControls = ['ST', 'CLIMD', 'CLIHCS', 'CLISPH', 'CLISPC', 'CLIFS']
+kMaxBurstEvents = 50	# flush accumulated states at least this often during a long burst
+kReconnectDelay = 5
+kMaxReconnectDelay = 60	# event loop mode backs off reconnect attempts up to this
+
+# event loop mode connection states
+kStateWaiting = 'waiting'
+kStateConnecting = 'connecting'
+kStateSubscribing = 'subscribing'
+kStateSubscribed = 'subscribed'
+kStateStopped = 'stopped'
+
+# program status (s) in _1 trigger events -> (fork, status)
+kProgramStatus = {'22':('then', 'started'), '21':('then', 'finished'), '33':('else', 'started'), '31':('else', 'finished')}
+
+# control events that only go to the event viewer, with the name they're logged under
+kViewerControls = {'_2':'Driver specific', '_4':'system config', '_5':'system status', '_6':'internet access',
+	'_7':'system progress', '_8':'security event', '_9':'system alert', '_10':'OpenADR event', '_11':'weather event',
+	'_12':'AMI Meter', '_13':'Electricity Monitor', '_14':'UPB Event', '_15':'UPB Event', '_16':'UPB Event',
+	'_17':'Gas Meter', '_18':'Zigbee Action', '_19':'ELK event', '_20':'Device Linker', '_21':'Zwave event',
+	'_22':'Billing Event'}
 
 ########################################################
-class HttpBaseForm(object):
+class HttpStreamReader(object):
 	####################################################
+	# The ISY pushes events back-to-back over a single socket, so rather than
+	# reading a byte at a time we pull large chunks into a reusable buffer and
+	# split complete messages (headers plus Content-Length body) out of it.
+	# Anything left over after a message stays buffered for the next one.
+
+	def __init__(self, conn, chunkSize=kRecvChunkSize):
+		self.conn = conn
+		self.chunk = bytearray(chunkSize)
+		self.chunkView = memoryview(self.chunk)
+		self.buffer = bytearray()
+		self.scanFrom = 0
+		self.lastReceived = time.time()
+
+	def fill(self):
+		count = self.conn.recv_into(self.chunk)
+		if count == 0:
+			raise Exception('ISY closed subscription connection')
+		self.lastReceived = time.time()
+		self.buffer += self.chunkView[:count]
+		return count
+
+	def nextMessage(self):
+		# returns (headers, body) for the next complete message, or None if
+		# the buffer doesn't hold one yet
+		end = self.buffer.find('\r\n\r\n', self.scanFrom)
+		if end < 0:
+			# the terminator may straddle two chunks, so back up a little
+			self.scanFrom = max(0, len(self.buffer) - 3)
+			return None
+		end += 4
+		headers = str(self.buffer[:end])
+		messageEnd = end + contentLength(headers)
+		if len(self.buffer) < messageEnd:
+			self.scanFrom = end - 4
+			return None
+		body = str(self.buffer[end:messageEnd])
+		del self.buffer[:messageEnd]
+		self.scanFrom = 0
+		return headers, body
+
+	def readMessage(self):
+		while True:
+			message = self.nextMessage()
+			if message is not None:
+				return message
+			self.fill()
+
+	def hasBufferedData(self):
+		return len(self.buffer) > 0
+
+	def hasMessage(self):
+		# true if a complete message is already buffered, i.e. the next read won't block
+		end = self.buffer.find('\r\n\r\n')
+		if end < 0:
+			return False
+		end += 4
+		return len(self.buffer) >= end + contentLength(str(self.buffer[:end]))
 
-	def __init__(self, conn):
-		self.getHeaders(conn)
-		self.getBody(conn, self.getContentLength())
+########################################################
 
-	def getHeaders(self, conn):
-		self.headers = ''
-		while True:
-			d=conn.recv(1)
-			if not d:
-				raise Exception('ISY closed subscription connection')
-			self.headers = self.headers + d
-			if d == '\n':
-				l = len(self.headers)
-				if l >= 4:
-					if self.headers[l-2] == '\r' and self.headers[l-3] == '\n' and self.headers[l-4] == '\r':
-						break
+# the ISY's address may carry a port, e.g. for the simulator in benchmarks
+def splitAddress(address):
+	host, separator, port = address.partition(':')
+	return host, int(port) if port else 80
+
+def contentLength(headers):
+	for header in headers.split('\r\n'):
+		if header[:15].lower() == 'content-length:':
+			return int(header[15:])
+	return 0
+
+########################################################
+class HttpBaseForm(object):
+	####################################################
+
+	def __init__(self, reader):
+		self.headers, self.body = reader.readMessage()
 
 	def getContentLength(self):
-		value = 0
-		splitHeaders = self.headers.split('\r\n')
-		for header in splitHeaders:
-			if 'content-length' in header.lower():
-				value = int(header[len('content-length')+1:])
-				break
-		return value
-
-	def getBody(self, conn, contentLength):
-		self.body = ''
-		while len(self.body) < contentLength:
-			d = conn.recv(1)
-			if not d:
-				raise Exception('ISY closed subscription connection')
-			self.body = self.body + d
+		return contentLength(self.headers)
 
 ########################################################
 class HttpResponse(HttpBaseForm):
@@ -102,21 +181,46 @@ class SubscriptionServer(object):
 	
 	def __init__(self, plugin, dev, deviceDict):
 		self.plugin = plugin
-		self.debugLog = plugin.debugLog
+		self.log = plugin.getLog('subscription')
+		self.debugLog = self.log.debug
 		self.errorLog = plugin.errorLog
 		self.ISY = dev
 		self.devices = deviceDict
 		self.badDevices = {}
+		# held for anything that changes devices or badDevices; they're changed from this
+		# server's thread, the plugin's device callbacks and the topology resync thread
+		self.devicesLock = Lock()
+		self.topology = TopologySync(plugin, self)
+		self.dispatcher = EventDispatcher()
+		self.registerHandlers()
+		self.lastValues = {}
+		self.freshValues = []		# one set per status fetch in flight, see fetchStatus
+		self.lastRecovery = 0
+		self.recoveryPending = False
+		self.sequenceGaps = 0
+		self.missedEvents = 0
+		self.recoveries = 0
+		self.recoveryTime = 0.0
+		self.states = StateAccumulator(self.errorLog)
+		self.burstEvents = 0
+		self.lastSyncTime = 0.0
 		self.conn = ''
+		self.reader = None
 		self.sid = None
 		self.stop = False
+		self.stopped = Event()
 		self.connectionIsValid = False
-		self.heartbeatTimeout = ''
+		self.scheduler = None
+		self.eventLoop = None
+		self.loopState = kStateStopped
+		self.heartbeatInterval = kHeartbeatInterval
+		self.lastHeartbeat = 0
+		self.missedHeartbeats = 0
+		self.missedInARow = 0
+		self.metrics = kNoMetrics
 		
 	def encodeBase64(self, arg):
-		encoded = base64.b64encode(arg)
-		self.debugLog(encoded)
-		return encoded
+		return base64.b64encode(arg)
 
 	def subscribe(self):
 
@@ -155,66 +259,112 @@ class SubscriptionServer(object):
 		#self.debugLog('element [start:end] is %s' % element[start:end])
 		return element[start:end]
 		
+	###########################
+	# deadlines
+	###########################
+	# Our deadlines live in the DeadlineScheduler shared by all subscriptions, keyed by
+	# (server, name) so rescheduling a name replaces its previous deadline.  In event
+	# loop mode they run on the loop thread and a failure drops the connection.
+
+	def scheduleDeadline(self, name, when, func, *args):
+		self.scheduler.schedule((self, name), when, self.runDeadline, func, args)
+
+	def runDeadline(self, func, args):
+		if self.eventLoop is None:
+			func(*args)
+		else:
+			self.eventLoop.dispatch(self, func, *args)
+
+	def cancelDeadlines(self):
+		for name in ['connect', 'heartbeat', 'recovery', 'metrics']:
+			self.scheduler.cancel((self, name))
+
+	def nextDeadline(self):
+		deadlines = [self.scheduler.deadline((self, name)) for name in ['connect', 'heartbeat', 'recovery']]
+		deadlines = [deadline for deadline in deadlines if deadline is not None]
+		return min(deadlines) if deadlines else None
+
+	# while collecting metrics, a summary goes to the ISY device's states every kMetricsInterval
+	def publishMetrics(self):
+		metrics = self.metrics
+		self.ISY.updateStatesOnServer([
+			{'key':'eventsReceived', 'value':metrics.counter('eventsReceived')},
+			{'key':'eventParseMs', 'value':round(metrics.average('eventParse'), 3)},
+			{'key':'eventHandlerMs', 'value':round(metrics.average('eventHandler'), 3)},
+			{'key':'commandsSent', 'value':metrics.counter('commandsSent')},
+			{'key':'restLatencyMs', 'value':round(metrics.average('restLatency'), 1)},
+			{'key':'reconnects', 'value':metrics.counter('reconnects')},
+			{'key':'sequenceGaps', 'value':metrics.counter('sequenceGaps')}])
+		self.scheduleDeadline('metrics', time.time() + kMetricsInterval, self.publishMetrics)
+
+	# The ISY tells us how often it will send a heartbeat (the _0 action), so we expect
+	# each one within that interval plus some slack.  A late heartbeat is only counted
+	# as missed if other events are still coming in - if the socket has been silent for
+	# the whole interval the link is dead and we reconnect straight away, rather than
+	# sitting out a second interval.
+	def startHeartbeat(self):
+		self.lastHeartbeat = time.time()
+		self.missedInARow = 0
+		self.scheduleDeadline('heartbeat', self.lastHeartbeat + self.heartbeatInterval + kHeartbeatSlack, self.checkHeartbeat)
+
+	def checkHeartbeat(self):
+		now = time.time()
+		self.missedHeartbeats += 1
+		self.missedInARow += 1
+		idleTime = now - self.reader.lastReceived
+		if idleTime < self.heartbeatInterval + kHeartbeatSlack and self.missedInARow < kMaxMissedHeartbeats:
+			self.debugLog('missed heartbeat from ISY %s, last data %d seconds ago', self.ISY.address, idleTime)
+			self.scheduleDeadline('heartbeat', now + self.heartbeatInterval, self.checkHeartbeat)
+			return
+		self.lostHeartbeat()
+		if self.eventLoop is not None:
+			self.loopFailed(None)
+
 	def lostHeartbeat(self):
 		self.errorLog('Failed to receive heartbeat - lost connection with ISY: %s' % self.ISY.address)
 		self.connectionIsValid = False
+
+	def heartbeatStats(self):
+		now = time.time()
+		nextDeadline = self.nextDeadline()
+		return {'interval':self.heartbeatInterval, 'missed':self.missedHeartbeats,
+			'lastHeartbeat':now - self.lastHeartbeat if self.lastHeartbeat else None,
+			'idleTime':now - self.reader.lastReceived if self.reader is not None else None,
+			'nextDeadline':nextDeadline - now if nextDeadline is not None else None}
 		
+	# threaded mode - this thread owns the connection for as long as the ISY device runs
 	def startServer(self):
 		self.stop == False
 		while self.stop == False:
+			connectTime = time.time()
 			try:
 				self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 				self.conn.settimeout(kSocketTimeout)
-				self.conn.connect((self.ISY.address, 80))
+				self.conn.connect(splitAddress(self.ISY.address))
 				self.connectionIsValid = True
-				self.debugLog('connected to ISY: %s' % self.ISY.address)
+				self.debugLog('connected to ISY: %s', self.ISY.address)
 			except Exception, e:
 				self.errorLog('Failed to connect to ISY: %s Error: %s' % (self.ISY.address, e))
-				self.plugin.sleep(5)
+				self.stopped.wait(kReconnectDelay)
 				continue	# failed to connect to ISY, skip rest of loop and try again
 
+			self.reader = HttpStreamReader(self.conn)
 			self.subscribe()
-			response = HttpResponse(self.conn)
-			if response.sid == None:
-				self.errorLog('Failed to establish ISY subscription: %s%s' % (response.headers, response.body))
+			if not self.subscribed(HttpResponse(self.reader), connectTime):
 				self.conn.close()
-				self.plugin.sleep(5)
+				self.stopped.wait(kReconnectDelay)
 				continue	# ISY failed to respond appropriately to subscription, close connection and try again
-
-			self.debugLog('SID: %s' % response.sid)
-			self.sid = response.sid
-			self.seqnum = 0
-			self.ISY.updateStateOnServer('connectionStatus', 'connected')
-			self.debugLog('subscribed to ISY: %s' % self.ISY.address)
 				
- 			self.heartbeatTimeout = Timer(kHeartbeatTimeout, self.lostHeartbeat)
- 			self.heartbeatTimeout.start()
+			self.startHeartbeat()
 
 			while self.stop == False and self.connectionIsValid == True:
 				try:
-					request = HttpRequest(self.conn)
-					if '<Event' not in request.body:
-						self.errorLog('invalid request body: %s' % request.body)
-						continue
-					self.debugLog('<<--- startServer received ISY event %s' % request.body)
-					event = parseString(request.body).getElementsByTagName('Event')[0]
-					sid = event.getAttribute('sid')
-					if sid != self.sid:
-						self.errorLog('caught invalid sid: %s' % request.body)
-						continue
-					seqnum = int(event.getAttribute('seqnum'))
-					if seqnum > self.seqnum + 1:
-						if seqnum > self.seqnum + 2:
-							self.errorLog('Missing Sequence Numbers: %d-%d' % (self.seqnum+1, seqnum-1))
-						else:
-							self.errorLog('Missing Sequence Number: %d' % seqnum-1)
-					self.seqnum = seqnum
-					control = self.extractFromXML(event, 'control')
-					action = self.extractFromXML(event, 'action')
-					node = self.extractFromXML(event, 'node')
-					eventInfo = self.extractFromXML(event, 'eventInfo')
-					self.debugLog('seqnum: %d control: %s action: %s node: %s eventInfo: %s' % (seqnum, control, action, node, eventInfo))
-					self.handleEvent(control, action, node, eventInfo)
+					if self.recoveryPending and time.time() - self.lastRecovery >= kGapRecoveryInterval:
+						self.recoverState()
+					self.receiveEvent(HttpRequest(self.reader))
+					# keep accumulating state changes while more events are already waiting
+					if not self.reader.hasMessage() or self.burstEvents >= kMaxBurstEvents:
+						self.flushStates()
 				except socket.timeout:
 					self.debugLog('socket timeout')
 				except Exception, e:
@@ -223,14 +373,304 @@ class SubscriptionServer(object):
 					if not self.stop:
 						self.errorLog('%s: %s' % (e, self.ISY.address))
 						self.connectionIsValid = False
- 			self.heartbeatTimeout.cancel()
+			self.cancelDeadlines()
+			self.disconnected()
+
+	# checks the ISY's answer to our subscribe request and, if it took, brings Indigo up to date
+	def subscribed(self, response, connectTime):
+		if response.sid == None:
+			self.errorLog('Failed to establish ISY subscription: %s%s' % (response.headers, response.body))
+			return False
+		self.debugLog('SID: %s', response.sid)
+		if self.sid is not None:
+			self.metrics.count('reconnects')
+		self.sid = response.sid
+		self.seqnum = 0
+		self.ISY.updateStateOnServer('connectionStatus', 'connected')
+		self.debugLog('subscribed to ISY: %s', self.ISY.address)
+		self.freshValues = []
+		self.loadSnapshot(connectTime)
+		if self.metrics.enabled:
+			self.publishMetrics()
+		return True
+
+	def receiveEvent(self, request):
+		if '<Event' not in request.body:
+			self.errorLog('invalid request body: %s' % request.body)
+			return
+		self.log.verbose('<<--- received ISY event %s', request.body)
+		metrics = self.metrics
+		if metrics.enabled:
+			startTime = time.time()
+		event = decodeEvent(request.body)
+		if metrics.enabled:
+			parsedTime = time.time()
+			metrics.observe('eventParse', parsedTime - startTime)
+			metrics.count('eventsReceived')
+		if event.sid != self.sid:
+			self.errorLog('caught invalid sid: %s' % request.body)
+			return
+		seqnum = event.seqnum
+		if seqnum > self.seqnum + 1:
+			if seqnum > self.seqnum + 2:
+				self.errorLog('Missing Sequence Numbers: %d-%d' % (self.seqnum+1, seqnum-1))
+			else:
+				self.errorLog('Missing Sequence Number: %d' % (seqnum-1))
+			# any node changes in the gap are lost, so the topology caches can't be trusted
+			self.topology.invalidate('sequence gap')
+			self.sequenceGap(seqnum - self.seqnum - 1)
+		self.seqnum = seqnum
+		self.debugLog('seqnum: %d control: %s action: %s node: %s eventInfo: %s', seqnum, event.control, event.action, event.node, event.eventInfo)
+		self.handleEvent(event.control, event.action, event.node, event.eventInfo)
+		if metrics.enabled:
+			metrics.observe('eventHandler', time.time() - parsedTime)
+		self.burstEvents += 1
+
+	def disconnected(self):
+		self.flushStates()
+		self.conn.close()
+		self.debugLog('closed connection to ISY')
+		self.ISY.updateStateOnServer('connectionStatus', 'disconnected')
+
+	###########################
+	# event loop mode
+	###########################
+	# Here a SubscriptionLoop drives the connection instead of a thread of our own.  It
+	# asks what we're waiting for - the socket to connect or become readable - and calls
+	# back when that happens or one of our deadlines (reconnect, connect timeout,
+	# heartbeat, pending recovery) comes due, so none of this may block - the REST calls
+	# behind the status snapshot and gap recovery go to the ISY's command queue, see
+	# fetchStatus.  Anything these raise ends up in loopFailed, which drops the connection
+	# and schedules a reconnect.
+
+	def loopStart(self, now):
+		self.loopState = kStateWaiting
+		self.retryDelay = kReconnectDelay
+		self.scheduleDeadline('connect', now, self.loopConnect)
+
+	def loopWants(self):
+		# (socket, waiting to read, waiting to write)
+		if self.loopState == kStateConnecting:
+			return self.conn, False, True
+		if self.loopState in [kStateSubscribing, kStateSubscribed]:
+			return self.conn, True, False
+		return None, False, False
+
+	def loopConnectTimeout(self):
+		raise Exception('Timed out connecting to ISY')
+
+	def loopConnect(self):
+		self.connectTime = time.time()
+		self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.conn.setblocking(0)
+		self.loopState = kStateConnecting
+		self.scheduleDeadline('connect', self.connectTime + kSocketTimeout, self.loopConnectTimeout)
+		error = self.conn.connect_ex(splitAddress(self.ISY.address))
+		if error not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+			raise socket.error(error, 'Failed to connect to ISY: %s' % os.strerror(error))
+
+	def loopWritable(self):
+		error = self.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+		if error != 0:
+			raise socket.error(error, 'Failed to connect to ISY: %s' % os.strerror(error))
+		# reads only happen once select says there's data, so the socket can go back to blocking
+		self.conn.settimeout(kSocketTimeout)
+		self.connectionIsValid = True
+		self.debugLog('connected to ISY: %s', self.ISY.address)
+		self.reader = HttpStreamReader(self.conn)
+		self.subscribe()
+		self.loopState = kStateSubscribing
+		self.scheduleDeadline('connect', time.time() + kSocketTimeout, self.loopConnectTimeout)
+
+	def loopReadable(self):
+		self.reader.fill()
+		if self.loopState == kStateSubscribing:
+			if not self.reader.hasMessage():
+				return
+			if not self.subscribed(HttpResponse(self.reader), self.connectTime):
+				raise Exception('ISY refused subscription')
+			self.loopState = kStateSubscribed
+			self.scheduler.cancel((self, 'connect'))
+			self.startHeartbeat()
+			self.retryDelay = kReconnectDelay
+		while self.reader.hasMessage():
+			self.receiveEvent(HttpRequest(self.reader))
+			if self.burstEvents >= kMaxBurstEvents:
+				self.flushStates()
+		self.flushStates()
+
+	def loopFailed(self, error):
+		# we don't want to report an error if we've been told to stop since
+		# that's likely the cause of the error anyway
+		if error is not None and not self.stop:
+			self.errorLog('%s: %s' % (error, self.ISY.address))
+		self.connectionIsValid = False
+		self.loopClose()
+		if self.stop:
+			self.loopState = kStateStopped
+			return
+		self.loopState = kStateWaiting
+		self.scheduleDeadline('connect', time.time() + self.retryDelay, self.loopConnect)
+		self.debugLog('reconnecting to ISY %s in %d seconds', self.ISY.address, self.retryDelay)
+		self.retryDelay = min(self.retryDelay * 2, kMaxReconnectDelay)
+
+	def loopStop(self):
+		self.loopClose()
+		self.loopState = kStateStopped
+
+	def loopClose(self):
+		self.cancelDeadlines()
+		if self.loopState == kStateSubscribed:
+			self.disconnected()
+		elif self.loopState in [kStateConnecting, kStateSubscribing]:
 			self.conn.close()
-			self.debugLog('closed connection to ISY')
-			self.ISY.updateStateOnServer('connectionStatus', 'disconnected')
+		self.loopState = kStateWaiting
 		
+	# Lost events mean some Indigo states may be stale.  Rather than querying every node,
+	# we fetch /rest/status once and replay only the values that differ from what we last
+	# saw for each node.  Recovery is rate limited so a flapping link can't flood the ISY;
+	# a gap inside the interval just marks a recovery as pending and it runs once the
+	# interval has passed.
+	def sequenceGap(self, missing):
+		self.sequenceGaps += 1
+		self.missedEvents += missing
+		self.metrics.count('sequenceGaps')
+		self.metrics.count('missedEvents', missing)
+		if time.time() - self.lastRecovery >= kGapRecoveryInterval:
+			self.recoverState()
+		elif not self.recoveryPending:
+			self.recoveryPending = True
+			if self.eventLoop is not None:
+				# the threaded loop checks for a pending recovery itself
+				self.scheduleDeadline('recovery', self.lastRecovery + kGapRecoveryInterval, self.recoverState)
+
+	def recoverState(self):
+		startTime = time.time()
+		self.lastRecovery = startTime
+		self.recoveryPending = False
+		self.scheduler.cancel((self, 'recovery'))
+		self.fetchStatus(self.recovered, startTime)
+
+	def recovered(self, status, error, startTime):
+		if error is not None:
+			self.errorLog('Unable to re-query ISY status after missed events: %s' % error)
+			return
+		changed = self.applyStatus(status)
+		elapsed = time.time() - startTime
+		self.recoveries += 1
+		self.recoveryTime += elapsed
+		self.debugLog('recovered %d changed values after missed events in %.2f seconds', changed, elapsed)
+
+	# Indigo states are whatever they were when we lost the connection, so as soon as we're
+	# subscribed we pull the whole of /rest/status once and bring every device up to date,
+	# rather than waiting for events to trickle in or querying each node.  lastSyncSeconds on
+	# the ISY device is how long it took from starting to connect to being consistent again.
+	def loadSnapshot(self, connectTime):
+		self.lastValues = {}
+		self.fetchStatus(self.snapshotLoaded, connectTime)
+
+	def snapshotLoaded(self, status, error, connectTime):
+		if error is not None:
+			self.errorLog('Unable to load ISY status snapshot: %s' % error)
+			return
+		self.topology.checkNodes(status.keys())
+		changed = self.applyStatus(status)
+		self.lastSyncTime = time.time() - connectTime
+		self.ISY.updateStateOnServer('lastSyncSeconds', round(self.lastSyncTime, 2))
+		self.debugLog('status snapshot updated %d values, consistent %.2f seconds after connecting', changed, self.lastSyncTime)
+
+	# Fetches /rest/status and calls done(status, error, *args) with it.  Our own thread
+	# can wait for it, but the event loop hands the fetch to the ISY's command queue and
+	# is called back with the result.  Events keep coming in meanwhile and anything they
+	# report is newer than the status, so those values are dropped from it.  A result that
+	# arrives after the connection it was fetched for has gone is thrown away.
+	def fetchStatus(self, done, *args):
+		if self.eventLoop is None:
+			try:
+				status = self.plugin.getStatus(self.ISY)
+			except Exception, e:
+				done(None, e, *args)
+				return
+			done(status, None, *args)
+			return
+		sid = self.sid
+		fresh = set()
+		self.freshValues.append(fresh)
+		def fetched(status, error):
+			self.eventLoop.call(self.eventLoop.dispatch, self, self.statusFetched, sid, fresh, status, error, done, args)
+		self.plugin.queueStatus(self.ISY, fetched)
+
+	def statusFetched(self, sid, fresh, status, error, done, args):
+		self.freshValues = [values for values in self.freshValues if values is not fresh]
+		if sid != self.sid or self.loopState != kStateSubscribed:
+			return
+		if status is not None:
+			for node, control in fresh:
+				if node in status:
+					status[node] = [(name, value) for name, value in status[node] if name != control]
+		done(status, error, *args)
+
+	# replays status properties that differ from what we last saw through the device
+	# handlers; the resulting state changes go out as one batch per device
+	def applyStatus(self, status):
+		changed = 0
+		for node, properties in status.iteritems():
+			device = self.devices.get(node)
+			if device is None:
+				continue
+			for control, value in properties:
+				if control in kStatusControls and self.lastValues.get((node, control)) != value:
+					self.lastValues[(node, control)] = value
+					try:
+						self.handleDeviceEvent(device, control, value)
+					except Exception, e:
+						self.errorLog('Unable to apply ISY status %s %s for %s: %s' % (control, value, node, e))
+					changed += 1
+		self.flushStates()
+		return changed
+
+	# device handlers set states through here; nothing reaches the server until flushStates
+	def setState(self, dev, key, value):
+		self.states.set(dev, key, value)
+
+	def flushStates(self):
+		self.burstEvents = 0
+		return self.states.flush()
+
+	# the plugin keeps our devices current as Indigo reports changes to them; a
+	# device we've marked bad stays on the bad list until the ISY hears from it
+	def updateDevice(self, address, dev):
+		with self.devicesLock:
+			if address in self.badDevices:
+				self.badDevices[address] = dev
+			else:
+				self.devices[address] = dev
+
 	def deleteDevice(self, address):
-		if address in self.devices:
-			del self.devices[address]
+		with self.devicesLock:
+			self.devices.pop(address, None)
+			self.badDevices.pop(address, None)
+
+	# all the devices from a full resync; a device on the bad list stays there, with the
+	# new copy, until the ISY hears from it again
+	def replaceDevices(self, deviceDict):
+		deviceDict = dict(deviceDict)
+		with self.devicesLock:
+			for address in self.badDevices.keys():
+				if address in deviceDict:
+					self.badDevices[address] = deviceDict.pop(address)
+				else:
+					del self.badDevices[address]
+			self.devices.clear()
+			self.devices.update(deviceDict)
+
+	# takes a device off the bad list, returning it if it was there
+	def restoreDevice(self, node):
+		with self.devicesLock:
+			device = self.badDevices.pop(node, None)
+			if device is not None:
+				self.devices[node] = device
+		return device
 
 	def unSubscribe(self, conn):
 
@@ -249,12 +689,19 @@ class SubscriptionServer(object):
 
 	def stopServer(self):
 		self.stop = True
+		self.stopped.set()
 		conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		conn.connect((self.ISY.address, 80))
+		conn.connect(splitAddress(self.ISY.address))
 		self.unSubscribe(conn)
-		response = HttpResponse(conn)
-		self.debugLog('Unsubscribe Response: %d' % response.status)
+		response = HttpResponse(HttpStreamReader(conn))
+		self.debugLog('Unsubscribe Response: %d', response.status)
 		conn.close()
+		# a threaded server may be blocked reading the event socket; wake it now rather
+		# than when the ISY gets round to closing its end
+		try:
+			self.conn.shutdown(socket.SHUT_RDWR)
+		except (socket.error, AttributeError):
+			pass
 
 # handleEvent:
 # This is the main worker routine that is called when an ISY event appears.
@@ -264,73 +711,63 @@ class SubscriptionServer(object):
 #/jms/171220
 	
 	def handleEvent(self, control, action, node, eventInfo):
-		self.debugLog('<<----called: handleEvent')
-# The ERR seems to come from devices that are red in the ISY GUI
-# but work perfectly well anyway.  So I'm going to ignore ERR
-# and only accept _3 NE events.  May God have mercy on my soul./jms
-#		if control == 'ERR' or (control == '_3' and action == 'NE'):  # PREVIOUS CODE
-		if control == 'ERR': 
-			self.debugLog('IGNORED communications error %s %s %s %s' % (node, control, action, eventInfo))
-
-                elif (control == '_3' and action == 'NE'):
-			self.debugLog('Communication Error: %s %s %s %s' % (node, control, action, eventInfo))
-			# move the device to the bad list
- 			if node in self.devices:
-  				needsDeletion = self.plugin.communicationError(self.ISY, self.devices[node])
- 				if needsDeletion != True:
-					self.badDevices[node] = self.devices[node]
- 				del self.devices[node]
-	
+		self.log.verbose('<<----called: handleEvent')
+		handler = self.dispatcher.controlHandler(control, action)
+		if handler is not None:
+			handler(control, action, node, eventInfo)
 		elif control[0] == '_':
-			self.handleControlEvent(control, action, node, eventInfo)
-
-		elif control in ['RR', 'OL']:    # ramp rate and on level not currently handled
-			pass
-		
+			self.errorLog('UNKNOWN ISY control event control: %s action: %s eventInfo: %s' % (control, action, eventInfo))
 		else:
-			try:
-				#self.debugLog('in handleEvent checkpoint 1')
-				#self.debugLog('   node is %s' % (node))
-				#self.debugLog('   dumping devices array')
-				#self.debugLog(str(self.devices))
-				#self.debugLog('   end of devices dump')
+			self.handleNodeEvent(control, action, node, eventInfo)
+
+	def handleNodeEvent(self, control, action, node, eventInfo):
+		try:
+			#self.debugLog('in handleEvent checkpoint 1')
+			#self.debugLog('   node is %s' % (node))
+			#self.debugLog('   dumping devices array')
+			#self.debugLog(str(self.devices))
+			#self.debugLog('   end of devices dump')
 # A problem here is that devices may show up which are not
 # in our devices array, either because we don't support them
 # or perhaps because they were added later.  Thus, if the device
 # is not in the devices dictionary, then simply ignore the event (debug log)/jms
-                                if node in self.devices: 
-					device = self.devices[node]
-				else:
-					self.debugLog('IGNORED event for device %s' % node)
-					return
-				if device.deviceTypeId in ['ISYRelay', 'ISYIrrigation', 'ISYIODevice']:
-					self.handleRelayEvent(device, control, action)
-					
-				elif device.deviceTypeId == 'ISYDimmer':
-					self.handleDimmerEvent(device, control, action)
-					
-				elif device.deviceTypeId == 'ISYThermostat':
-					self.handleThermostatEvent(device, control, action)
-					
-				else:
-					self.errorLog('unhandled feedback control: %s action: %s node: %s eventInfo: %s' % (control, action, node, eventInfo))
-			except:
-				nodeParts = node.split(' ')
-				if nodeParts[3] != '1':    # not currently handling secondary nodes (i.e., non-load buttons on keypadlinc)
-					pass
-				elif node in self.badDevices:
-					if control == 'ST':   # if we are receiving state info on a bad device, it's no longer bad
-						self.debugLog('device resumed communication: %s' % node)
-						self.devices[node] = self.badDevices[node]
-						del self.badDevices[node]
-						self.plugin.communicationResumed(self.ISY, self.devices[node])
+			if node in self.devices: 
+				device = self.devices[node]
+			else:
+				self.debugLog('IGNORED event for device %s', node)
+				return
+			self.lastValues[(node, control)] = action
+			for fresh in self.freshValues:
+				fresh.add((node, control))
+			self.handleDeviceEvent(device, control, action, eventInfo)
+		except:
+			nodeParts = node.split(' ')
+			if nodeParts[3] != '1':    # not currently handling secondary nodes (i.e., non-load buttons on keypadlinc)
+				pass
+			elif node in self.badDevices:
+				if control == 'ST':   # if we are receiving state info on a bad device, it's no longer bad
+					self.debugLog('device resumed communication: %s', node)
+					device = self.restoreDevice(node)
+					if device is not None:
+						self.plugin.communicationResumed(self.ISY, device)
 						self.plugin.queryDevice(self.ISY, node)
-				else:
-					self.debugLog('No plugin device defined for node: %s control: %s action: %s eventInfo: %s' % (node, control, action, eventInfo))
-					self.plugin.undefinedDeviceDetected(node)
+			else:
+				self.debugLog('No plugin device defined for node: %s control: %s action: %s eventInfo: %s', node, control, action, eventInfo)
+				self.plugin.undefinedDeviceDetected(node)
 
-# handleControlEvent:
-# This is called by handleEvent for all control events, which are defined as "events with a control beginning with _"
+	def handleDeviceEvent(self, device, control, action, eventInfo=''):
+		handler = self.dispatcher.deviceHandler(device.deviceTypeId)
+		if handler is not None:
+			handler(device, control, action)
+		else:
+			self.errorLog('unhandled feedback control: %s action: %s node: %s eventInfo: %s' % (control, action, device.address, eventInfo))
+
+# registerHandlers:
+# Builds the dispatch tables handleEvent and handleDeviceEvent route through.  Control
+# events (controls beginning with _) are registered by (control, action), with action
+# None catching everything else for that control; a control event with no handler at
+# all is reported as unknown.  Anything else (ST, DON, CLISPH...) is a node property
+# and goes to the handler registered for the node's device type.
 # The code expects that the XML that comes over will ALWAYS have control, action, node, and eventInfo, although
 # it is not clear from the documentation if that is necessarily true.  
 #
@@ -350,80 +787,32 @@ class SubscriptionServer(object):
 # This is what the documentation says. 
 # /jms/171220
 
-	def handleControlEvent(self, control, action, node, eventInfo):
-		self.debugLog('<<----called: handleControlEvent')
+	def registerHandlers(self):
+		register = self.dispatcher.registerControlHandler
+
+# The ERR seems to come from devices that are red in the ISY GUI
+# but work perfectly well anyway.  So I'm going to ignore ERR
+# and only accept _3 NE events.  May God have mercy on my soul./jms
+		register('ERR', None, self.handleDeviceError)
+		register('RR', None, self.ignoreEvent)    # ramp rate and on level not currently handled
+		register('OL', None, self.ignoreEvent)
 
 # Heart Beat: _0
 # (in this case, action is the number of seconds)
-		if control == '_0':
-			# ISY heartbeat
-			self.conn.send('beat')
- 			self.heartbeatTimeout.cancel()
- 			self.heartbeatTimeout = Timer(kHeartbeatTimeout, self.lostHeartbeat)
- 			self.heartbeatTimeout.start()
-			self.debugLog('Rubatosis ... thump.thump ... thump.thump')
+		register('_0', None, self.handleHeartbeat)
 
 # Trigger Events: 0 = event status; 1 = client should get status; 2 = key changed; 3 = info string; 4 = IR learn mode;
 #		  5 = schedule status changed; 6 = variable status changed; 7 = variable intialized;
 #		  8 = current program key
-		elif control == '_1':
-			if action == '0':
-				programXML = parseString('<prg>%s</prg>' % eventInfo)
-				# we only get back the program number, and it's not zero padded to 4 places, so we
-				# need to pad it out (4 becomes 0004) and prepend the ISY device id
-				id = "[%i]%04i" % (self.ISY.id, int(self.extractFromXML(programXML, 'id')))
-				s = self.extractFromXML(programXML, 's')
-				if s == '22':
-					fork = 'then'
-					status = 'started'
-				elif s == '21':
-					fork = 'then'
-					status = 'finished'
-				elif s == '33':
-					fork = 'else'
-					status = 'started'
-				elif s == '31':
-					fork = 'else'
-					status = 'finished'
-				else:
-					fork = 'unknown'
-					status = 'unknown'
-				self.plugin.programFeedback(id, fork, status)
-				
-#			elif action == '1':  # get status, subscribers must refresh - usage unclear - tbd
-
-#			elif action == '2':  # key changed - usage unclear - tbd
-			
-			elif action == '3':  # information event
-				# event viewer
-				self.plugin.pluginEventViewer(self.ISY, eventInfo)
-
-			elif action == '4':
-				# ir learn mode - ignored for now
-				pass
-				
-#			elif action == '5':  # schedule changed status - usage unclear - tbd
-
-			elif action == '6':
-				# variable status changed - ignored for now
-				pass
-				
-			elif action == '7':
-				# variable initialized - ignored for now
-				pass
-
-			elif action == '8': 
-				# key - ignored for now/jms
-				self.debugLog('Ignoring ISY control event _1/_8 (key): eventInfo: %s' % (eventInfo))
-				
-			else:
-				self.errorLog('UNKNOWN ISY control _1 event for node: %s action: %s eventInfo: %s' % (node, action, eventInfo))
-
-# _2 = Driver specific events
-# Not really described in the manual other than "driver specific events."  Print/ignore
-# /jms/171220
-		elif control == '_2':
-			self.plugin.pluginEventViewer(self.ISY, 'IGNORED Driver specific _2 %s %s %s' % (node, action, eventInfo))
+# 1 (get status, subscribers must refresh), 2 (key changed) and 5 (schedule changed
+# status) - usage unclear - tbd
+		register('_1', '0', self.handleProgramStatus)
+		register('_1', '3', self.handleInformationEvent)     # event viewer
+		register('_1', '4', self.ignoreEvent)                # ir learn mode - ignored for now
+		register('_1', '6', self.ignoreEvent)                # variable status changed - ignored for now
+		register('_1', '7', self.ignoreEvent)                # variable initialized - ignored for now
+		register('_1', '8', self.handleKeyEvent)             # key - ignored for now/jms
+		register('_1', None, self.handleUnknownTriggerEvent)
 
 # _3 = Node Changed/Updated
 # NN = node renamed; NR = node removed; ND = node added; MV = node moved into a scene; CL = link changed;
@@ -433,74 +822,15 @@ class SubscriptionServer(object):
 # SN = Discovering Nodes/Linking; SC = Discovery Complete; WR = network renamed; WH = Pending Device Operation;
 # WD = programming device; RV = Node Revised (UPB)
 # /jms
-
-			
- 		elif control == '_3':
-
-			if action == 'CE':
-				if node in self.badDevices:
-					self.devices[node] = self.badDevices[node]
-					del self.badDevices[node]
-					self.plugin.communicationResumed(self.devices[node])
-					self.plugin.queryDevice(self.ISY, node)
-
-#			NE is dealt with above
-# 			elif action == 'NE':
-# 				Plugin.errorLog('Comm Error: %s %s %s' % (control, action, eventInfo))
-
-			elif action == 'NR':
-				if node in self.devices:
-					self.plugin.deviceNeedsDeletion(self.devices[node])
-					del self.devices[node]
-				
-			elif action == 'ND':
-				device = self.plugin.deviceNeedsAdding(self.ISY, eventInfo)
-				if device != None:
-					self.devices[device.address] = device
-					self.plugin.queryDevice(ISY, node)
-				
-			elif action == 'NN':
-				if node in self.devices:
-					index = eventInfo.index('<newName>')
-					index2 = eventInfo.index('</newName>')
-					newName = eventInfo[index+9:index2]
-					device = self.devices[node]
-					device.name = newName
-					device.replaceOnServer()
-
-			elif action in ['GN', 'GR' 'GD']:		# add, delete scenes - should deal w/ this
-				pass
-
-			elif action in ['MV', 'CL', 'RG']:
-				# group restructuring - ignored for now
-				pass
-				
-			elif action == 'EN':
-				# enabled - ignored for now
-				pass
-				
-			elif action in ['PC', 'PI', 'DI', 'DP', 'RV']:
-				# misc node changes - ignored for now
-				pass
-
-			elif action in ['FN', 'FR', 'FD']:
-				# folder changes = ignored for now
-				pass
-				
-			elif action in ['SN', 'SC','WR', 'WH', 'WD']:
-				# ISY action states - ignored for now
-				pass
-				
-			else:			# actions other than the above fall through here to see which are relevant
-				self.errorLog('unhandled ISY control event: %s node: %s action: %s eventInfo: %s' % (control, node, action, eventInfo))
-
-# _4 = System Config Updated Event
-# 1 = time cofig updated; 2 = NTP settings updated; 3 = notification settings updated;
-# 4 = NTP server communications error; 5 = Batch mode changed 1/on 0/off;
-# 6 = battery device write mode changed: 1/auto 0/manual
-# jms/171220
-                elif control == '_4':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED system config _4 %s %s %s' % (node, action, eventInfo))
+		register('_3', 'NE', self.handleCommunicationError)
+		register('_3', 'CE', self.handleCommunicationResumed)
+		for action in kTopologyActions:
+			# node, scene and scene membership changes
+			register('_3', action, self.handleTopologyEvent)
+		# enabled, misc node changes, folder changes and ISY action states - ignored for now
+		for action in ['EN', 'PC', 'PI', 'DI', 'DP', 'RV', 'FN', 'FR', 'FD', 'SN', 'SC', 'WR', 'WH', 'WD']:
+			register('_3', action, self.ignoreEvent)
+		register('_3', None, self.handleUnknownNodeEvent)
 
 # _5 = System Status Event
 # 0 = not busy; 1 = busy; 2 = completely idle; 4 = safe mode
@@ -512,26 +842,25 @@ class SubscriptionServer(object):
 # and they will just be confusing to anyone trying to read the logs.
 # I will print out the other _5 events, although I haven't seen them yet.
 #/jms/171220
-                elif control == '_5':
-			if action == '0':
-				self.debugLog('Ignoring ISY not busy event _5/_0')
-			elif action == '1':
-				self.debugLog('Ignoring ISY     busy event _5/_1')
-			else:
-                        	self.plugin.pluginEventViewer(self.ISY, 'IGNORED system status _5 %s %s %s' % (node, action, eventInfo))
+		register('_5', '0', self.handleBusyEvent)
+		register('_5', '1', self.handleBusyEvent)
 
+# None of the following are of any use to Indigo, they just go to the event viewer
+# (along with the rest of the _5 events).
+# _2 = Driver specific events
+# Not really described in the manual other than "driver specific events."  Print/ignore
+# /jms/171220
+# _4 = System Config Updated Event
+# 1 = time cofig updated; 2 = NTP settings updated; 3 = notification settings updated;
+# 4 = NTP server communications error; 5 = Batch mode changed 1/on 0/off;
+# 6 = battery device write mode changed: 1/auto 0/manual
+# jms/171220
 # _6 = Internet Access Event
 # 0 = disabled; 1 = enabled; 2 = failed
 #/jms/171220
-                elif control == '_6':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED internet access _6 %s %s %s' % (node, action, eventInfo))
-
 # _7 = System Progress Event
 # 1 = progress updated event; 2.x = device adder info/warn/error event
 #/jms/171220
-                elif control == '_7':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED system progress _7 %s %s %s' % (node, action, eventInfo))
-
 # _8 = Security System Event
 # 0 = disconnected; 1 = connected
 # DA = disarmed; AW = armed away; AS = armed stay; ASI = armed stay instant; AN = armed night
@@ -540,20 +869,12 @@ class SubscriptionServer(object):
 # but if you wanted to start the integration from UDI->Indigo, then this is where you'd probably
 # do a lot of the work.
 #/jms/171220
-                elif control == '_8':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED security event _8 %s %s %s' % (node, action, eventInfo))
-                        # security system event - ignored for now
-                        pass
-
 # _9 = System Alert Event
 # 1 = electricity peak demand; 2 = electricity max utilization; 3 = gas max utilization; 4 = water max utilization
 # "A programmable alert sent to clients to do as they wish: beep, change colors, do something else"
 # These all seem to have something to do with energy/utility usage
 # So I'm ignoring them.
 #/jms/171220
-                elif control == '_9':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED system alert _9 %s %s %s' % (node, action, eventInfo))
-
 # _10 = OpenADR event
 # Open Auto Demand/Reponse actions
 # Eventinfo structure holds: bPrice = base price; cPrice = current price
@@ -561,9 +882,6 @@ class SubscriptionServer(object):
 # 5 = Error connecting to Flex Your Power; 6 = Flex Your Power (FYP) status
 # 8 = OpenADR 2.0 registration; 9 = OpenADR Report; 10 = OpenADR Opt (look in oadrobjs.xsd for more info)
 #/jms/172220
-                elif control == '_10':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED OpenADR event _10 %s %s %s' % (node, action, eventInfo))
-
 # _11 = Climate Events
 # There are a ton of these; all require some sort of plugin (weatherbug module on ISY)
 # 1 = Temp; 2 = Temp High; 3 = Temp Low; 4 = Feels Like; 5 = Temp Average
@@ -581,71 +899,110 @@ class SubscriptionServer(object):
 # 46 = 24 hr Rain Forecast; 27 = 24 hr Snow Forecast; 48 = 24 hr Coverage forecast; 49 = 24 hr Intensity Forecast
 # 50 = 24 hr Condition FOrecast; 51 = 24 hr Cloud Forecast; 100 = Last successfully polled and processed timestamp
 #/jms/171220
-                elif control == '_11':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED weather event _11 %s %s %s' % (node, action, eventInfo))
-
 # _12 = AMI Meter Events
-                elif control == '_12':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED AMI Meter _12 %s %s %s' % (node, action, eventInfo))
-
 # _13 = Electricity Monitor Events
 #  Eventinfo contains # of channels, report actions, and raw message from Brultech
-                elif control == '_13':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Electricity Monitor _13 %s %s %s' % (node, action, eventInfo))
-
 # _14 = UPB Linker Events
 # 1 = status; 2 = pending stop find; 3 = pending cancel device add
 # _15 = UPB Adder Events
 # 1 = device status
 # _16 = UPB Status Event
-                elif control in ['_14', '_15', '_16']:
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED UPB Event %s %s %s %s' % (control, node, action, eventInfo))
-
 # _17 = Gas Meter Event
-                elif control == '_17':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Gas Meter _17 %s %s %s' % (node, action, eventInfo))
-
 # _18 = Zigbee Event
-                elif control == '_18':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Zigbee Action _18 %s %s %s' % (node, action, eventInfo))
-
 # _19 = ELK Events (actions and event info defined in elkobjs.xld)
 # These are ignored; if you want to do Elk, talk directly to the Indigo with the Elk
 #/jms/171220
-                elif control == '_19':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED ELK event _19 %s %s %s' % (node, action, eventInfo))
-
 # _20 = Device Linker events (defined in DeviceLinkerEventInfo)
 # Device Linker Events (1 = status; 2 = cleared)/jms
-                elif control == '_20':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Device Linker _20 %s %s %s' % (node, action, eventInfo))
-                        # Not relevant to Indigo, so ignored
-
 # _21 = Z-Wave Events (actions and events defined in zwobjs.xsd)
 # Z-Wave Events.  These are Z wave events about the management of the network, so they are not
 # anything that we can propagate to/from the Indigo interface.  See Z-Wave API for 1.3 (System Status),
 # 2.1/2.2/2.3/2.4/2.5 (Discovery Inactive/Include/Exclude/Replicate/Learn),
 # 3.x.y General status and 4.x.y General Error.  Just ignore and log them.
 #/jms/171220
-                elif control == '_21':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Zwave event _21 %s %s' % (action, eventInfo))
-
 # _22 = Billing Events (supported on ZS series.  Look in billobjs.xsd for information)
 # According to the docs, we should be getting these on a "normal" ISY but we are
 # and we're just going to log and ignore them all. /jms
-                elif control == '_22':
-                        self.plugin.pluginEventViewer(self.ISY, 'IGNORED Billing Event _22 %s %s %s' % (node, action, eventInfo))
-
 # _23 = Portal Events (actions and event info defined in portal.xsd)
-                elif control == '_23':
-                        # don't propagate these to Indigo or log them
-                        pass
-
+# don't propagate these to Indigo or log them
+		for control in kViewerControls:
+			register(control, None, self.handleViewerEvent)
+		register('_23', None, self.ignoreEvent)
+
+		self.dispatcher.registerDeviceHandler(['ISYRelay', 'ISYIrrigation', 'ISYIODevice'], self.handleRelayEvent)
+		self.dispatcher.registerDeviceHandler(['ISYDimmer'], self.handleDimmerEvent)
+		self.dispatcher.registerDeviceHandler(['ISYThermostat'], self.handleThermostatEvent)
+
+	def ignoreEvent(self, control, action, node, eventInfo):
+		pass
+
+	def handleDeviceError(self, control, action, node, eventInfo):
+		self.debugLog('IGNORED communications error %s %s %s %s', node, control, action, eventInfo)
+
+	def handleCommunicationError(self, control, action, node, eventInfo):
+		self.debugLog('Communication Error: %s %s %s %s', node, control, action, eventInfo)
+		# move the device to the bad list
+		device = self.devices.get(node)
+		if device is not None:
+			needsDeletion = self.plugin.communicationError(self.ISY, device)
+			with self.devicesLock:
+				device = self.devices.pop(node, None)
+				if device is not None and needsDeletion != True:
+					self.badDevices[node] = device
+
+	def handleCommunicationResumed(self, control, action, node, eventInfo):
+		device = self.restoreDevice(node)
+		if device is not None:
+			self.plugin.communicationResumed(self.ISY, device)
+			self.plugin.queryDevice(self.ISY, node)
+
+	def handleTopologyEvent(self, control, action, node, eventInfo):
+		self.topology.applyNodeEvent(action, node, eventInfo)
+
+	def handleUnknownNodeEvent(self, control, action, node, eventInfo):
+		# actions other than the above fall through here to see which are relevant
+		self.errorLog('unhandled ISY control event: %s node: %s action: %s eventInfo: %s' % (control, node, action, eventInfo))
+
+	def handleHeartbeat(self, control, action, node, eventInfo):
+		# ISY heartbeat
+		self.conn.send('beat')
+		try:
+			self.heartbeatInterval = int(action)
+		except ValueError:
+			pass
+		self.startHeartbeat()
+		self.log.limited((self.ISY.address, '_0'), 'Rubatosis ... thump.thump ... thump.thump')
+
+	def handleProgramStatus(self, control, action, node, eventInfo):
+		programXML = parseString('<prg>%s</prg>' % eventInfo)
+		# we only get back the program number, in hex and not zero padded to 4 places, so we
+		# need to pad it out (1A becomes 001A, as in the program list) and prepend the ISY device id
+		programId = '%04X' % int(self.extractFromXML(programXML, 'id'), 16)
+		id = "[%i]%s" % (self.ISY.id, programId)
+		fork, status = kProgramStatus.get(self.extractFromXML(programXML, 's'), ('unknown', 'unknown'))
+		self.topology.programSeen(programId)
+		self.plugin.programFeedback(id, fork, status)
+
+	def handleInformationEvent(self, control, action, node, eventInfo):
+		self.plugin.pluginEventViewer(self.ISY, eventInfo)
+
+	def handleKeyEvent(self, control, action, node, eventInfo):
+		self.debugLog('Ignoring ISY control event _1/_8 (key): eventInfo: %s', eventInfo)
+
+	def handleUnknownTriggerEvent(self, control, action, node, eventInfo):
+		self.errorLog('UNKNOWN ISY control _1 event for node: %s action: %s eventInfo: %s' % (node, action, eventInfo))
+
+	def handleBusyEvent(self, control, action, node, eventInfo):
+		if action == '0':
+			self.log.limited((self.ISY.address, '_5', action), 'Ignoring ISY not busy event _5/_0')
 		else:
-			self.errorLog('UNKNOWN ISY control event control: %s action: %s eventInfo: %s' % (control, action, eventInfo))
+			self.log.limited((self.ISY.address, '_5', action), 'Ignoring ISY     busy event _5/_1')
+
+	def handleViewerEvent(self, control, action, node, eventInfo):
+		self.plugin.pluginEventViewer(self.ISY, 'IGNORED %s %s %s %s %s' % (kViewerControls[control], control, node, action, eventInfo))
 
 	def handleRelayEvent(self, dev, control, action):
-		self.debugLog('<<----called: handleRelayEvent')
+		self.log.verbose('<<----called: handleRelayEvent')
 # apparently,both 255 and 100 are legal for "on" for relay devices/jms.  At least
 # all I am seeing is 100. 
 		if control == 'ST':
@@ -655,12 +1012,12 @@ class SubscriptionServer(object):
 				onOff = True
 			else:
 				onOff = False
-			dev.updateStateOnServer('onOffState', onOff)
+			self.setState(dev, 'onOffState', onOff)
 		else:
 			self.errorLog('unhandled ISY relay event node %s control %s action %s' % (dev.address, control, action))
 		
 	def handleDimmerEvent(self, dev, control, action):
-		self.debugLog('<<----called: handleDimmerEvent')
+		self.log.verbose('<<----called: handleDimmerEvent')
 # we update the brightness based on the maximum, which is stored as a property of
 # the device, and which we set earlier, typically either 255 (X10/Insteon) or 100 (ZWave)
 # Indigo seems to automatically consider something with non-zero brightness as "ON," so
@@ -672,51 +1029,51 @@ class SubscriptionServer(object):
 			#self.debugLog('handleDimmerEvent: dev maxBrightness is %d' % maxBrightness)
 			newBrightness = int( float(action) * (100./float(maxBrightness)) )
 			#self.debugLog('handleDimmerEvent: ST event new brightness %d' % newBrightness)
-                        dev.updateStateOnServer('brightnessLevel', newBrightness)
+                        self.setState(dev, 'brightnessLevel', newBrightness)
 		elif control == 'DON':
 			# ignoring action, although it is usually 100 here
 			# not sure how we tell Indigo what the brightness is, or if we even know./jms/171220
 			# possibly for future analysis and experimentation.
-			dev.updateStateOnServer('onOffState', True)
+			self.setState(dev, 'onOffState', True)
 		elif control == 'DOF':
 			# ignoring action, although is is usually 0 here
-			dev.updateStateOnServer('onOffState', False)
+			self.setState(dev, 'onOffState', False)
 		else:
 			self.errorLog('unhandled ISY dimmer event node %s control %s action %s' % (dev.address, control, action))
 
 	def handleThermostatEvent(self, dev, control, action):
-		self.debugLog('<<----called: ISYThermostatEvent')
+		self.log.verbose('<<----called: ISYThermostatEvent')
 		if control == 'ST':
-			dev.updateStateOnServer('temperatureInput1', int(action)/2)
+			self.setState(dev, 'temperatureInput1', int(action)/2)
 			
 		elif control == 'CLIMD':
 			mode = action.replace(' ', '').replace('ProgramAuto', 'ProgramHeatCool')
-			dev.updateStateOnServer('hvacOperationMode', mode)
+			self.setState(dev, 'hvacOperationMode', mode)
 
 		elif control == 'CLIHCS':
 			if action == '0':
-				dev.updateStateOnServer('hvacCoolerIsOn', False)
-				dev.updateStateOnServer('hvacHeaterIsOn', False)
+				self.setState(dev, 'hvacCoolerIsOn', False)
+				self.setState(dev, 'hvacHeaterIsOn', False)
 			elif action == '1':
-				dev.updateStateOnServer('hvacCoolerIsOn', False)
-				dev.updateStateOnServer('hvacHeaterIsOn', True)
+				self.setState(dev, 'hvacCoolerIsOn', False)
+				self.setState(dev, 'hvacHeaterIsOn', True)
 			elif action == '2':
-				dev.updateStateOnServer('hvacCoolerIsOn', True)
-				dev.updateStateOnServer('hvacHeaterIsOn', False)
+				self.setState(dev, 'hvacCoolerIsOn', True)
+				self.setState(dev, 'hvacHeaterIsOn', False)
 			else:
 				self.errorLog('invalid CLIHCS action parameter')
 
 		elif control == 'CLISPH':
-			dev.updateStateOnServer('setpointHeat', int(action)/2)
+			self.setState(dev, 'setpointHeat', int(action)/2)
 
 		elif control == 'CLISPC':
-			dev.updateStateOnServer('setpointCool', int(action)/2)
+			self.setState(dev, 'setpointCool', int(action)/2)
 
 		elif control == 'CLIFS':
 			if action == '7':
-				dev.updateStateOnServer('hvacFanMode', 1)
+				self.setState(dev, 'hvacFanMode', 1)
 			elif action == '8':
-				dev.updateStateOnServer('hvacFanMode', 0)
+				self.setState(dev, 'hvacFanMode', 0)
 			else:
 				self.errorLog('invalid CLIFS action parameter')
 				
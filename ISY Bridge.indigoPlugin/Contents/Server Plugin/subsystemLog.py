@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							subsystemLog.py
+#
+# Debug logging for the busy parts of the plugin - the event subscription, REST
+# calls, discovery and topology sync - each with a level of its own set in the
+# plugin config.  Messages are passed as a format string plus arguments and only
+# formatted once we know the level lets them through, so with debugging off an
+# event costs a comparison rather than building strings nobody reads.
+#
+# Repetitive messages (heartbeats, busy/not busy) go through limited(), which
+# lets one per key through each interval and says how many were held back.
+################################################################################
+
+import time
+
+kLogOff = 0
+kLogDebug = 1
+kLogVerbose = 2		# adds a line or two for every event, REST response and node
+
+kLogSubsystems = ['subscription', 'rest', 'discovery', 'sync']
+kRepeatInterval = 600	# seconds between repeats of a rate limited message
+
+########################################################
+class SubsystemLog(object):
+	####################################################
+
+	def __init__(self, name, output, level=kLogDebug):
+		self.name = name
+		self.output = output
+		self.level = level
+		self.repeats = {}
+
+	def debug(self, message, *args):
+		if self.level >= kLogDebug:
+			self.output(message % args if args else message)
+
+	def verbose(self, message, *args):
+		if self.level >= kLogVerbose:
+			self.output(message % args if args else message)
+
+	def limited(self, key, message, *args):
+		if self.level < kLogDebug:
+			return
+		now = time.time()
+		repeat = self.repeats.get(key)
+		if repeat is not None and now - repeat[0] < kRepeatInterval:
+			repeat[1] += 1
+			return
+		self.repeats[key] = [now, 0]
+		message = message % args if args else message
+		if repeat is not None and repeat[1] > 0:
+			message = '%s (%d more in the last %d minutes)' % (message, repeat[1], (now - repeat[0]) // 60)
+		self.output(message)
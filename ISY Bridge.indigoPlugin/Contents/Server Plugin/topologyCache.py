@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							topologyCache.py
+#
+# The node addresses each ISY had the last time we heard from it, kept in a
+# marshal file per ISYuuid in the plugin's cache folder.  The ISY has no cheap
+# change indicator of its own, but every status snapshot the subscription loads
+# lists all of its nodes, so the snapshot is checked against the cache for free.
+# If the addresses match, a restart carries on with the devices Indigo already
+# has and /rest/nodes is never downloaded.  If they don't, nodes were added or
+# removed while we weren't listening and the topology sync reloads everything.
+#
+# While an ISY is running the topology sync keeps the cached addresses current
+# as nodes are added and removed.
+################################################################################
+
+import os
+import time
+import marshal
+from threading import Lock
+
+kTopologyCacheVersion = 3
+kISYChanged = 'ISY nodes changed'
+
+########################################################
+class TopologyCache(object):
+	####################################################
+
+	def __init__(self, folder, log):
+		self.folder = folder		# called for the cache folder, which may not exist until then
+		self.log = log
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def path(self, ISYuuid):
+		return os.path.join(self.folder(), 'topology-%s.cache' % ISYuuid.replace(':', '').replace('/', ''))
+
+	def read(self, ISYuuid):
+		try:
+			with open(self.path(ISYuuid), 'rb') as cache:
+				cached = marshal.load(cache)
+		except Exception:
+			return None		# missing or unreadable
+		if not isinstance(cached, dict) or cached.get('version') != kTopologyCacheVersion:
+			return None
+		return cached
+
+	def write(self, ISYuuid, cached):
+		cacheFile = self.path(ISYuuid)
+		try:
+			with open(cacheFile + '.new', 'wb') as cache:
+				marshal.dump(cached, cache)
+			os.rename(cacheFile + '.new', cacheFile)
+		except Exception, e:
+			self.log.debug('Unable to write topology cache %s: %s', cacheFile, e)
+
+	# nodes is the sorted address list from a status snapshot; returns None on a hit or
+	# the reason for a miss, and a reason of kISYChanged is the only one that says
+	# anything about the ISY
+	def check(self, ISYuuid, nodes):
+		startTime = time.time()
+		with self.lock:
+			cached = self.read(ISYuuid)
+			if cached is None:
+				reason = 'nothing cached'
+			elif cached['nodes'] != nodes:
+				reason = kISYChanged
+			else:
+				reason = None
+			if reason is None:
+				self.hits += 1
+			else:
+				self.misses += 1
+		self.log.debug('topology cache for %s: %s in %.3f seconds', ISYuuid, reason or 'hit', time.time() - startTime)
+		return reason
+
+	def store(self, ISYuuid, nodes):
+		with self.lock:
+			self.write(ISYuuid, {'version':kTopologyCacheVersion, 'nodes':nodes})
+
+	def nodeChanged(self, ISYuuid, address, present):
+		# a node added or removed while we're listening, for a cache that is otherwise still good
+		with self.lock:
+			cached = self.read(ISYuuid)
+			if cached is not None and (address in cached['nodes']) != present:
+				nodes = set(cached['nodes'])
+				if present:
+					nodes.add(address)
+				else:
+					nodes.discard(address)
+				cached['nodes'] = sorted(nodes)
+				self.write(ISYuuid, cached)
@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							topologySync.py
+#
+# Keeps our picture of an ISY's nodes, scenes and programs current from the
+# _3 node changed events the subscription already delivers, instead of
+# re-downloading /rest/nodes, /rest/nodes/scenes and /rest/programs.  Node
+# adds/removes/renames go straight to the device cache (the subscription
+# server's address -> device dict), scene adds/removes/renames go to the scene
+# cache which is written back to the ISY device's 'scenes' prop, and a status
+# event for a program we've never heard of refreshes just the program list.
+#
+# If we lose events (a sequence gap) or can't make sense of one, the caches
+# can no longer be trusted and we fall back to a full resync, run on its own
+# thread so event processing carries on.  Only one resync runs at a time.  The
+# same goes for a status snapshot whose nodes don't match the topology cache -
+# they changed while we weren't listening.
+################################################################################
+
+import simplejson
+from xml.dom.minidom import parseString
+from threading import Thread, Lock
+from topologyCache import kISYChanged
+
+kNodeActions = ['ND', 'NR', 'NN']
+kSceneActions = ['GD', 'GR', 'GN']
+kMembershipActions = ['MV', 'CL', 'RG']
+kTopologyActions = kNodeActions + kSceneActions + kMembershipActions
+
+########################################################
+
+def elementText(xml, tag):
+	elements = xml.getElementsByTagName(tag)
+	if len(elements) == 0 or elements[0].firstChild is None:
+		return None
+	return elements[0].firstChild.data
+
+########################################################
+class TopologySync(object):
+	####################################################
+
+	def __init__(self, plugin, server):
+		self.plugin = plugin
+		self.debugLog = plugin.getLog('sync').debug
+		self.errorLog = plugin.errorLog
+		self.server = server
+		self.ISY = server.ISY
+		self.devices = server.devices
+		self.lock = Lock()
+		self.resyncRunning = False
+		self.programRefreshRunning = False
+		self.deltasApplied = 0
+		self.resyncs = 0
+		self.programRefreshes = 0
+		self.pendingNodes = None	# snapshot addresses to cache once a resync has loaded them
+		self.loadScenes(simplejson.loads(self.ISY.pluginProps.get('scenes', '[]')))
+		self.loadPrograms(simplejson.loads(self.ISY.pluginProps.get('programs', '[]')))
+
+	def loadScenes(self, sceneList):
+		self.scenes = dict([(address, name) for address, name in sceneList])
+
+	def loadPrograms(self, programList):
+		self.programs = set([id for id, name in programList])
+
+	def sceneList(self):
+		return sorted([[address, name] for address, name in self.scenes.items()], key=lambda scene: scene[1])
+
+	# every status snapshot lists all of the ISY's nodes; if nothing was cached the
+	# addresses are stored straight away, if they changed they're stored by the resync
+	def checkNodes(self, nodes):
+		ISYuuid = self.ISY.pluginProps['ISYuuid']
+		nodes = sorted(nodes)
+		reason = self.plugin.topologyCache.check(ISYuuid, nodes)
+		if reason == kISYChanged:
+			self.pendingNodes = nodes
+			self.invalidate('nodes changed while not listening')
+		elif reason is not None:
+			self.plugin.topologyCache.store(ISYuuid, nodes)
+
+	###########################
+	# incremental updates
+	###########################
+
+	def applyNodeEvent(self, action, node, eventInfo):
+		try:
+			if action in kNodeActions:
+				self.applyNodeChange(action, node, eventInfo)
+			elif action in kSceneActions:
+				self.applySceneChange(action, node, eventInfo)
+			else:
+				# scene membership - our caches don't track members, nothing to do
+				pass
+		except Exception, e:
+			self.errorLog('Unable to apply ISY node change %s %s: %s' % (action, node, e))
+			self.invalidate('unreadable %s event' % action)
+			return
+		self.deltasApplied += 1
+
+	def applyNodeChange(self, action, node, eventInfo):
+		if action in ['ND', 'NR']:
+			self.plugin.topologyCache.nodeChanged(self.ISY.pluginProps['ISYuuid'], node, action == 'ND')
+
+		if action == 'ND':
+			device = self.plugin.deviceNeedsAdding(self.ISY, eventInfo)
+			if device != None:
+				self.server.updateDevice(device.address, device)
+				self.plugin.queryDevice(self.ISY, device.address)
+
+		elif action == 'NR':
+			if node in self.devices:
+				# the plugin's device index has usually told the server already; deleting twice is harmless
+				self.plugin.deviceNeedsDeletion(self.devices[node])
+				self.server.deleteDevice(node)
+
+		elif action == 'NN':
+			if node in self.devices:
+				index = eventInfo.index('<newName>')
+				index2 = eventInfo.index('</newName>')
+				newName = eventInfo[index+9:index2]
+				device = self.devices[node]
+				device.name = newName
+				device.replaceOnServer()
+			elif node in self.scenes:
+				# scenes get NN as well as GN depending on firmware
+				self.applySceneChange('GN', node, eventInfo)
+
+	def applySceneChange(self, action, node, eventInfo):
+		if action == 'GD':
+			groupXML = parseString('<e>%s</e>' % eventInfo)
+			address = elementText(groupXML, 'address') or node
+			name = elementText(groupXML, 'name')
+			if not address or name is None:
+				raise Exception('scene added without an address and name')
+			self.scenes[address] = name
+
+		elif action == 'GR':
+			if node not in self.scenes:
+				return
+			del self.scenes[node]
+
+		elif action == 'GN':
+			name = elementText(parseString('<e>%s</e>' % eventInfo), 'newName')
+			if name is None:
+				raise Exception('scene renamed without a new name')
+			self.scenes[node] = name
+
+		self.debugLog('scene cache updated by %s for %s', action, node)
+		self.plugin.storeScenes(self.ISY, self.sceneList())
+
+	def programSeen(self, id):
+		# a status event for a program that's not in our list means programs were added;
+		# id is the bare one from the program list, without the ISY device id in front
+		if id in self.programs:
+			return
+		with self.lock:
+			if self.programRefreshRunning or self.resyncRunning:
+				return
+			self.programRefreshRunning = True
+			self.programRefreshes += 1
+		self.debugLog('unknown program %s, refreshing program list', id)
+		thread = Thread(target=self.refreshPrograms)
+		thread.daemon = True
+		thread.start()
+
+	def refreshPrograms(self):
+		try:
+			self.loadPrograms(self.plugin.refreshPrograms(self.ISY))
+		except Exception, e:
+			self.errorLog('Unable to refresh ISY program list: %s' % e)
+		finally:
+			with self.lock:
+				self.programRefreshRunning = False
+
+	###########################
+	# full resync
+	###########################
+
+	def invalidate(self, reason):
+		with self.lock:
+			if self.resyncRunning:
+				return
+			self.resyncRunning = True
+		self.errorLog('ISY topology out of sync (%s), reloading devices, scenes and programs: %s' % (reason, self.ISY.address))
+		thread = Thread(target=self.resync)
+		thread.daemon = True
+		thread.start()
+
+	def resync(self):
+		nodes = self.pendingNodes
+		try:
+			deviceDict, sceneList, programList = self.plugin.resyncISY(self.ISY)
+			self.server.replaceDevices(deviceDict)
+			self.loadScenes(sceneList)
+			self.loadPrograms(programList)
+			self.resyncs += 1
+			if nodes is not None:
+				self.plugin.topologyCache.store(self.ISY.pluginProps['ISYuuid'], nodes)
+				self.pendingNodes = None
+		except Exception, e:
+			self.errorLog('ISY topology resync failed: %s' % e)
+		finally:
+			with self.lock:
+				self.resyncRunning = False
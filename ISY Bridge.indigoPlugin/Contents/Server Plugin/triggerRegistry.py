@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY INSTEON Controller
+#							triggerRegistry.py
+#
+# Our Indigo triggers - a program's THEN or ELSE fork starting or finishing - by
+# event type and program id, any number of them per program.  Program status
+# events arrive on the subscription thread, which only looks the program up and
+# queues whatever triggers it has; a worker thread of our own executes them, so
+# a slow trigger can't hold up the events behind it.
+#
+# The queue is bounded like the command queue.  If the triggers fall that far
+# behind, a program's triggers are dropped and the drop is logged.
+################################################################################
+
+from Queue import Queue, Full
+from threading import Thread, Lock
+
+kTriggerQueueDepth = 256
+kWorkerJoinTimeout = 5
+
+# (fork, status) from the program status event -> our event type in Events.xml
+kProgramEvents = {('then', 'started'):'programThenStarted', ('then', 'finished'):'programThenFinished',
+	('else', 'started'):'programElseStarted', ('else', 'finished'):'programElseFinished'}
+
+########################################################
+class TriggerRegistry(object):
+	####################################################
+
+	def __init__(self, plugin, execute, depth=kTriggerQueueDepth):
+		self.errorLog = plugin.errorLog
+		self.execute = execute
+		self.lock = Lock()
+		self.triggers = {}		# (event type, program id) -> {trigger id: trigger}
+		self.keys = {}			# trigger id -> (event type, program id)
+		self.queue = Queue(depth)
+		self.thread = None
+		self.dispatched = 0
+		self.dropped = 0
+
+	def start(self):
+		self.thread = Thread(target=self.worker)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		# anything still queued is dropped
+		if self.thread is not None:
+			try:
+				self.queue.put_nowait(None)
+			except Full:
+				pass
+			self.thread.join(kWorkerJoinTimeout)
+			self.thread = None
+
+	###########################
+	# triggers starting and stopping
+	###########################
+
+	def add(self, trigger, eventType, programId):
+		with self.lock:
+			self.discard(trigger.id)
+			key = (eventType, programId)
+			self.triggers.setdefault(key, {})[trigger.id] = trigger
+			self.keys[trigger.id] = key
+
+	def remove(self, trigger):
+		with self.lock:
+			self.discard(trigger.id)
+
+	def discard(self, id):
+		key = self.keys.pop(id, None)
+		if key is not None:
+			triggers = self.triggers[key]
+			del triggers[id]
+			if not triggers:
+				del self.triggers[key]
+
+	def count(self):
+		return len(self.keys)
+
+	###########################
+	# program events
+	###########################
+
+	# called on the subscription thread
+	def programEvent(self, programId, fork, status):
+		with self.lock:
+			triggers = self.triggers.get((kProgramEvents.get((fork, status)), programId))
+			if not triggers:
+				return
+			triggers = triggers.values()
+		try:
+			self.queue.put_nowait(triggers)
+		except Full:
+			self.dropped += 1
+			self.errorLog('Too many program triggers waiting, %d triggers for program %s %s %s dropped' %
+				(len(triggers), programId, fork, status))
+
+	def worker(self):
+		while True:
+			triggers = self.queue.get()
+			if triggers is None:
+				break
+			for trigger in triggers:
+				try:
+					self.execute(trigger)
+					self.dispatched += 1
+				except Exception, e:
+					self.errorLog('Unable to execute trigger %s: %s' % (trigger.name, e))
@@ -0,0 +1,399 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							benchEndToEnd.py
+#
+# Runs the plugin's own DeviceController and SubscriptionServer against the
+# simulated ISY in isySimulator.py (in a child process, so it doesn't share our
+# CPU) with the indigo stub standing in for Indigo, and measures:
+#
+#	ingest		events per second through the subscription during a burst,
+#				and CPU time per event
+#	latency		p50/p99 from an event's arrival on the socket to the state it
+#				changes reaching updateStatesOnServer, for the burst and for a
+#				steady trickle of events
+#	commands	p50/p99 REST round trip for on/off commands, and from sending
+#				the command to the ISY's feedback reaching the device states
+#	programs	p50/p99 from running a program to its finished status event
+#				reaching the plugin with the id its triggers are keyed on
+#
+# --metrics turns on the plugin's performance metrics, to see what they cost.
+# Results are written as JSON along with the commit they were taken at, and
+# --compare prints the change against an earlier results file:
+#
+#	python benchmarks/benchEndToEnd.py [--mode loop|threaded] [--events N] [--output file] [--compare file]
+################################################################################
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import resource
+import threading
+import subprocess
+import multiprocessing
+
+import eventCorpus
+import indigoStub
+import isySimulator
+eventCorpus.addPluginPath()
+indigoStub.install()
+from deviceController import DeviceController
+from subscriptionServer import SubscriptionServer
+from subscriptionLoop import SubscriptionLoop
+from deadlineScheduler import DeadlineScheduler
+from topologyCache import TopologyCache
+from metrics import Metrics
+
+kAuthorization = 'bench:bench'
+kSettleTime = 0.5
+kFeedbackTimeout = 5
+
+########################################################
+class EndToEndPlugin(indigoStub.BenchPlugin):
+	####################################################
+	# what SubscriptionServer and TopologySync call back into; only the status
+	# snapshot and program feedback do anything here
+
+	def __init__(self, controller=None):
+		indigoStub.BenchPlugin.__init__(self)
+		self.controller = controller
+		self.programEvents = []
+		# a cache folder of our own, so every run starts with nothing cached
+		cacheFolder = tempfile.mkdtemp()
+		self.topologyCache = TopologyCache(lambda: cacheFolder, self.getLog('sync'))
+
+	def getStatus(self, ISY):
+		return self.controller.getStatus(ISY.address, kAuthorization)
+
+	# the plugin runs this on the ISY's command queue; here a thread of its own does
+	def queueStatus(self, ISY, callback):
+		def fetch():
+			try:
+				status = self.getStatus(ISY)
+			except Exception, e:
+				callback(None, e)
+				return
+			callback(status, None)
+		thread = threading.Thread(target=fetch)
+		thread.daemon = True
+		thread.start()
+
+	def programFeedback(self, id, fork, status):
+		self.programEvents.append((id, fork, status))
+
+	def refreshPrograms(self, ISY):
+		return self.controller.getPrograms(ISY.address, kAuthorization)
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+	def ignore(self, *args):
+		pass
+
+	queryDevice = undefinedDeviceDetected = communicationError = communicationResumed = ignore
+	pluginEventViewer = resyncISY = storeScenes = ignore
+	deviceNeedsAdding = deviceNeedsDeletion = ignore
+
+########################################################
+class TimedSubscriptionServer(SubscriptionServer):
+	####################################################
+	# notes when each event arrived on the socket and which device states it set, so
+	# the devices can work out the latency once their update reaches the 'server'
+
+	def __init__(self, plugin, dev, deviceDict):
+		SubscriptionServer.__init__(self, plugin, dev, deviceDict)
+		self.received = 0
+		self.nodeEvents = 0
+		self.receivedAt = None
+		self.pending = {}
+		self.latencies = []
+		for device in deviceDict.values():
+			device.onUpdate = self.deviceUpdated
+
+	def receiveEvent(self, request):
+		# the time the chunk holding this event came off the socket
+		self.receivedAt = self.reader.lastReceived
+		self.received += 1
+		SubscriptionServer.receiveEvent(self, request)
+
+	def handleNodeEvent(self, control, action, node, eventInfo):
+		SubscriptionServer.handleNodeEvent(self, control, action, node, eventInfo)
+		self.nodeEvents += 1
+
+	def setState(self, dev, key, value):
+		if self.receivedAt is not None:
+			self.pending.setdefault(dev.address, {})[self.received] = self.receivedAt
+		SubscriptionServer.setState(self, dev, key, value)
+
+	def flushStates(self):
+		sent = SubscriptionServer.flushStates(self)
+		# anything still pending was unchanged and never went to the server
+		self.pending.clear()
+		return sent
+
+	def deviceUpdated(self, dev, now, keys):
+		self.latencies.extend([now - receivedAt for receivedAt in self.pending.pop(dev.address, {}).values()])
+
+########################################################
+class SimulatorProcess(object):
+	####################################################
+	# the simulated ISY in a child process, driven over a pipe
+
+	def __init__(self, nodeCount, seed):
+		self.pipe, childPipe = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=self.run, args=(childPipe, nodeCount, seed))
+		self.process.daemon = True
+		self.process.start()
+		self.address = self.pipe.recv()
+
+	def run(self, pipe, nodeCount, seed):
+		simulator = isySimulator.SimulatedISY(nodeCount, seed=seed).start()
+		pipe.send(simulator.address)
+		while True:
+			request = pipe.recv()
+			if request[0] == 'burst':
+				pipe.send(simulator.burst(*request[1:]))
+			elif request[0] == 'stats':
+				pipe.send(dict(simulator.stats))
+			else:
+				simulator.stop()
+				pipe.send(None)
+				return
+
+	def request(self, *request):
+		self.pipe.send(request)
+		return self.pipe.recv()
+
+	def stop(self):
+		self.request('stop')
+		self.process.join(5)
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def milliseconds(values):
+	return {'p50':round(percentile(values, 0.5) * 1000, 3), 'p99':round(percentile(values, 0.99) * 1000, 3),
+		'max':round(max(values) * 1000, 3), 'samples':len(values)} if values else None
+
+def cpuTime():
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+	return usage.ru_utime + usage.ru_stime
+
+def waitFor(condition, timeout):
+	deadline = time.time() + timeout
+	while not condition():
+		if time.time() > deadline:
+			raise Exception('timed out waiting for the simulated ISY')
+		time.sleep(0.001)
+
+def waitForQuiet(server):
+	# until no events have come in for a little while
+	while True:
+		received = server.received
+		time.sleep(kSettleTime)
+		if server.received == received:
+			return
+
+def loadDevices(controller, address):
+	# the device list as the plugin would create it from /rest/nodes
+	devices = {}
+	for index, node in enumerate(controller.iterDevices(address, kAuthorization)):
+		devices[node['address']] = indigoStub.Device(1000 + index, node['address'], node['type'],
+			pluginProps={'ISYmaxBrightness':node['maxBrightness'], 'ISYuuid':'bench'}, name=node['name'])
+	return devices
+
+########################################################
+class Subscription(object):
+	####################################################
+	# starts and stops the subscription the way plugin.py does in either mode
+
+	def __init__(self, plugin, server, mode):
+		self.server = server
+		self.mode = mode
+		if mode == 'loop':
+			self.loop = SubscriptionLoop(plugin)
+			self.loop.start()
+			self.loop.add(server)
+		else:
+			server.scheduler = DeadlineScheduler(plugin.errorLog)
+			server.scheduler.start()
+			self.thread = threading.Thread(target=server.startServer)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def stop(self):
+		if self.mode == 'loop':
+			self.loop.remove(self.server).wait(5)
+			self.loop.stop()
+		else:
+			self.server.stopServer()
+			self.thread.join(5)
+			self.server.scheduler.stop()
+
+def measureIngest(simulator, server, changes, rate=0):
+	server.latencies = []
+	nodeEvents = server.nodeEvents
+	cpu = cpuTime()
+	start = time.time()
+	published = simulator.request('burst', changes, rate)
+	waitFor(lambda: server.nodeEvents - nodeEvents >= published, 30 + published / 1000.0)
+	elapsed = time.time() - start
+	cpu = cpuTime() - cpu
+	result = {'events':published, 'seconds':round(elapsed, 4), 'latencyMs':milliseconds(server.latencies)}
+	if not rate:
+		result['eventsPerSecond'] = round(published / elapsed, 1)
+		result['cpuMicrosecondsPerEvent'] = round(cpu / published * 1000000, 2)
+	return result
+
+def measureCommands(controller, address, devices, count):
+	# alternates each dimmer between on and off so every command changes its state
+	dimmers = [device for device in devices.values() if device.deviceTypeId == 'ISYDimmer' and device.address.endswith(' 1')]
+	roundTrips = []
+	feedback = []
+	for index in range(count):
+		device = dimmers[index % len(dimmers)]
+		updates = device.updates
+		start = time.time()
+		if device.states.get('brightnessLevel'):
+			controller.deviceOff(address, kAuthorization, device.address)
+		else:
+			controller.deviceOn(address, kAuthorization, device.address)
+		roundTrips.append(time.time() - start)
+		waitFor(lambda: device.updates > updates, kFeedbackTimeout)
+		feedback.append(time.time() - start)
+	return {'roundTripMs':milliseconds(roundTrips), 'feedbackMs':milliseconds(feedback)}
+
+def measurePrograms(plugin, controller, address, server, programs, count):
+	# runs each program in turn and waits for the feedback the plugin's triggers are keyed on.
+	# Every program is in the topology's list, so none of them may set off a refresh of it.
+	ISY = server.ISY
+	refreshes = server.topology.programRefreshes
+	feedback = []
+	for index in range(count):
+		id = programs[index % len(programs)][0]
+		expected = ('[%s]%s' % (ISY.id, id), 'then', 'finished')
+		events = len(plugin.programEvents)
+		start = time.time()
+		controller.programCommand(address, kAuthorization, id, 'runThen')
+		waitFor(lambda: expected in plugin.programEvents[events:], kFeedbackTimeout)
+		feedback.append(time.time() - start)
+	if server.topology.programRefreshes != refreshes:
+		raise Exception('status events for known programs refreshed the program list %d times' %
+			(server.topology.programRefreshes - refreshes))
+	return {'feedbackMs':milliseconds(feedback)}
+
+def gitCommit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+	except Exception:
+		return None
+
+def run(args):
+	simulator = SimulatorProcess(args.nodes, args.seed)
+	plugin = EndToEndPlugin()
+	controller = DeviceController(plugin)
+	plugin.controller = controller
+	try:
+		start = time.time()
+		devices = loadDevices(controller, simulator.address)
+		topologySeconds = time.time() - start
+		ISY = indigoStub.Device(1, simulator.address, 'ISY', name='Simulated ISY',
+			pluginProps={'authorization':kAuthorization, 'ISYuuid':'bench', 'scenes':'[]', 'programs':'[]'})
+		server = TimedSubscriptionServer(plugin, ISY, devices)
+		programs = controller.getPrograms(simulator.address, kAuthorization)
+		server.topology.loadPrograms(programs)
+		if args.metrics:
+			server.metrics = Metrics()
+			controller.setMetrics(simulator.address, server.metrics)
+		subscription = Subscription(plugin, server, args.mode)
+		try:
+			start = time.time()
+			waitFor(lambda: ISY.states.get('connectionStatus') == 'connected', 30)
+			waitForQuiet(server)
+			subscribeSeconds = time.time() - start - kSettleTime
+			burst = measureIngest(simulator, server, args.events)
+			waitForQuiet(server)
+			steady = measureIngest(simulator, server, args.steadyEvents, args.steadyRate)
+			waitForQuiet(server)
+			commands = measureCommands(controller, simulator.address, devices, args.commands)
+			programRuns = measurePrograms(plugin, controller, simulator.address, server, programs, args.programs)
+		finally:
+			subscription.stop()
+		simulatorStats = simulator.request('stats')
+	finally:
+		simulator.stop()
+	return {
+		'commit':gitCommit(),
+		'time':time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python':sys.version.split()[0],
+		'platform':sys.platform,
+		'parameters':{'mode':args.mode, 'metrics':args.metrics, 'nodes':args.nodes, 'events':args.events, 'steadyEvents':args.steadyEvents,
+			'steadyRate':args.steadyRate, 'commands':args.commands, 'programs':args.programs, 'seed':args.seed},
+		'topologyLoadSeconds':round(topologySeconds, 4),
+		'subscribeSeconds':round(subscribeSeconds, 4),
+		'burst':burst,
+		'steady':steady,
+		'commands':commands,
+		'programs':programRuns,
+		'errors':len(plugin.errors),
+		'simulator':simulatorStats,
+	}
+
+def flatten(results, prefix=''):
+	values = {}
+	for key, value in results.items():
+		if isinstance(value, dict):
+			values.update(flatten(value, prefix + key + '.'))
+		elif isinstance(value, (int, float)) and not isinstance(value, bool):
+			values[prefix + key] = value
+	return values
+
+def compare(old, new):
+	oldValues = flatten(old)
+	newValues = flatten(new)
+	print('%-40s %12s %12s %8s' % ('metric (vs %s)' % old.get('commit'), 'before', 'after', 'change'))
+	for key in sorted(newValues):
+		if key.startswith('parameters.') or key.startswith('simulator.') or key not in oldValues:
+			continue
+		before, after = oldValues[key], newValues[key]
+		change = '%+.1f%%' % ((after - before) * 100.0 / before) if before else ''
+		print('%-40s %12s %12s %8s' % (key, before, after, change))
+
+def main():
+	parser = argparse.ArgumentParser(description='End-to-end event ingest and command latency against a simulated ISY.')
+	parser.add_argument('--mode', choices=['loop', 'threaded'], default='threaded', help='subscription mode, threaded like the plugin by default')
+	parser.add_argument('--nodes', type=int, default=500)
+	parser.add_argument('--events', type=int, default=20000, help='node changes in the ingest burst')
+	parser.add_argument('--steady-events', dest='steadyEvents', type=int, default=1000)
+	parser.add_argument('--steady-rate', dest='steadyRate', type=float, default=200, help='node changes per second')
+	parser.add_argument('--commands', type=int, default=200)
+	parser.add_argument('--programs', type=int, default=50, help='program runs')
+	parser.add_argument('--seed', type=int, default=1)
+	parser.add_argument('--metrics', action='store_true', help='collect the plugin\'s performance metrics')
+	parser.add_argument('--output', help='results file, benchEndToEnd-<commit>.json by default')
+	parser.add_argument('--compare', help='earlier results file to compare against')
+	args = parser.parse_args()
+
+	results = run(args)
+	output = args.output or 'benchEndToEnd-%s.json' % (results['commit'] or 'unknown')
+	with open(output, 'w') as file:
+		json.dump(results, file, indent=2, sort_keys=True)
+	burst = results['burst']
+	print('%s mode%s, %d nodes: %.0f events/s, %.1f us CPU/event' % (args.mode, ' with metrics' if args.metrics else '', args.nodes, burst['eventsPerSecond'], burst['cpuMicrosecondsPerEvent']))
+	for name, latency in [('burst latency', burst['latencyMs']), ('steady latency', results['steady']['latencyMs']),
+			('command round trip', results['commands']['roundTripMs']), ('command feedback', results['commands']['feedbackMs']),
+			('program feedback', results['programs']['feedbackMs'])]:
+		print('%-20s p50 %8.3f ms  p99 %8.3f ms' % (name, latency['p50'], latency['p99']))
+	print('results written to %s' % output)
+	if args.compare:
+		with open(args.compare) as file:
+			compare(json.load(file), results)
+
+if __name__ == '__main__':
+	main()
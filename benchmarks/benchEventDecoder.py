@@ -0,0 +1,50 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							benchEventDecoder.py
+#
+# Decodes the captured ISY event bodies with the fast path and with the
+# strict minidom decoder, checks they agree, and reports events per second.
+#
+#	python benchmarks/benchEventDecoder.py [eventCount]
+################################################################################
+
+import sys
+import time
+
+import eventCorpus
+eventCorpus.addPluginPath()
+from eventDecoder import fastDecodeEvent, strictDecodeEvent
+
+def checkAgreement(bodies):
+	for body in bodies:
+		fast = fastDecodeEvent(body)
+		strict = strictDecodeEvent(body)
+		if fast is None:
+			raise Exception('fast path rejected a corpus event: %s' % body)
+		for field in ('sid', 'seqnum', 'control', 'action', 'node', 'eventInfo'):
+			if getattr(fast, field) != getattr(strict, field):
+				raise Exception('decoders disagree on %s: %r != %r' % (field, getattr(fast, field), getattr(strict, field)))
+
+def timeIt(decode, bodies, repeat=3):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		for body in bodies:
+			decode(body)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+	bodies = eventCorpus.eventBodies(count)
+	checkAgreement(bodies[:len(eventCorpus.kEventTemplates)])
+	print('decoding %d events' % count)
+	for name, decode in [('minidom (strict)', strictDecodeEvent), ('fast path', fastDecodeEvent)]:
+		elapsed = timeIt(decode, bodies)
+		print('%-18s %8.3fs %10.0f events/s' % (name, elapsed, count / elapsed))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							benchHttpReader.py
+#
+# Replays a recorded subscription event stream through the old byte-at-a-time
+# reader and through HttpStreamReader and reports messages per second.
+#
+#	python benchmarks/benchHttpReader.py [eventCount]
+################################################################################
+
+import sys
+import time
+
+import eventCorpus
+eventCorpus.addPluginPath()
+from subscriptionServer import HttpRequest, HttpStreamReader
+
+########################################################
+class LegacyHttpRequest(object):
+	####################################################
+	# the reader as it was before HttpStreamReader, kept here for comparison
+
+	def __init__(self, conn):
+		self.headers = ''
+		while True:
+			d = conn.recv(1)
+			if not d:
+				raise Exception('ISY closed subscription connection')
+			self.headers = self.headers + d
+			if d == '\n':
+				l = len(self.headers)
+				if l >= 4:
+					if self.headers[l-2] == '\r' and self.headers[l-3] == '\n' and self.headers[l-4] == '\r':
+						break
+		contentLength = 0
+		for header in self.headers.split('\r\n'):
+			if 'content-length' in header.lower():
+				contentLength = int(header[len('content-length')+1:])
+				break
+		self.body = ''
+		while len(self.body) < contentLength:
+			d = conn.recv(1)
+			if not d:
+				raise Exception('ISY closed subscription connection')
+			self.body = self.body + d
+
+def runLegacy(stream, count):
+	conn = eventCorpus.ReplaySocket(stream)
+	for i in xrange(count):
+		LegacyHttpRequest(conn)
+
+def runBuffered(stream, count):
+	reader = HttpStreamReader(eventCorpus.ReplaySocket(stream))
+	for i in xrange(count):
+		HttpRequest(reader)
+
+def timeIt(func, stream, count, repeat=3):
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		func(stream, count)
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+	stream = eventCorpus.eventStream(count)
+	print('replaying %d events (%d bytes)' % (count, len(stream)))
+	for name, func in [('byte-at-a-time', runLegacy), ('HttpStreamReader', runBuffered)]:
+		elapsed = timeIt(func, stream, count)
+		print('%-18s %8.3fs %10.0f msg/s' % (name, elapsed, count / elapsed))
+
+if __name__ == '__main__':
+	main()
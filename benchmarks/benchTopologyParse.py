@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							benchTopologyParse.py
+#
+# Parses synthetic /rest/nodes, /rest/nodes/scenes and /rest/programs documents
+# the old way (minidom plus extractFromXML per field) and with the streaming
+# iterparse pipeline, and reports the time and the peak memory each takes.
+# Each run happens in a child process of its own so the peaks don't mix.
+#
+#	python benchmarks/benchTopologyParse.py [nodeCount ...]
+################################################################################
+
+import os
+import sys
+import time
+import string
+import resource
+import subprocess
+from xml.dom.minidom import parseString
+
+import eventCorpus
+import indigoStub
+import topologyCorpus
+eventCorpus.addPluginPath()
+indigoStub.install()
+from deviceController import DeviceController, ChunkStream, iterElements
+
+########################################################
+class LegacyParser(object):
+	####################################################
+	# the DOM based parsing as it was before the streaming pipeline, kept here for
+	# comparison - just the field extraction and description lookup, which is where
+	# the time went; the device type mapping is the same either way
+
+	def __init__(self):
+		self.deviceTypes = parseString(open(os.path.join(eventCorpus.kPluginFolder, '1_fam.xml')).read())
+
+	def extractFromXML(self, xml, tag, attribute=None, value=None):
+		elementList = xml.getElementsByTagName(tag)
+		if attribute == None:
+			return elementList[0].toxml().replace('<' + tag + '>','').replace('</' + tag + '>','')
+		for element in elementList:
+			if element.getAttribute(attribute) == value:
+				return element
+		return None
+
+	def parseOneDevice(self, device):
+		name = self.extractFromXML(device, 'name')
+		address = self.extractFromXML(device, 'address')
+		type = self.extractFromXML(device, 'type').split('.')
+		if type[0] not in ['1', '2', '4', '5', '7', '113']:
+			return None
+		if type[0] == '4':
+			devtypeXML = '<XML>' + self.extractFromXML(device, 'devtype') + '</XML>'
+			self.extractFromXML(parseString(devtypeXML), 'cat')
+		category = self.extractFromXML(self.deviceTypes, 'nodeCategory', 'id', type[0])
+		subcategory = self.extractFromXML(category, 'nodeSubCategory', 'id', type[1]) if category else None
+		if subcategory:
+			description = string.capwords(subcategory.getAttribute('name').replace('DEV_SCAT_','').replace('_',' ').lower())
+		else:
+			description = 'Unknown Device'
+		return {'name':name, 'address':address, 'description':description}
+
+	def devices(self, document):
+		return [device for device in [self.parseOneDevice(node) for node in parseString(document).getElementsByTagName('node')] if device]
+
+	def scenes(self, document):
+		return [[self.extractFromXML(scene, 'address'), self.extractFromXML(scene, 'name')]
+			for scene in parseString(document).getElementsByTagName('group')]
+
+	def programs(self, document):
+		return [[program.getAttribute('id'), self.extractFromXML(program, 'name')]
+			for program in parseString(document).getElementsByTagName('program') if program.getAttribute('folder') == 'false']
+
+########################################################
+class StreamingParser(object):
+	####################################################
+
+	def __init__(self):
+		self.controller = DeviceController(indigoStub.BenchPlugin())
+
+	def elements(self, document, tag):
+		return iterElements(ChunkStream(topologyCorpus.chunked(document)), tag)
+
+	def devices(self, document):
+		return [device for device in [self.controller.parseOneDevice(node) for node in self.elements(document, 'node')] if device]
+
+	def scenes(self, document):
+		return [[scene.findtext('address'), scene.findtext('name')] for scene in self.elements(document, 'group')]
+
+	def programs(self, document):
+		return [[program.get('id'), program.findtext('name')] for program in self.elements(document, 'program') if program.get('folder') == 'false']
+
+kParsers = {'minidom':LegacyParser, 'streaming':StreamingParser}
+
+def peakMemory():
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on OS X
+	return peak / 1024.0 if sys.platform == 'darwin' else peak
+
+def documents(nodeCount):
+	return (topologyCorpus.nodesDocument(nodeCount), topologyCorpus.scenesDocument(nodeCount // 10, nodeCount),
+		topologyCorpus.programsDocument(nodeCount // 5))
+
+def runChild(parserName, nodeCount):
+	nodes, scenes, programs = documents(nodeCount)
+	parser = kParsers[parserName]()
+	baseline = peakMemory()
+	start = time.time()
+	counts = (len(parser.devices(nodes)), len(parser.scenes(scenes)), len(parser.programs(programs)))
+	elapsed = time.time() - start
+	print('%f %f %d %d %d %d' % ((elapsed, peakMemory() - baseline, sum([len(document) for document in (nodes, scenes, programs)])) + counts))
+
+def checkAgreement(nodeCount):
+	nodes, scenes, programs = documents(nodeCount)
+	legacy = LegacyParser()
+	streaming = StreamingParser()
+	for name in ('devices', 'scenes', 'programs'):
+		document = {'devices':nodes, 'scenes':scenes, 'programs':programs}[name]
+		old = getattr(legacy, name)(document)
+		new = getattr(streaming, name)(document)
+		if name == 'devices':
+			old = [(device['address'], device['name'], device['description']) for device in old]
+			new = [(device['address'], device['name'], device['description']) for device in new]
+		if old != new:
+			raise Exception('parsers disagree on %s' % name)
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == '--child':
+		runChild(sys.argv[2], int(sys.argv[3]))
+		return
+	nodeCounts = [int(count) for count in sys.argv[1:]] or [1000, 5000]
+	checkAgreement(200)
+	print('%-10s %6s %9s %10s %10s %12s' % ('parser', 'nodes', 'doc KB', 'time', 'nodes/s', 'peak +KB'))
+	for nodeCount in nodeCounts:
+		for parserName in ('minidom', 'streaming'):
+			output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', parserName, str(nodeCount)])
+			elapsed, memory, size, devices, scenes, programs = output.split()
+			print('%-10s %6d %9.0f %9.3fs %10.0f %12.0f' % (parserName, nodeCount, int(size) / 1024.0,
+				float(elapsed), nodeCount / float(elapsed), float(memory)))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							eventCorpus.py
+#
+# Event bodies captured from an ISY-994i (v5 firmware) subscription, with the
+# addresses and sid scrubbed.  The mix roughly follows what a scene change on
+# a busy install looks like: a burst of ST/DON/DOF for the members, program
+# status updates, lots of _5 busy/not busy and the odd heartbeat.
+################################################################################
+
+import os
+import sys
+
+kPluginFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ISY Bridge.indigoPlugin', 'Contents', 'Server Plugin')
+kSid = 'uuid:47'
+
+def addPluginPath():
+	if kPluginFolder not in sys.path:
+		sys.path.insert(0, kPluginFolder)
+
+kEventTemplates = [
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_0</control><action>120</action><node></node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>ST</control><action>255</action><node>1A 2B 3C 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>DON</control><action>100</action><node>1A 2B 3C 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>ST</control><action uom="100" prec="0">127</action><node>22 4F 10 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>DOF</control><action>0</action><node>22 4F 10 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>ST</control><action>0</action><node>ZW004_1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_5</control><action>1</action><node></node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_5</control><action>0</action><node></node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_1</control><action>0</action><node></node><eventInfo><id>1A</id><r>170601 18:22:41</r><f>170601 18:22:41</f><s>21</s></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_1</control><action>3</action><node></node><eventInfo>[  1A 2B 3C 1]       ST 255</eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>CLIHCS</control><action>1</action><node>14 A2 9E 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>CLISPH</control><action>136</action><node>14 A2 9E 1</node><eventInfo></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_3</control><action>NN</action><node>1A 2B 3C 1</node><eventInfo><newName>Kitchen Pendants</newName></eventInfo></Event>',
+	'<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>_23</control><action>2</action><node></node><eventInfo><status>1</status></eventInfo></Event>',
+]
+
+kRequestHeaders = ('POST reuse HTTP/1.1\r\n'
+	'Host: 192.168.1.10:80\r\n'
+	'Content-Type: text/xml; charset="utf-8"\r\n'
+	'Content-Length: %d\r\n'
+	'SOAPACTION:""\r\n\r\n')
+
+def eventBodies(count, sid=kSid):
+	bodies = []
+	for seqnum in range(1, count + 1):
+		template = kEventTemplates[seqnum % len(kEventTemplates)]
+		bodies.append(template % (seqnum, sid))
+	return bodies
+
+def eventStream(count, sid=kSid):
+	# the raw bytes the ISY writes to a REUSE_SOCKET subscription
+	return ''.join([kRequestHeaders % len(body) + body for body in eventBodies(count, sid)])
+
+########################################################
+class ReplaySocket(object):
+	####################################################
+	# Plays back a recorded stream the way the network delivers it: in
+	# segments of at most one MSS, and never more than the caller asked for.
+
+	def __init__(self, data, segmentSize=1448):
+		self.data = data
+		self.segmentSize = segmentSize
+		self.offset = 0
+
+	def recv(self, size):
+		size = min(size, self.segmentSize)
+		chunk = self.data[self.offset:self.offset+size]
+		self.offset += len(chunk)
+		return chunk
+
+	def recv_into(self, buffer, size=0):
+		chunk = self.recv(size or len(buffer))
+		buffer[:len(chunk)] = chunk
+		return len(chunk)
+
+	def send(self, data):
+		return len(data)
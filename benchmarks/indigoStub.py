@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							indigoStub.py
+#
+# Just enough of the indigo module for the plugin's modules to import and run
+# outside the Indigo server.  install() only puts it in place when the real
+# module isn't available, so inside Indigo nothing changes.  Device stands in
+# for the indigo.Device objects the subscription server updates.
+################################################################################
+
+import sys
+import time
+import types
+import tempfile
+
+########################################################
+class Server(object):
+	####################################################
+
+	def getInstallFolderPath(self):
+		return tempfile.gettempdir()
+
+	def log(self, message, isError=False):
+		pass
+
+def install():
+	try:
+		import indigo
+		return indigo
+	except ImportError:
+		pass
+	indigo = types.ModuleType('indigo')
+	indigo.server = Server()
+	sys.modules['indigo'] = indigo
+	return indigo
+
+########################################################
+class BenchPlugin(object):
+	####################################################
+	# stands in for the Plugin object the modules are handed
+
+	pluginId = 'com.perceptiveautomation.indigoplugin.isybridge.benchmark'
+
+	def __init__(self, verbose=False):
+		self.verbose = verbose
+		self.errors = []
+
+	def getLog(self, name):
+		from subsystemLog import SubsystemLog, kLogVerbose, kLogOff
+		return SubsystemLog(name, self.debugLog, kLogVerbose if self.verbose else kLogOff)
+
+	def debugLog(self, message):
+		if self.verbose:
+			print(message)
+
+	def errorLog(self, message):
+		self.errors.append(message)
+		if self.verbose:
+			print(message)
+
+########################################################
+class Device(object):
+	####################################################
+	# keeps its states locally; onUpdate, if set, is called with the device, the
+	# time and the keys of each update that reaches the 'server'
+
+	def __init__(self, id, address, deviceTypeId, states=None, pluginProps=None, name=None):
+		self.id = id
+		self.address = address
+		self.deviceTypeId = deviceTypeId
+		self.name = name or address
+		self.states = dict(states or {})
+		self.pluginProps = dict(pluginProps or {})
+		self.updates = 0
+		self.onUpdate = None
+
+	def updateStateOnServer(self, key, value):
+		self.states[key] = value
+		self.updated([key])
+
+	def updateStatesOnServer(self, stateList):
+		for state in stateList:
+			self.states[state['key']] = state['value']
+		self.updated([state['key'] for state in stateList])
+
+	def updated(self, keys):
+		self.updates += 1
+		if self.onUpdate is not None:
+			self.onUpdate(self, time.time(), keys)
+
+	def replacePluginPropsOnServer(self, pluginProps):
+		self.pluginProps = dict(pluginProps)
@@ -0,0 +1,489 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							isySimulator.py
+#
+# A stand-in ISY on localhost for load and regression testing the plugin without
+# any hardware.  It serves the REST calls the plugin makes (/rest/nodes,
+# /rest/nodes/scenes, /rest/programs, /rest/status, /rest/query and the node and
+# program commands) and the SOAP /services Subscribe and Unsubscribe requests,
+# pushing events back over the subscribing socket the way an ISY does for a
+# REUSE_SOCKET subscription: the current status of every node first, then a
+# heartbeat every interval and whatever changes.  Running a program sends its
+# started and finished status events.
+#
+# The node list is the synthetic one from topologyCorpus, so its size is up to
+# you.  Node state lives here - commands change it and send events just like a
+# real ISY would, and a generator thread changes random nodes at a steady rate.
+# Fault injection covers what a flaky network or a busy ISY does to the plugin:
+# events dropped (the sequence number is used up but the event never arrives),
+# sequence number gaps, the subscription dropped after a number of events, slow
+# responses and no heartbeats at all.
+#
+# Point an ISY device (or a SubscriptionServer in a benchmark) at the address it
+# prints - the plugin takes host:port addresses:
+#
+#	python benchmarks/isySimulator.py --port 8080 --nodes 500 --rate 20 --drop 0.01
+################################################################################
+
+import re
+import time
+import socket
+import random
+import urllib
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from Queue import Queue, Empty
+
+import topologyCorpus
+
+kDefaultHeartbeat = 120
+kStatsInterval = 10
+
+kEventTemplate = ('<?xml version="1.0"?><Event seqnum="%d" sid="%s"><control>%s</control><action>%s</action>'
+	'<node>%s</node><eventInfo>%s</eventInfo></Event>')
+
+kEventHeaders = ('POST reuse HTTP/1.1\r\n'
+	'Host: %s\r\n'
+	'Content-Type: text/xml; charset="utf-8"\r\n'
+	'Content-Length: %d\r\n'
+	'SOAPACTION:""\r\n\r\n')
+
+kSubscribeResponse = ('<?xml version="1.0" encoding="UTF-8"?><s:Envelope><s:Body><UDIDefaultResponse>'
+	'<SID>%s</SID><duration>0</duration></UDIDefaultResponse></s:Body></s:Envelope>')
+
+kUnsubscribeResponse = ('<?xml version="1.0" encoding="UTF-8"?><s:Envelope><s:Body><UDIDefaultResponse>'
+	'<status>200</status></UDIDefaultResponse></s:Body></s:Envelope>')
+
+# a program status event; the ISY leaves the leading zeros off the id
+kProgramEventInfo = '<id>%X</id><r>%s</r><f>%s</f><s>%s</s>'
+
+# the status codes a program run goes through: started then finished, for each fork
+kProgramRuns = {'run':('22', '21'), 'runThen':('22', '21'), 'runElse':('33', '31')}
+
+kRestResponse = '<?xml version="1.0" encoding="UTF-8"?><RestResponse succeeded="%s"><status>%d</status></RestResponse>'
+
+# what a thermostat reports on top of ST (temperature, in half degrees like the setpoints)
+kThermostatProperties = [('CLISPH', '136'), ('CLISPC', '156'), ('CLIHCS', '0'), ('CLIFS', '8')]
+
+########################################################
+class SimulatedNode(object):
+	####################################################
+
+	__slots__ = ('address', 'kind', 'properties')
+
+	def __init__(self, index):
+		type, nodeDefId, properties, devtype = topologyCorpus.kNodeTemplates[index % len(topologyCorpus.kNodeTemplates)]
+		self.address = topologyCorpus.nodeAddress(index)
+		if type.startswith('5.'):
+			self.kind = 'thermostat'
+		elif 'DIMMER' in nodeDefId.upper():
+			self.kind = 'dimmer'
+		else:
+			self.kind = 'relay'
+		self.properties = [['ST', re.search('value="(\d+)"', properties).group(1)]]
+		if self.kind == 'thermostat':
+			self.properties += [[control, value] for control, value in kThermostatProperties]
+
+	def get(self, control):
+		for property in self.properties:
+			if property[0] == control:
+				return property[1]
+		return None
+
+	def set(self, control, value):
+		for property in self.properties:
+			if property[0] == control:
+				property[1] = value
+				return
+		self.properties.append([control, value])
+
+	def statusXML(self):
+		return '<node id="%s">%s</node>' % (self.address,
+			''.join(['<property id="%s" value="%s" formatted="%s" uom=""/>' % (control, value, value) for control, value in self.properties]))
+
+########################################################
+class Subscriber(object):
+	####################################################
+	# one event subscription; its handler thread writes everything queued for it
+	# to the subscribing socket until it's unsubscribed, stopped or disconnected
+
+	def __init__(self, simulator, sid, conn, seed):
+		self.simulator = simulator
+		self.sid = sid
+		self.conn = conn
+		# events are small and the plugin never answers them, so don't let Nagle hold them back
+		self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.random = random.Random(seed)
+		self.queue = Queue()
+		self.seqnum = 0
+		self.sent = 0
+
+	def put(self, event):
+		self.queue.put(event)
+
+	def stop(self):
+		self.queue.put(None)
+
+	def message(self, control, action, node, eventInfo):
+		body = kEventTemplate % (self.seqnum, self.sid, control, action, node, eventInfo)
+		self.seqnum += 1
+		return kEventHeaders % (self.simulator.address, len(body)) + body
+
+	def send(self, messages):
+		self.conn.sendall(''.join(messages))
+		self.simulator.count('eventsSent', len(messages))
+
+	def nextSeqnum(self):
+		# the sequence numbers lost to a drop or a gap, if any
+		simulator = self.simulator
+		if simulator.gapRate and self.random.random() < simulator.gapRate:
+			simulator.count('gaps')
+			return self.random.randint(2, 10)
+		if simulator.dropRate and self.random.random() < simulator.dropRate:
+			simulator.count('eventsDropped')
+			return 1
+		return 0
+
+	def serve(self, initialStatus):
+		simulator = self.simulator
+		self.send([self.message(*event) for event in initialStatus])
+		interval = simulator.heartbeatInterval
+		nextHeartbeat = time.time()
+		while True:
+			if interval:
+				now = time.time()
+				if now >= nextHeartbeat:
+					self.send([self.message('_0', str(interval), '', '')])
+					nextHeartbeat = now + interval
+				wait = nextHeartbeat - now
+			else:
+				wait = kDefaultHeartbeat
+			try:
+				event = self.queue.get(timeout=max(0.01, wait))
+			except Empty:
+				continue
+			if event is None:
+				return
+			# everything already queued goes out in one write, back to back like an ISY burst
+			messages = []
+			stopping = False
+			while event is not None:
+				self.seqnum += self.nextSeqnum()
+				messages.append(self.message(*event))
+				self.sent += 1
+				if simulator.disconnectAfter and self.sent >= simulator.disconnectAfter:
+					simulator.count('disconnects')
+					stopping = True
+					break
+				try:
+					event = self.queue.get_nowait()
+				except Empty:
+					break
+				stopping = event is None
+			self.send(messages)
+			if stopping:
+				return
+
+########################################################
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	####################################################
+
+	protocol_version = 'HTTP/1.1'
+	# each response goes out in one write, otherwise Nagle's algorithm and delayed
+	# acks add 40ms to every keep-alive request
+	wbufsize = -1
+
+	def log_message(self, format, *args):
+		pass
+
+	def respond(self, status, body, contentType='text/xml; charset=UTF-8'):
+		if self.server.simulator.latency:
+			time.sleep(self.server.simulator.latency)
+		self.send_response(status)
+		self.send_header('Content-Type', contentType)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		self.wfile.flush()
+
+	def do_GET(self):
+		simulator = self.server.simulator
+		simulator.count('restRequests')
+		path = urllib.unquote(self.path.split('?')[0]).rstrip('/')
+		parts = path.split('/')[1:]
+		try:
+			status, body = simulator.rest(parts)
+		except Exception, e:
+			status, body = 500, kRestResponse % ('false', 500)
+			simulator.count('restErrors')
+		self.respond(status, body)
+
+	def do_POST(self):
+		simulator = self.server.simulator
+		body = self.rfile.read(int(self.headers.getheader('Content-Length', '0')))
+		if self.path != '/services':
+			self.respond(404, kRestResponse % ('false', 404))
+		elif 'Unsubscribe' in body:
+			sid = body[body.find('<SID>')+5:body.find('</SID>')]
+			simulator.unsubscribe(sid)
+			self.respond(200, kUnsubscribeResponse)
+		elif 'Subscribe' in body and 'REUSE_SOCKET' in body:
+			subscriber, initialStatus = simulator.subscribe(self.connection)
+			self.respond(200, kSubscribeResponse % subscriber.sid)
+			# from here on the socket belongs to the subscription
+			self.close_connection = 1
+			try:
+				subscriber.serve(initialStatus)
+			except socket.error:
+				pass
+			finally:
+				simulator.unsubscribe(subscriber.sid)
+		else:
+			self.respond(500, kRestResponse % ('false', 500))
+
+########################################################
+class SimulatorHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	####################################################
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+########################################################
+class SimulatedISY(object):
+	####################################################
+	# rates are fractions of events, latency is in seconds, disconnectAfter counts
+	# the events sent on a subscription, heartbeatInterval 0 stops heartbeats and
+	# port 0 picks a free port; the ISY's address is in .address once started
+
+	def __init__(self, nodeCount=100, eventRate=0.0, latency=0.0, dropRate=0.0, gapRate=0.0, disconnectAfter=0,
+			heartbeatInterval=kDefaultHeartbeat, host='127.0.0.1', port=0, seed=None):
+		self.nodeCount = nodeCount
+		self.eventRate = eventRate
+		self.latency = latency
+		self.dropRate = dropRate
+		self.gapRate = gapRate
+		self.disconnectAfter = disconnectAfter
+		self.heartbeatInterval = heartbeatInterval
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.nodes = [SimulatedNode(index) for index in range(nodeCount)]
+		self.nodesByAddress = dict([(node.address, node) for node in self.nodes])
+		self.programIds = ['%04X' % (0x100 + index) for index in range(max(1, nodeCount // 5))]
+		self.documents = {}
+		self.subscribers = {}
+		self.sidCounter = 0
+		self.stats = dict.fromkeys(['eventsPublished', 'eventsSent', 'eventsDropped', 'gaps', 'disconnects',
+			'subscriptions', 'restRequests', 'restErrors', 'commands'], 0)
+		self.running = False
+		self.server = SimulatorHTTPServer((host, port), RequestHandler)
+		self.server.simulator = self
+		self.address = '%s:%d' % self.server.server_address
+		self.threads = []
+
+	def start(self):
+		self.running = True
+		self.threads = [threading.Thread(target=self.server.serve_forever)]
+		if self.eventRate > 0:
+			self.threads.append(threading.Thread(target=self.generate))
+		for thread in self.threads:
+			thread.daemon = True
+			thread.start()
+		return self
+
+	def stop(self):
+		self.running = False
+		with self.lock:
+			subscribers = self.subscribers.values()
+		for subscriber in subscribers:
+			subscriber.stop()
+		self.server.shutdown()
+		self.server.server_close()
+		for thread in self.threads:
+			thread.join(5)
+
+	def count(self, name, amount=1):
+		with self.lock:
+			self.stats[name] += amount
+
+	###########################
+	# subscriptions
+	###########################
+
+	def subscribe(self, conn):
+		with self.lock:
+			self.sidCounter += 1
+			subscriber = Subscriber(self, 'uuid:%d' % self.sidCounter, conn, self.random.random())
+			self.subscribers[subscriber.sid] = subscriber
+			self.stats['subscriptions'] += 1
+			# taken under the lock so no change can slip in between the dump and the first event
+			initialStatus = [(control, value, node.address, '') for node in self.nodes for control, value in node.properties]
+		return subscriber, initialStatus
+
+	def unsubscribe(self, sid):
+		with self.lock:
+			subscriber = self.subscribers.pop(sid, None)
+		if subscriber is not None:
+			subscriber.stop()
+
+	def publish(self, control, action, node='', eventInfo=''):
+		# callers that change node state hold the lock, so events go out in the order the changes happened
+		self.stats['eventsPublished'] += 1
+		for subscriber in self.subscribers.values():
+			subscriber.put((control, action, node, eventInfo))
+
+	def change(self, node, control, value):
+		with self.lock:
+			node.set(control, value)
+			self.publish(control, value, node.address)
+
+	def runProgram(self, id, command):
+		# runs finish straight away; other commands (stop, enable...) send nothing
+		if command not in kProgramRuns:
+			return
+		now = time.strftime('%y%m%d %H:%M:%S')
+		with self.lock:
+			for status in kProgramRuns[command]:
+				self.publish('_1', '0', '', kProgramEventInfo % (int(id, 16), now, now, status))
+
+	###########################
+	# event generator
+	###########################
+
+	def randomChange(self):
+		node = self.random.choice(self.nodes)
+		if node.kind == 'thermostat':
+			if self.random.random() < 0.8:
+				value = str(max(100, min(190, int(node.get('ST')) + self.random.choice([-2, -1, 1, 2]))))
+				self.change(node, 'ST', value)
+			else:
+				self.change(node, 'CLIHCS', self.random.choice(['0', '1', '2']))
+			return
+		if node.kind == 'dimmer':
+			value = str(self.random.choice([0, 255, self.random.randint(1, 254)]))
+		else:
+			value = '0' if node.get('ST') != '0' else '255'
+		with self.lock:
+			if node.kind == 'dimmer':
+				# a dimmer switched at the wall sends the command as well as the new status
+				self.publish('DON' if value != '0' else 'DOF', '0' if value == '0' else '255', node.address)
+			node.set('ST', value)
+			self.publish('ST', value, node.address)
+
+	def burst(self, changes, rate=0):
+		# makes this many random changes, back to back or paced at rate a second, and
+		# returns the number of events they published
+		published = self.stats['eventsPublished']
+		start = time.time()
+		for change in xrange(changes):
+			if rate:
+				delay = start + change / float(rate) - time.time()
+				if delay > 0:
+					time.sleep(delay)
+			self.randomChange()
+		return self.stats['eventsPublished'] - published
+
+	def generate(self):
+		# holds the rate on average; if we fall behind the next events go out back to back
+		start = time.time()
+		generated = 0
+		while self.running:
+			delay = start + generated / self.eventRate - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			self.randomChange()
+			generated += 1
+
+	###########################
+	# REST
+	###########################
+
+	def document(self, name):
+		if name not in self.documents:
+			if name == 'nodes':
+				self.documents[name] = topologyCorpus.nodesDocument(self.nodeCount)
+			elif name == 'scenes':
+				self.documents[name] = topologyCorpus.scenesDocument(max(1, self.nodeCount // 10), self.nodeCount)
+			else:
+				self.documents[name] = topologyCorpus.programsDocument(len(self.programIds))
+		return self.documents[name]
+
+	def statusDocument(self):
+		with self.lock:
+			nodes = ''.join([node.statusXML() for node in self.nodes])
+		return '<?xml version="1.0" encoding="UTF-8"?><nodes>%s</nodes>' % nodes
+
+	def rest(self, parts):
+		# parts of the path after the leading / e.g. ['rest', 'nodes', '1A 2B 3C 1', 'cmd', 'DON']
+		ok = (200, kRestResponse % ('true', 200))
+		notFound = (404, kRestResponse % ('false', 404))
+		if parts[:1] != ['rest'] or len(parts) < 2:
+			return notFound
+		resource = parts[1]
+		if resource == 'status' and len(parts) == 2:
+			return 200, self.statusDocument()
+		if resource == 'programs':
+			if len(parts) == 2:
+				return 200, self.document('programs')
+			if len(parts) == 4 and parts[2] in self.programIds:
+				self.count('commands')
+				self.runProgram(parts[2], parts[3])
+				return ok
+			return notFound
+		if resource == 'nodes' and len(parts) == 2:
+			return 200, self.document('nodes')
+		if resource == 'nodes' and parts[2:] == ['scenes']:
+			return 200, self.document('scenes')
+		node = self.nodesByAddress.get(parts[2]) if len(parts) > 2 else None
+		if node is None:
+			return notFound
+		if resource == 'query' and len(parts) == 3:
+			with self.lock:
+				for control, value in node.properties:
+					self.publish(control, value, node.address)
+			return ok
+		if resource == 'nodes' and len(parts) >= 5:
+			self.count('commands')
+			if parts[3] == 'cmd' and parts[4] in ['DON', 'DOF']:
+				level = '0' if parts[4] == 'DOF' else (parts[5] if len(parts) > 5 else '255')
+				with self.lock:
+					self.publish(parts[4], level, node.address)
+					node.set('ST', level)
+					self.publish('ST', level, node.address)
+				return ok
+			if parts[3] == 'set' and len(parts) == 6:
+				self.change(node, parts[4], parts[5])
+				return ok
+		return notFound
+
+def main():
+	parser = argparse.ArgumentParser(description='Simulated ISY on localhost for load and regression testing.')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8080)
+	parser.add_argument('--nodes', type=int, default=100, help='number of nodes')
+	parser.add_argument('--rate', type=float, default=1.0, help='random node changes per second, 0 for none')
+	parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every response')
+	parser.add_argument('--drop', type=float, default=0.0, help='fraction of events dropped')
+	parser.add_argument('--gap', type=float, default=0.0, help='fraction of events preceded by a sequence number gap')
+	parser.add_argument('--disconnect-after', type=int, default=0, help='drop a subscription after this many events')
+	parser.add_argument('--heartbeat', type=int, default=kDefaultHeartbeat, help='heartbeat interval in seconds, 0 for none')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--duration', type=float, default=0, help='seconds to run, 0 to run until interrupted')
+	args = parser.parse_args()
+
+	simulator = SimulatedISY(args.nodes, args.rate, args.latency / 1000.0, args.drop, args.gap, args.disconnect_after,
+		args.heartbeat, args.host, args.port, args.seed).start()
+	print('simulated ISY with %d nodes at %s' % (args.nodes, simulator.address))
+	start = time.time()
+	try:
+		while not args.duration or time.time() - start < args.duration:
+			time.sleep(min(kStatsInterval, args.duration - (time.time() - start)) if args.duration else kStatsInterval)
+			print(' '.join(['%s=%d' % item for item in sorted(simulator.stats.items())]))
+	except KeyboardInterrupt:
+		pass
+	simulator.stop()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#							ISY Bridge benchmarks
+#							topologyCorpus.py
+#
+# Synthetic /rest/nodes, /rest/nodes/scenes and /rest/programs documents of
+# any size, built from node, scene and program records shaped like the ones
+# an ISY-994i (v5 firmware) returns.  The node mix has Insteon dimmers and
+# relays, thermostats, Z-Wave nodes with a devtype and a share of secondary
+# and unsupported nodes, grouped into folders the way a real install is.
+################################################################################
+
+kNodeTemplates = [
+	('1.32.65.0', 'DimmerLampSwitch_ADV', '<property id="ST" value="255" formatted="On" uom="%"/>', ''),
+	('2.42.67.0', 'RelayLampSwitch_ADV', '<property id="ST" value="0" formatted="Off" uom="%"/>', ''),
+	('1.66.68.0', 'KeypadDimmer_ADV', '<property id="ST" value="127" formatted="50%" uom="%"/>', ''),
+	('5.11.16.0', 'Thermostat', '<property id="ST" value="144" formatted="72" uom="101"/>', ''),
+	('4.16.1.0', 'ZW_DIMMER', '<property id="ST" value="99" formatted="99%" uom="51"/>', '<devtype><gen>4.16.1</gen><mfg>99.12353.0</mfg><cat>109</cat></devtype>'),
+	('4.16.1.0', 'ZW_SWITCH', '<property id="ST" value="0" formatted="Off" uom="78"/>', '<devtype><gen>4.16.1</gen><mfg>99.12342.0</mfg><cat>121</cat></devtype>'),
+	('16.1.0.0', 'BinaryAlarm', '<property id="ST" value="0" formatted="Off" uom="2"/>', ''),
+	('7.0.65.0', 'RelaySwitch_ADV', '<property id="ST" value="0" formatted="Off" uom="%"/>', ''),
+]
+
+kNodeTemplate = ('<node flag="%d" nodeDefId="%s"><address>%s</address><name>%s</name><parent type="3">%d</parent>'
+	'<type>%s</type><enabled>true</enabled><deviceClass>0</deviceClass><wattage>0</wattage><dcPeriod>0</dcPeriod>'
+	'<startDelay>0</startDelay><endDelay>0</endDelay><pnode>%s</pnode>%s%s</node>')
+
+kGroupTemplate = ('<group flag="132" nodeDefId="InsteonDimmer"><address>%d</address><name>Scene %d</name>'
+	'<parent type="3">%d</parent><ELK_ID>C%02d</ELK_ID><members>%s</members></group>')
+
+kProgramTemplate = ('<program id="%04X" parentId="%04X" status="false" folder="false" enabled="true" runAtStartup="false" running="idle">'
+	'<name>Program %d</name><lastRunTime>2017/06/01 06:00:00 PM</lastRunTime><lastFinishTime>2017/06/01 06:00:00 PM</lastFinishTime>'
+	'<nextScheduledRunTime>2017/06/02 06:00:00 PM</nextScheduledRunTime></program>')
+
+kFolderCount = 20
+
+def nodeAddress(index):
+	# every fourth node is a secondary node (keypad button, sensor) of the one before
+	secondary = index % 4 == 3
+	device = index - 1 if secondary else index
+	button = 2 if secondary else 1
+	return '%X %X %X %d' % (0x10 + device // 0x10000 % 0xF0, device // 0x100 % 0x100, device % 0x100, button)
+
+def nodeRecords(count):
+	records = []
+	for index in range(count):
+		type, nodeDefId, properties, devtype = kNodeTemplates[index % len(kNodeTemplates)]
+		address = nodeAddress(index)
+		records.append(kNodeTemplate % (128, nodeDefId, address, 'Node %d' % index, 10000 + index % kFolderCount,
+			type, address, devtype, properties))
+	return records
+
+def nodesDocument(count):
+	folders = ''.join(['<folder flag="12"><address>%d</address><name>Folder %d</name></folder>' % (10000 + i, i)
+		for i in range(kFolderCount)])
+	groups = ''.join(sceneRecords(max(1, count // 20), count))
+	return ('<?xml version="1.0" encoding="UTF-8"?><nodes><root>Network</root>%s%s%s</nodes>' %
+		(folders, ''.join(nodeRecords(count)), groups))
+
+def sceneRecords(count, nodeCount=100):
+	records = []
+	for index in range(count):
+		members = ''.join(['<link type="16">%s</link>' % nodeAddress((index * 7 + member) % max(1, nodeCount)) for member in range(6)])
+		records.append(kGroupTemplate % (20000 + index, index, 10000 + index % kFolderCount, index % 100, members))
+	return records
+
+def scenesDocument(count, nodeCount=100):
+	return '<?xml version="1.0" encoding="UTF-8"?><nodes>%s</nodes>' % ''.join(sceneRecords(count, nodeCount))
+
+def programsDocument(count):
+	folders = ''.join(['<program id="%04X" parentId="0001" status="true" folder="true"><name>Folder %d</name></program>' % (2 + i, i)
+		for i in range(kFolderCount)])
+	programs = ''.join([kProgramTemplate % (0x100 + i, 2 + i % kFolderCount, i) for i in range(count)])
+	return '<?xml version="1.0" encoding="UTF-8"?><programs>%s%s</programs>' % (folders, programs)
+
+def chunked(document, chunkSize=16384):
+	# the document as the connection pool would hand it over
+	for offset in xrange(0, len(document), chunkSize):
+		yield document[offset:offset+chunkSize]